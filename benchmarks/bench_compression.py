@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Benchmark compressed FASTQ I/O.
+
+Generates a synthetic nanopore-like FASTQ (lognormal read lengths, random bases
+and qualities), compresses it as gzip and BGZF and compares the original
+single-threaded paths (zcat | wc -l, stdlib gzip) with lassensus.core.compression
+on decompression and compression throughput. The codec in use (ISA-L, zlib-ng
+or zlib) and whether pigz is available are printed; parallel BGZF gains need
+more than one CPU core.
+
+Usage: python benchmarks/bench_compression.py [--reads 50000] [--threads 4] [--repeats 3]
+"""
+
+import os
+import sys
+import gzip
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+
+from lassensus.core.compression import read_chunks, write_chunks, describe_backend
+
+def write_fastq(path, n_reads, seed=42):
+    """Write a synthetic FASTQ file with n_reads nanopore-like reads."""
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(n_reads):
+            length = max(100, min(int(rng.lognormvariate(7.2, 0.6)), 20000))
+            sequence = ''.join(rng.choices('ACGT', k=length))
+            quality = ''.join(rng.choices('+,-./0123456789:;<=>?@ABCDE', k=length))
+            f.write(f"@read{i} runid=benchmark\n{sequence}\n+\n{quality}\n")
+
+def best_time(func, repeats):
+    """Return the best runtime over several repeats and the last result."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def zcat_count(path):
+    """Count lines like the original count_reads (zcat | wc -l)."""
+    cat_process = subprocess.Popen(['zcat', str(path)], stdout=subprocess.PIPE)
+    result = subprocess.run(['wc', '-l'], stdin=cat_process.stdout, capture_output=True, text=True, check=True)
+    cat_process.wait()
+    return int(result.stdout.strip()) // 4
+
+def stdlib_read(path):
+    """Decompress with the standard library gzip module."""
+    size = 0
+    with gzip.open(path, 'rb') as f:
+        while True:
+            data = f.read(4 * 1024 * 1024)
+            if not data:
+                return size
+            size += len(data)
+
+def chunks_read(path, threads):
+    """Decompress with lassensus.core.compression.read_chunks."""
+    return sum(len(data) for data in read_chunks(path, threads))
+
+def stdlib_write(source, path, level):
+    """Compress with the standard library gzip module."""
+    with open(source, 'rb') as f_in, gzip.open(path, 'wb', compresslevel=level) as f_out:
+        while True:
+            data = f_in.read(4 * 1024 * 1024)
+            if not data:
+                break
+            f_out.write(data)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compressed FASTQ I/O')
+    parser.add_argument('--reads', type=int, default=50000, help='Number of simulated reads (default: 50000)')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1, help='Number of threads (default: all CPU cores)')
+    parser.add_argument('--level', type=int, default=6, help='Compression level (default: 6)')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of timed repeats (default: 3)')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fastq = Path(temp_dir) / 'reads.fastq'
+        gzip_file = Path(temp_dir) / 'reads.fastq.gz'
+        bgzf_file = Path(temp_dir) / 'reads.bgzf.fastq.gz'
+        write_fastq(fastq, args.reads)
+        size_mb = os.path.getsize(fastq) / 1e6
+        
+        print(f"Reads: {args.reads:,} ({size_mb:,.0f} MB uncompressed)")
+        print(f"Backend: {describe_backend(args.threads)}")
+        
+        print("\nCompression")
+        results = [
+            ('stdlib gzip', best_time(lambda: stdlib_write(fastq, gzip_file, args.level), args.repeats)[0]),
+            ('gzip, 1 thread', best_time(lambda: write_chunks(Path(temp_dir) / 'g1.gz', read_chunks(fastq), 'gzip', 1, args.level), args.repeats)[0]),
+            (f'gzip, {args.threads} threads', best_time(lambda: write_chunks(Path(temp_dir) / 'gn.gz', read_chunks(fastq), 'gzip', args.threads, args.level), args.repeats)[0]),
+            ('bgzf, 1 thread', best_time(lambda: write_chunks(Path(temp_dir) / 'b1.gz', read_chunks(fastq), 'bgzf', 1, args.level), args.repeats)[0]),
+            (f'bgzf, {args.threads} threads', best_time(lambda: write_chunks(bgzf_file, read_chunks(fastq), 'bgzf', args.threads, args.level), args.repeats)[0])
+        ]
+        for name, elapsed in results:
+            print(f"{name:20s} {elapsed:7.2f} s  {size_mb / elapsed:7.1f} MB/s  {results[0][1] / elapsed:5.1f}x")
+        print(f"gzip size {os.path.getsize(gzip_file) / 1e6:,.1f} MB, bgzf size {os.path.getsize(bgzf_file) / 1e6:,.1f} MB")
+        
+        print("\nDecompression")
+        results = [
+            ('zcat | wc -l', best_time(lambda: zcat_count(gzip_file), args.repeats)[0]),
+            ('stdlib gzip', best_time(lambda: stdlib_read(gzip_file), args.repeats)[0]),
+            (f'gzip, {args.threads} threads', best_time(lambda: chunks_read(gzip_file, args.threads), args.repeats)[0]),
+            ('bgzf, 1 thread', best_time(lambda: chunks_read(bgzf_file, 1), args.repeats)[0]),
+            (f'bgzf, {args.threads} threads', best_time(lambda: chunks_read(bgzf_file, args.threads), args.repeats)[0])
+        ]
+        for name, elapsed in results:
+            print(f"{name:20s} {elapsed:7.2f} s  {size_mb / elapsed:7.1f} MB/s  {results[0][1] / elapsed:5.1f}x")
+
+if __name__ == '__main__':
+    main()
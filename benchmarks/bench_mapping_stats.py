@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark the reference scoring statistics engine.
+
+Generates a synthetic 10k-read nanopore-like SAM file (soft clips, ~7% errors)
+and compares the original per-character CIGAR parser with the NumPy-batched
+engine in lassensus.core.mapping_stats on runtime and on the identity they
+report.
+
+Usage: python benchmarks/bench_mapping_stats.py [--reads 10000] [--repeats 3]
+"""
+
+import sys
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+
+from lassensus.core.mapping_stats import calculate_mapping_stats
+
+REF_LENGTH = 7279
+
+def legacy_calculate_mapping_stats(sam_file):
+    """Original calculate_mapping_stats from lassensus 0.0.3."""
+    mapped_reads = 0
+    total_length = 0
+    total_matches = 0
+    
+    with open(sam_file, 'r') as f:
+        for line in f:
+            if line.startswith('@'):
+                continue
+            
+            fields = line.strip().split('\t')
+            if len(fields) < 11:
+                continue
+                
+            flag = int(fields[1])
+            if flag & 0x4:  # unmapped
+                continue
+                
+            mapped_reads += 1
+            
+            # Parse CIGAR string for alignment statistics
+            cigar = fields[5]
+            matches = sum(int(n) for n in ''.join(c if c.isdigit() else ' ' for c in cigar).split())
+            total_length += matches
+            
+            # Calculate identity from optional NM field
+            for field in fields[11:]:
+                if field.startswith('NM:i:'):
+                    nm = int(field.split(':')[2])
+                    total_matches += matches - nm
+                    break
+    
+    return {
+        'mapped_reads': mapped_reads,
+        'coverage': total_length / 1000,
+        'avg_identity': (total_matches / total_length * 100) if total_length > 0 else 0
+    }
+
+def simulate_alignment(rng):
+    """Simulate a CIGAR string, NM value and reference start for one nanopore read."""
+    read_length = min(int(rng.lognormvariate(7.2, 0.6)), REF_LENGTH - 200)
+    start = rng.randint(0, REF_LENGTH - read_length - 1)
+    ops = []
+    nm = 0
+    if rng.random() < 0.5:
+        ops.append(f"{rng.randint(10, 150)}S")
+    remaining = read_length
+    while remaining > 0:
+        block = min(remaining, rng.randint(5, 40))
+        ops.append(f"{block}M")
+        nm += sum(1 for _ in range(block) if rng.random() < 0.03)
+        remaining -= block
+        if remaining <= 0:
+            break
+        indel = rng.randint(1, 3)
+        ops.append(f"{indel}{rng.choice('ID')}")
+        nm += indel
+    if rng.random() < 0.5:
+        ops.append(f"{rng.randint(10, 150)}S")
+    return start, ''.join(ops), nm
+
+def write_sam(path, n_reads, seed=42):
+    """Write a synthetic SAM file with n_reads alignments to one reference."""
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write(f"@SQ\tSN:ref\tLN:{REF_LENGTH}\n")
+        for i in range(n_reads):
+            if rng.random() < 0.05:
+                f.write(f"read{i}\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*\n")
+                continue
+            start, cigar, nm = simulate_alignment(rng)
+            f.write(f"read{i}\t0\tref\t{start + 1}\t60\t{cigar}\t*\t0\t0\t*\t*\ttp:A:P\tNM:i:{nm}\tms:i:0\n")
+
+def best_time(func, repeats):
+    """Return the best runtime over several repeats and the last result."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reference scoring statistics')
+    parser.add_argument('--reads', type=int, default=10000, help='Number of simulated reads (default: 10000)')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of timed repeats (default: 3)')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sam_file = Path(temp_dir) / 'benchmark.sam'
+        write_sam(sam_file, args.reads)
+        
+        legacy_time, legacy = best_time(lambda: legacy_calculate_mapping_stats(sam_file), args.repeats)
+        
+        def run_engine():
+            with open(sam_file, 'r') as f:
+                return calculate_mapping_stats(f, alignment_format='sam')
+        engine_time, engine = best_time(run_engine, args.repeats)
+    
+    print(f"Reads: {args.reads:,}")
+    print(f"legacy: {legacy_time * 1000:8.1f} ms  mapped={legacy['mapped_reads']}  identity={legacy['avg_identity']:.2f}%")
+    print(f"engine: {engine_time * 1000:8.1f} ms  mapped={engine['mapped_reads']}  identity={engine['avg_identity']:.2f}%  "
+          f"breadth={engine['breadth']:.1f}%  mismatches={engine['mismatches']:,}  "
+          f"insertions={engine['insertions']:,}  deletions={engine['deletions']:,}")
+    print(f"speed-up: {legacy_time / engine_time:.1f}x")
+
+if __name__ == '__main__':
+    main()
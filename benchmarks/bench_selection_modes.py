@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Compare the per-reference and competitive reference selection modes.
+
+Generates a synthetic L-segment reference set around one random 7,279 bp
+sequence: the source of the reads, near-identical variants of it (0.1%
+divergence, which tie with the source on mapped reads) and more distant
+variants (2%, 5% and 10%). Nanopore-like reads (~7% errors) are simulated
+from the source, and both selection modes score every reference on the same
+reads. For each mode the runtime, the selected reference (whether it is the
+source) and the mapped reads and identity of the top references are printed,
+together with the agreement of the two rankings.
+
+Needs minimap2 on the PATH.
+
+Usage: python benchmarks/bench_selection_modes.py [--reads 2000] [--close 4] [--distant 6] [--threads 4]
+"""
+
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+
+from lassensus.core.reference_selection import evaluate_references, evaluate_references_competitive, select_best_references, ranking_key
+
+REF_LENGTH = 7279
+DISTANT_DIVERGENCES = [0.02, 0.05, 0.10]
+
+def mutate(sequence, divergence, rng):
+    """Return a copy of sequence with a fraction divergence of its bases substituted."""
+    bases = list(sequence)
+    for position in rng.sample(range(len(bases)), int(len(bases) * divergence)):
+        bases[position] = rng.choice([base for base in 'ACGT' if base != bases[position]])
+    return ''.join(bases)
+
+def make_references(directory, n_close, n_distant, rng):
+    """Write the synthetic reference set and return the source and the (ref_file, ref_info) tuples in shuffled order."""
+    source = ''.join(rng.choice('ACGT') for _ in range(REF_LENGTH))
+    sequences = [('SOURCE', source)]
+    sequences += [(f"CLOSE{i + 1}", mutate(source, 0.001, rng)) for i in range(n_close)]
+    sequences += [(f"DISTANT{i + 1}", mutate(source, DISTANT_DIVERGENCES[i % len(DISTANT_DIVERGENCES)], rng)) for i in range(n_distant)]
+    rng.shuffle(sequences)
+    
+    segment_dir = Path(directory) / 'L_segment'
+    segment_dir.mkdir(parents=True)
+    references = []
+    for accession, sequence in sequences:
+        ref_file = segment_dir / f"{accession}.fasta"
+        with open(ref_file, 'w') as f:
+            f.write(f">{accession} synthetic\n{sequence}\n")
+        references.append((ref_file, {'accession': accession, 'description': 'synthetic', 'sequence': sequence}))
+    return source, references
+
+def write_reads(fastq_file, source, n_reads, rng):
+    """Write n_reads reads from source with ~7% substitution, insertion and deletion errors."""
+    with open(fastq_file, 'w') as f:
+        for i in range(n_reads):
+            length = min(REF_LENGTH, max(200, int(rng.lognormvariate(7.3, 0.6))))
+            start = rng.randrange(0, REF_LENGTH - length + 1)
+            read = []
+            for base in source[start:start + length]:
+                r = rng.random()
+                if r < 0.03:
+                    read.append(rng.choice('ACGT'))
+                elif r < 0.05:
+                    read.append(base + rng.choice('ACGT'))
+                elif r >= 0.07:
+                    read.append(base)
+            sequence = ''.join(read)
+            f.write(f"@read{i}\n{sequence}\n+\n{'5' * len(sequence)}\n")
+
+def report(name, results, elapsed):
+    """Print the runtime, selected reference and top references of one mode; return the ranking."""
+    best_refs, _, _ = select_best_references(results)
+    ranked = sorted(results, key=lambda result: ranking_key(result[2]), reverse=True)
+    selected = best_refs['L']['accession'] if best_refs['L'] else None
+    print(f"{name}: {elapsed:.2f} s, selected {selected} ({'source' if selected == 'SOURCE' else 'not the source'})")
+    for ref_file, ref_info, stats in ranked[:5]:
+        print(f"  {ref_info['accession']:<10} {stats['mapped_reads']:>6} reads  {stats['avg_identity']:6.2f}% identity  {stats['matches']:>9} matches")
+    return [ref_info['accession'] for ref_file, ref_info, stats in ranked]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-reference and competitive reference selection')
+    parser.add_argument('--reads', type=int, default=2000)
+    parser.add_argument('--close', type=int, default=4, help='Near-identical variants of the source')
+    parser.add_argument('--distant', type=int, default=6, help='Variants 2-10%% away from the source')
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    
+    if not shutil.which('minimap2'):
+        print("minimap2 not found")
+        sys.exit(1)
+    
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        source, references = make_references(temp_dir / 'references', args.close, args.distant, rng)
+        fastq_file = temp_dir / 'reads.fastq'
+        write_reads(fastq_file, source, args.reads, rng)
+        work_dir = temp_dir / 'work'
+        work_dir.mkdir()
+        cache_dir = temp_dir / 'cache'
+        print(f"{len(references)} references ({args.close} near-identical, {args.distant} distant), {args.reads:,} reads")
+        
+        start = time.perf_counter()
+        results = evaluate_references(references, fastq_file, work_dir, args.threads, cache_dir)
+        per_reference = report('per-reference', results, time.perf_counter() - start)
+        
+        start = time.perf_counter()
+        results = evaluate_references_competitive(references, fastq_file, work_dir, args.threads, cache_dir)
+        competitive = report('competitive', results, time.perf_counter() - start)
+    
+    agreement = sum(a == b for a, b in zip(per_reference, competitive))
+    print(f"Rankings agree on {agreement} of {len(per_reference)} positions; "
+          f"top reference {'agrees' if per_reference[0] == competitive[0] else 'differs'}")
+
+if __name__ == '__main__':
+    main()
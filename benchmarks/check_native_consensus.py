@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Check the native consensus backend on a fixture with a known consensus.
+
+Calls the consensus of a small fixture (benchmarks/data/native_consensus) with
+the native backend and compares it with expected_consensus.fa. The expected
+consensus was worked out by hand from ivar's documented rules for
+
+    samtools mpileup -aa -d 0 -Q 0 -f reference.fasta reads.bam |
+        ivar consensus -p expected -m 3 -q 0 -t 0.7 -k
+
+It has not been produced by samtools and ivar, so parity with ivar is not
+verified by this check on its own; run it with --ivar where samtools and ivar
+are installed to compare against their actual output.
+
+reads.bam holds the five alignments of reads.sam (samtools view -b reads.sam)
+on a 30 bp reference, laid out so that every ivar rule decides one position:
+
+- positions 1-5 and 26-30 are covered by two reads, below -m, and left out (-k)
+- position 11 has C in three reads and T in two, so C alone stays below -t
+  and both are called as Y
+- position 13 has T in four reads and G in one, so T alone is called
+- position 15 is deleted in four reads and left out
+- position 19 is deleted in one read and called as the reference base
+- all five reads insert GG after position 21, which is added
+- one read inserts C after position 23, which stays below -t and is not added
+
+All base qualities are 40 and -q is 0, so mpileup's BAQ recalibration (which
+the native backend does not apply) should not change which bases ivar counts.
+With --ivar, samtools and ivar are run on the fixture as well and their
+consensus is checked against the expected one.
+
+Usage: python benchmarks/check_native_consensus.py [--ivar]
+"""
+
+import sys
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+
+from lassensus.core.consensus_generation import generate_consensus, generate_native_consensus
+
+DATA_DIR = Path(__file__).parent / 'data' / 'native_consensus'
+MIN_DEPTH = 3
+MIN_QUALITY = 0
+MAJORITY_THRESHOLD = 0.7
+
+def read_sequence(fasta_file):
+    """Return the sequence of a single-record FASTA file."""
+    with open(fasta_file) as f:
+        return ''.join(line.strip() for line in f if not line.startswith('>'))
+
+def compare(name, sequence, expected):
+    """Print whether a consensus matches the expected one, with the first difference if not."""
+    if sequence == expected:
+        print(f"{name}: {sequence} matches the expected consensus")
+        return True
+    first = next((i for i, (a, b) in enumerate(zip(sequence, expected)) if a != b), min(len(sequence), len(expected)))
+    print(f"{name}: {sequence} differs from the expected consensus {expected} at consensus position {first + 1}")
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the native consensus backend on a fixture with a known consensus')
+    parser.add_argument('--ivar', action='store_true', help='Also run samtools mpileup | ivar consensus on the fixture')
+    args = parser.parse_args()
+    
+    expected = read_sequence(DATA_DIR / 'expected_consensus.fa')
+    bam_file = DATA_DIR / 'reads.bam'
+    reference_file = DATA_DIR / 'reference.fasta'
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        consensus_file, _ = generate_native_consensus(bam_file, reference_file, temp_dir, 'native', 'L',
+                                                      MIN_DEPTH, MIN_QUALITY, MAJORITY_THRESHOLD)
+        passed = compare('native', read_sequence(consensus_file), expected)
+        
+        if args.ivar:
+            if not (shutil.which('samtools') and shutil.which('ivar')):
+                print("ivar: samtools or ivar not found, skipped")
+            else:
+                consensus_file, _ = generate_consensus(bam_file, reference_file, temp_dir, 'ivar', 'L',
+                                                       MIN_DEPTH, MIN_QUALITY, MAJORITY_THRESHOLD)
+                passed = compare('ivar', read_sequence(consensus_file), expected) and passed
+    
+    sys.exit(0 if passed else 1)
+
+if __name__ == '__main__':
+    main()
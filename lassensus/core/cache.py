@@ -0,0 +1,610 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+import argparse
+import logging
+import hashlib
+import json
+import shutil
+import tarfile
+import tempfile
+from datetime import datetime
+
+from .compression import read_chunks
+
+logger = logging.getLogger(__name__)
+
+# Default maximum size of the minimap2 index, FASTQ scan and score cache in GB
+DEFAULT_CACHE_MAX_SIZE = 5.0
+
+# Version of the cached reference scores; increase when the statistics change
+SCORE_CACHE_VERSION = 2
+
+# File in a run's references directory recording which content its references were written from
+REFERENCE_SOURCE_FILE = 'reference_source.json'
+
+_minimap2_version = None
+
+def get_cache_dir(cache_dir=None):
+    """Return the lassensus cache directory.
+    
+    Uses cache_dir when given, otherwise $LASSENSUS_CACHE_DIR, otherwise
+    $XDG_CACHE_HOME/lassensus (~/.cache/lassensus).
+    """
+    if cache_dir:
+        return Path(cache_dir)
+    if os.environ.get('LASSENSUS_CACHE_DIR'):
+        return Path(os.environ['LASSENSUS_CACHE_DIR'])
+    xdg_cache = os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')
+    return Path(xdg_cache) / 'lassensus'
+
+def get_index_cache_dir(cache_dir=None):
+    """Return the directory holding cached minimap2 indexes."""
+    return get_cache_dir(cache_dir) / 'minimap2_indexes'
+
+def get_scan_cache_dir(cache_dir=None):
+    """Return the directory holding FASTQ scan sidecars."""
+    return get_cache_dir(cache_dir) / 'fastq_scans'
+
+def get_minimap2_version():
+    """Get the installed minimap2 version (cached for the lifetime of the process)."""
+    global _minimap2_version
+    if _minimap2_version is None:
+        try:
+            result = subprocess.run(['minimap2', '--version'], check=True, capture_output=True, text=True)
+            _minimap2_version = result.stdout.strip()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Could not determine minimap2 version: {e}")
+            _minimap2_version = 'unknown'
+    return _minimap2_version
+
+def hash_files(files):
+    """Calculate a SHA-256 hash over the contents of one or more files."""
+    sha = hashlib.sha256()
+    for file in files:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        # Separate files so that (AB, C) and (A, BC) hash differently
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+def hash_reads(fastq_file, threads=1):
+    """Calculate a SHA-256 hash over the decompressed content of a FASTQ file.
+    
+    Unlike hash_files, the hash does not change with the compression format,
+    level or codec the file was written with.
+    """
+    sha = hashlib.sha256()
+    for chunk in read_chunks(fastq_file, threads):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+def count_sequences(files):
+    """Count the FASTA records in one or more files."""
+    count = 0
+    for file in files:
+        with open(file, 'r') as f:
+            count += sum(1 for line in f if line.startswith('>'))
+    return count
+
+def get_index(reference_files, preset='map-ont', cache_dir=None):
+    """Return a cached minimap2 index (.mmi) for the given reference FASTA file(s).
+    
+    The index is keyed by the content hash of the reference FASTA(s), the
+    minimap2 preset and the minimap2 version, so it is reused across runs and
+    samples. A single reference sequence is indexed by minimap2 faster than
+    a separate indexing process takes to start, so it is not cached. In that
+    case, or if the cache directory cannot be used, the first reference file
+    is returned unchanged and minimap2 will index it on the fly.
+    
+    The cache is not trimmed here; call evict_cache once per run, after all
+    alignments are done, so that no index is removed while it is in use.
+    
+    Args:
+        reference_files: Reference FASTA file or list of files
+        preset: minimap2 preset used for indexing
+        cache_dir: Cache directory (see get_cache_dir)
+    """
+    if isinstance(reference_files, (str, Path)):
+        reference_files = [reference_files]
+    reference_files = [Path(f) for f in reference_files]
+    
+    if count_sequences(reference_files) <= 1:
+        return reference_files[0]
+    
+    index_dir = get_index_cache_dir(cache_dir)
+    try:
+        index_dir.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not use index cache directory {index_dir}: {e}")
+        return reference_files[0]
+    
+    version = get_minimap2_version()
+    key = hashlib.sha256(
+        f"{hash_files(reference_files)}|{preset}|{version}".encode()
+    ).hexdigest()
+    index_file = index_dir / f"{key}.mmi"
+    
+    if index_file.exists():
+        # Mark as recently used for LRU eviction
+        os.utime(index_file)
+        return index_file
+    
+    # Build into a temporary file and move it into place atomically so that
+    # concurrent runs never see a partially written index
+    temp_index = index_dir / f"{key}.{os.getpid()}.tmp"
+    cmd = ['minimap2', '-x', preset, '-d', str(temp_index)] + [str(f) for f in reference_files]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True, text=True)
+        os.replace(temp_index, index_file)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error building minimap2 index for {', '.join(str(f) for f in reference_files)}: {e.stderr}")
+        if temp_index.exists():
+            os.remove(temp_index)
+        sys.exit(1)
+    
+    metadata = {
+        'references': [str(f) for f in reference_files],
+        'preset': preset,
+        'minimap2_version': version,
+        'created': datetime.now().isoformat(timespec='seconds')
+    }
+    with open(index_dir / f"{key}.json", 'w') as f:
+        json.dump(metadata, f, indent=2)
+    
+    return index_file
+
+def list_indexes(cache_dir=None):
+    """List cached indexes, most recently used first."""
+    index_dir = get_index_cache_dir(cache_dir)
+    if not index_dir.exists():
+        return []
+    
+    entries = []
+    for index_file in index_dir.glob('*.mmi'):
+        stat = index_file.stat()
+        metadata_file = index_file.with_suffix('.json')
+        metadata = {}
+        if metadata_file.exists():
+            with open(metadata_file, 'r') as f:
+                metadata = json.load(f)
+        entries.append({
+            'file': index_file,
+            'size': stat.st_size,
+            'last_used': stat.st_mtime,
+            'references': metadata.get('references', []),
+            'preset': metadata.get('preset', 'unknown'),
+            'minimap2_version': metadata.get('minimap2_version', 'unknown')
+        })
+    
+    entries.sort(key=lambda entry: entry['last_used'], reverse=True)
+    return entries
+
+def remove_index(index_file):
+    """Remove a cached index together with its metadata."""
+    index_file = Path(index_file)
+    for f in [index_file, index_file.with_suffix('.json')]:
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+
+def list_scans(cache_dir=None):
+    """List cached FASTQ scans, most recently used first."""
+    scan_dir = get_scan_cache_dir(cache_dir)
+    if not scan_dir.exists():
+        return []
+    
+    entries = []
+    for scan_file in scan_dir.glob('*.scan.json'):
+        stat = scan_file.stat()
+        try:
+            with open(scan_file, 'r') as f:
+                fastq_file = json.load(f).get('path')
+        except (OSError, ValueError):
+            fastq_file = None
+        entries.append({
+            'file': scan_file,
+            'size': stat.st_size,
+            'last_used': stat.st_mtime,
+            'fastq': fastq_file
+        })
+    
+    entries.sort(key=lambda entry: entry['last_used'], reverse=True)
+    return entries
+
+def remove_cache_file(scan_file):
+    """Remove a cached FASTQ scan or score table."""
+    try:
+        os.remove(scan_file)
+    except FileNotFoundError:
+        pass
+
+def evict_cache(cache_dir=None, max_size=DEFAULT_CACHE_MAX_SIZE):
+    """Evict least recently used indexes, FASTQ scans and score tables until the cache fits in max_size GB.
+    
+    Scans of FASTQ files that no longer exist are removed first, whatever
+    the size of the cache. Returns the number of removed entries.
+    """
+    max_bytes = max_size * 1024 ** 3
+    entries = [(entry, remove_index) for entry in list_indexes(cache_dir)]
+    entries += [(entry, remove_cache_file) for entry in list_score_tables(cache_dir)]
+    orphaned = 0
+    for entry in list_scans(cache_dir):
+        if entry['fastq'] is None or not os.path.exists(entry['fastq']):
+            remove_cache_file(entry['file'])
+            orphaned += 1
+        else:
+            entries.append((entry, remove_cache_file))
+    if orphaned:
+        logger.info(f"Removed {orphaned} cached scans of FASTQ files that no longer exist")
+    
+    entries.sort(key=lambda item: item[0]['last_used'], reverse=True)
+    total_size = sum(entry['size'] for entry, _ in entries)
+    removed = 0
+    
+    # Entries are sorted most recently used first, so evict from the end
+    while entries and total_size > max_bytes:
+        entry, remove = entries.pop()
+        remove(entry['file'])
+        total_size -= entry['size']
+        removed += 1
+    
+    if removed:
+        logger.info(f"Evicted {removed} least recently used indexes, FASTQ scans and score tables from cache")
+    
+    return orphaned + removed
+
+def get_score_cache_dir(cache_dir=None):
+    """Return the directory holding cached per-sample reference scores."""
+    return get_cache_dir(cache_dir) / 'scores'
+
+def get_score_table_file(read_hash, parameters, cache_dir=None):
+    """Return the score table file for a read set and aligner parameters.
+    
+    read_hash identifies the reads by their decompressed content (see
+    hash_reads). A table holds the statistics of every reference scored on
+    the read set, keyed by the hash of the reference sequence.
+    """
+    key = hashlib.sha256(json.dumps({
+        'reads': read_hash,
+        'parameters': parameters,
+        'version': SCORE_CACHE_VERSION
+    }, sort_keys=True).encode()).hexdigest()
+    return get_score_cache_dir(cache_dir) / f"{key}.json"
+
+def load_score_table(table_file):
+    """Load a cached score table, or an empty table if there is none.
+    
+    A loaded table is marked as recently used for cache eviction (see evict_cache).
+    """
+    if not Path(table_file).exists():
+        return {}
+    try:
+        with open(table_file, 'r') as f:
+            table = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable score table {table_file}: {e}")
+        return {}
+    try:
+        os.utime(table_file)
+    except OSError:
+        pass
+    return table
+
+def list_score_tables(cache_dir=None):
+    """List cached score tables, most recently used first."""
+    score_dir = get_score_cache_dir(cache_dir)
+    if not score_dir.exists():
+        return []
+    
+    entries = []
+    for table_file in score_dir.glob('*.json'):
+        stat = table_file.stat()
+        entries.append({'file': table_file, 'size': stat.st_size, 'last_used': stat.st_mtime})
+    
+    entries.sort(key=lambda entry: entry['last_used'], reverse=True)
+    return entries
+
+def save_score_table(table_file, table):
+    """Write a score table atomically; failures only disable caching."""
+    table_file = Path(table_file)
+    try:
+        table_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = table_file.with_name(f"{table_file.name}.{os.getpid()}.tmp")
+        with open(temp_file, 'w') as f:
+            json.dump(table, f)
+        os.replace(temp_file, table_file)
+    except OSError as e:
+        logger.warning(f"Could not cache reference scores to {table_file}: {e}")
+
+def get_reference_cache_dir(cache_dir=None):
+    """Return the directory holding cached reference downloads."""
+    return get_cache_dir(cache_dir) / 'references'
+
+def reference_filters(genome=1, completeness=90, host=4, metadata=4):
+    """Return the lassaseq filter parameters that determine a reference download.
+    
+    Completeness only applies to partial genomes (genome=2) and is left out otherwise.
+    """
+    return {
+        'genome': genome,
+        'completeness': completeness if genome == 2 else None,
+        'host': host,
+        'metadata': metadata
+    }
+
+def hash_tree(directory):
+    """Calculate a SHA-256 hash over the relative paths and contents of all files in a directory."""
+    directory = Path(directory)
+    sha = hashlib.sha256()
+    for file in sorted(f for f in directory.rglob('*') if f.is_file()):
+        sha.update(str(file.relative_to(directory)).encode() + b'\0')
+        sha.update(hash_files([file]).encode())
+    return sha.hexdigest()
+
+def get_tree_size(directory):
+    """Total size in bytes of all files in a directory."""
+    return sum(f.stat().st_size for f in Path(directory).rglob('*') if f.is_file())
+
+def list_references(cache_dir=None):
+    """List cached reference downloads, newest first."""
+    reference_dir = get_reference_cache_dir(cache_dir)
+    if not reference_dir.exists():
+        return []
+    
+    entries = []
+    for metadata_file in reference_dir.glob('*/metadata.json'):
+        try:
+            with open(metadata_file, 'r') as f:
+                metadata = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable reference cache entry {metadata_file.parent}: {e}")
+            continue
+        metadata['dir'] = metadata_file.parent
+        metadata['modified'] = metadata_file.stat().st_mtime
+        entries.append(metadata)
+    
+    entries.sort(key=lambda entry: (entry['created'], entry['modified']), reverse=True)
+    return entries
+
+def find_cached_references(filters, version=None, cache_dir=None):
+    """Find the cached download for a set of filters.
+    
+    Returns the cache entry (see list_references) of the requested dataset
+    version, or of the newest version if none is given, or None. The
+    downloaded files are in the entry's 'dir' / 'data'.
+    """
+    for entry in list_references(cache_dir):
+        if entry['filters'] == filters and (version is None or entry['version'] == version):
+            return entry
+    return None
+
+def store_references(source_dir, filters, version, cache_dir=None):
+    """Copy a lassaseq download into the reference cache.
+    
+    Entries are keyed by the filters and the dataset version, and record a
+    content hash of the downloaded files to verify imported snapshots.
+    
+    Returns:
+        Directory with the cached references
+    """
+    reference_dir = get_reference_cache_dir(cache_dir)
+    key = hashlib.sha256(json.dumps({'filters': filters, 'version': version}, sort_keys=True).encode()).hexdigest()
+    entry_dir = reference_dir / key
+    reference_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Assemble the entry next to its final location and move it into place
+    temp_dir = Path(tempfile.mkdtemp(dir=reference_dir, prefix=f"{key}.", suffix='.tmp'))
+    shutil.copytree(source_dir, temp_dir / 'data')
+    with open(temp_dir / 'metadata.json', 'w') as f:
+        json.dump({
+            'filters': filters,
+            'version': version,
+            'content_hash': hash_tree(temp_dir / 'data'),
+            'created': datetime.now().isoformat(timespec='seconds')
+        }, f, indent=2)
+    
+    if entry_dir.exists():
+        shutil.rmtree(entry_dir)
+    os.replace(temp_dir, entry_dir)
+    
+    return entry_dir / 'data'
+
+def get_content_hash(data_dir):
+    """Return the content hash of a reference download: the one recorded in its cache entry, or a hash of its files."""
+    metadata_file = Path(data_dir).parent / 'metadata.json'
+    if metadata_file.exists():
+        try:
+            with open(metadata_file, 'r') as f:
+                content_hash = json.load(f).get('content_hash')
+            if content_hash:
+                return content_hash
+        except (OSError, ValueError):
+            pass
+    return hash_tree(data_dir)
+
+def references_current(output_dir, source):
+    """Check whether a run's references directory was last written from source (see record_references_source)."""
+    source_file = Path(output_dir) / REFERENCE_SOURCE_FILE
+    if not source_file.exists() or not (Path(output_dir) / 'FASTA').exists():
+        return False
+    try:
+        with open(source_file, 'r') as f:
+            return json.load(f).get('source') == source
+    except (OSError, ValueError):
+        return False
+
+def record_references_source(output_dir, source):
+    """Record the content a run's references directory was written from."""
+    with open(Path(output_dir) / REFERENCE_SOURCE_FILE, 'w') as f:
+        json.dump({'source': source}, f)
+
+def materialize_references(cached_dir, output_dir):
+    """Copy cached references into a run's references directory, replacing older copies.
+    
+    Nothing is copied when the directory already holds the same download, so
+    the sketch, cluster and reference store caches kept next to the FASTA
+    files survive between runs.
+    
+    Returns:
+        True if the references were copied, False if they were current
+    """
+    output_dir = Path(output_dir)
+    source = get_content_hash(cached_dir)
+    if references_current(output_dir, source):
+        logger.info(f"References in {output_dir} are up to date")
+        return False
+    
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / REFERENCE_SOURCE_FILE).unlink(missing_ok=True)
+    for item in Path(cached_dir).iterdir():
+        target = output_dir / item.name
+        if target.is_dir():
+            shutil.rmtree(target)
+        elif target.exists():
+            os.remove(target)
+        if item.is_dir():
+            shutil.copytree(item, target)
+        else:
+            shutil.copy2(item, target)
+    record_references_source(output_dir, source)
+    return True
+
+def export_snapshot(snapshot_file, cache_dir=None):
+    """Write all cached reference downloads to a .tar.gz snapshot for offline nodes."""
+    entries = list_references(cache_dir)
+    with tarfile.open(snapshot_file, 'w:gz') as tar:
+        for entry in entries:
+            tar.add(entry['dir'], arcname=f"references/{entry['dir'].name}")
+    return len(entries)
+
+def import_snapshot(snapshot_file, cache_dir=None):
+    """Add the reference downloads of a snapshot to the cache.
+    
+    Every entry is verified against its recorded content hash; corrupted
+    entries are skipped.
+    
+    Returns:
+        Number of imported entries
+    """
+    reference_dir = get_reference_cache_dir(cache_dir)
+    reference_dir.mkdir(parents=True, exist_ok=True)
+    imported = 0
+    
+    with tempfile.TemporaryDirectory(dir=reference_dir) as temp_dir:
+        with tarfile.open(snapshot_file, 'r:gz') as tar:
+            for member in tar.getmembers():
+                # Only accept regular files and directories inside references/
+                path = Path(member.name)
+                if path.is_absolute() or '..' in path.parts or path.parts[0] != 'references' or not (member.isfile() or member.isdir()):
+                    logger.error(f"Refusing to import unsafe snapshot member {member.name}")
+                    sys.exit(1)
+            tar.extractall(temp_dir)
+        
+        for entry_dir in sorted((Path(temp_dir) / 'references').glob('*')):
+            try:
+                with open(entry_dir / 'metadata.json', 'r') as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping snapshot entry {entry_dir.name}: {e}")
+                continue
+            if hash_tree(entry_dir / 'data') != metadata.get('content_hash'):
+                logger.warning(f"Skipping snapshot entry {entry_dir.name}: content does not match its hash")
+                continue
+            target = reference_dir / entry_dir.name
+            if target.exists():
+                shutil.rmtree(target)
+            os.replace(entry_dir, target)
+            imported += 1
+    
+    return imported
+
+def format_filters(filters):
+    """Format reference filters for display."""
+    return ', '.join(f"{name}={value}" for name, value in filters.items() if value is not None)
+
+def format_size(size):
+    """Format a size in bytes as a human-readable string."""
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def main(args=None):
+    """Main function for cache management."""
+    if args is None:
+        parser = argparse.ArgumentParser(description='Manage the lassensus cache')
+        parser.add_argument('action', choices=['list', 'prune', 'export', 'import'],
+            help='list=show cached indexes, FASTQ scans, scores and references, prune=evict indexes, FASTQ scans and scores, export/import=reference snapshot')
+        parser.add_argument('--cache_dir', default=None, help='Cache directory (default: $LASSENSUS_CACHE_DIR or ~/.cache/lassensus)')
+        parser.add_argument('--max_size', type=float, default=None, help='Prune the cache down to this size in GB (default: remove everything)')
+        parser.add_argument('--snapshot', default=None, help='Snapshot file (.tar.gz) to export to or import from')
+        args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    index_dir = get_index_cache_dir(args.cache_dir)
+    
+    if args.action == 'list':
+        entries = list_indexes(args.cache_dir)
+        logger.info(f"minimap2 index cache: {index_dir}")
+        for entry in entries:
+            last_used = datetime.fromtimestamp(entry['last_used']).strftime('%Y-%m-%d %H:%M')
+            references = ', '.join(Path(r).name for r in entry['references'])
+            logger.info(f"{entry['file'].name}  {format_size(entry['size'])}  last used {last_used}  {entry['preset']}  {references}")
+        total_size = sum(entry['size'] for entry in entries)
+        logger.info(f"{len(entries)} cached indexes, {format_size(total_size)} in total")
+        
+        scans = list_scans(args.cache_dir)
+        orphaned = sum(1 for entry in scans if entry['fastq'] is None or not os.path.exists(entry['fastq']))
+        logger.info(f"FASTQ scan cache: {get_scan_cache_dir(args.cache_dir)}, {len(scans)} scans "
+                    f"({orphaned} of FASTQ files that no longer exist), {format_size(sum(entry['size'] for entry in scans))}")
+        
+        references = list_references(args.cache_dir)
+        logger.info(f"Reference cache: {get_reference_cache_dir(args.cache_dir)}")
+        for entry in references:
+            logger.info(f"{entry['dir'].name[:12]}  {format_size(get_tree_size(entry['dir']))}  version {entry['version']}  "
+                        f"created {entry['created']}  {format_filters(entry['filters'])}")
+        logger.info(f"{len(references)} cached reference downloads")
+        
+        score_tables = list_score_tables(args.cache_dir)
+        score_size = sum(entry['size'] for entry in score_tables)
+        logger.info(f"Score cache: {get_score_cache_dir(args.cache_dir)}, {len(score_tables)} score tables, {format_size(score_size)}")
+    
+    elif args.action == 'prune':
+        if args.max_size is None:
+            entries = list_indexes(args.cache_dir)
+            for entry in entries:
+                remove_index(entry['file'])
+            logger.info(f"Removed {len(entries)} cached indexes from {index_dir}")
+            scan_dir = get_scan_cache_dir(args.cache_dir)
+            if scan_dir.exists():
+                shutil.rmtree(scan_dir)
+                logger.info(f"Removed cached FASTQ scans from {scan_dir}")
+            score_dir = get_score_cache_dir(args.cache_dir)
+            if score_dir.exists():
+                shutil.rmtree(score_dir)
+                logger.info(f"Removed cached reference scores from {score_dir}")
+        else:
+            removed = evict_cache(args.cache_dir, args.max_size)
+            logger.info(f"Removed {removed} cached indexes, FASTQ scans and score tables from {get_cache_dir(args.cache_dir)}")
+    
+    elif args.action in ['export', 'import']:
+        if not args.snapshot:
+            logger.error(f"cache {args.action} requires --snapshot")
+            sys.exit(1)
+        if args.action == 'export':
+            exported = export_snapshot(args.snapshot, args.cache_dir)
+            logger.info(f"Exported {exported} cached reference downloads to {args.snapshot}")
+        else:
+            imported = import_snapshot(args.snapshot, args.cache_dir)
+            logger.info(f"Imported {imported} reference downloads into {get_reference_cache_dir(args.cache_dir)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import os
+import zlib
+import gzip
+import shutil
+import struct
+import logging
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Fastest available zlib-compatible codec: ISA-L (python-isal), then zlib-ng,
+# then the standard library. Their threaded gzip modules decompress in a
+# background thread and compress with several threads.
+try:
+    from isal import isal_zlib as codec_zlib, igzip as codec_gzip, igzip_threaded as threaded_gzip
+    CODEC = 'isal'
+except ImportError:
+    try:
+        from zlib_ng import zlib_ng as codec_zlib, gzip_ng as codec_gzip, gzip_ng_threaded as threaded_gzip
+        CODEC = 'zlib-ng'
+    except ImportError:
+        codec_zlib = zlib
+        codec_gzip = gzip
+        threaded_gzip = None
+        CODEC = 'zlib'
+
+# Number of bytes read or written at once
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Output compression formats and the default: BGZF is gzip-compatible and can
+# be decompressed in parallel
+COMPRESSION_FORMATS = ['bgzf', 'gzip', 'plain']
+DEFAULT_COMPRESSION = 'bgzf'
+
+# Default compression level of gzip and BGZF output
+DEFAULT_LEVEL = 6
+
+# Uncompressed bytes per BGZF block (as written by htslib) and BGZF blocks per
+# thread pool task
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_BATCH_BLOCKS = 64
+
+# End-of-file marker block of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def detect_compression(path):
+    """Return 'bgzf', 'gzip' or 'plain' depending on the content of a file."""
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    if header[:2] != b'\x1f\x8b':
+        return 'plain'
+    # BGZF: gzip with an extra field holding the 'BC' block size subfield
+    if len(header) == 18 and header[3] & 4 and header[12:14] == b'BC':
+        return 'bgzf'
+    return 'gzip'
+
+def fastq_suffix(compression):
+    """Return the file name suffix of FASTQ output written with a compression format."""
+    return '.fastq' if compression == 'plain' else '.fastq.gz'
+
+def codec_level(level):
+    """Map a gzip compression level (0-9) to the level range of the codec (ISA-L supports 0-3)."""
+    if CODEC == 'isal':
+        return min(3, (level + 2) // 3)
+    return level
+
+def describe_backend(threads=1):
+    """Describe the codec and helpers used for compressed FASTQ I/O with a number of threads."""
+    helper = ''
+    if threads > 1 and threaded_gzip is None and shutil.which('pigz'):
+        helper = ', pigz for gzip'
+    return f"{CODEC} codec, {threads} thread{'s' if threads > 1 else ''}{helper}"
+
+def iter_bgzf_blocks(f):
+    """Yield (deflate payload, CRC32, uncompressed size) of every block of a BGZF stream."""
+    while True:
+        header = f.read(12)
+        if not header:
+            return
+        if len(header) < 12 or header[:2] != b'\x1f\x8b' or not header[3] & 4:
+            raise ValueError("Invalid BGZF block header")
+        extra_length = struct.unpack('<H', header[10:12])[0]
+        extra = f.read(extra_length)
+        block_size = None
+        i = 0
+        while i + 4 <= len(extra):
+            subfield_length = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == b'BC' and subfield_length == 2:
+                block_size = struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+            i += 4 + subfield_length
+        if block_size is None:
+            raise ValueError("BGZF block without block size")
+        payload = f.read(block_size - extra_length - 20)
+        crc, size = struct.unpack('<II', f.read(8))
+        yield payload, crc, size
+
+def inflate_bgzf_batch(blocks):
+    """Decompress and verify a list of BGZF blocks; runs in a worker thread (the codec releases the GIL)."""
+    data = []
+    for payload, crc, size in blocks:
+        block = codec_zlib.decompress(payload, -15) if size else b''
+        if len(block) != size or codec_zlib.crc32(block) != crc:
+            raise ValueError("BGZF block failed its size or CRC check")
+        data.append(block)
+    return b''.join(data)
+
+def deflate_bgzf_batch(data, level):
+    """Compress data into BGZF blocks; runs in a worker thread."""
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[start:start + BGZF_BLOCK_SIZE]
+        compressor = codec_zlib.compressobj(codec_level(level), zlib.DEFLATED, -15)
+        payload = compressor.compress(block) + compressor.flush()
+        if len(payload) > len(block):
+            # Incompressible data is stored, which always fits in a block
+            compressor = codec_zlib.compressobj(0, zlib.DEFLATED, -15)
+            payload = compressor.compress(block) + compressor.flush()
+        header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(payload) + 25)
+        blocks.append(header + payload + struct.pack('<II', codec_zlib.crc32(block), len(block)))
+    return b''.join(blocks)
+
+def map_ordered(executor, function, tasks, threads):
+    """Yield function(*task) for every task in order, keeping at most 2 x threads tasks in flight."""
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(function, *task))
+        if len(pending) >= 2 * threads:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def batched(items, size):
+    """Group an iterable into lists of size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def read_process_chunks(cmd, chunk_size):
+    """Yield the stdout of a command in chunks, raising CalledProcessError if it fails."""
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(chunk_size)
+            if not data:
+                break
+            yield data
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr.decode(errors='replace'))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+def read_chunks(path, threads=1, chunk_size=CHUNK_SIZE):
+    """Yield the decompressed content of a plain, gzip or BGZF file in chunks.
+    
+    BGZF files are decompressed block-parallel with threads worker threads.
+    Other gzip files are decompressed in a background thread by the threaded
+    ISA-L or zlib-ng reader, with pigz when neither is installed, or with the
+    single-threaded codec.
+    """
+    compression = detect_compression(path)
+    if compression == 'plain':
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    return
+                yield data
+    
+    if compression == 'bgzf' and threads > 1:
+        with open(path, 'rb') as f, ThreadPoolExecutor(max_workers=threads) as executor:
+            tasks = ((batch,) for batch in batched(iter_bgzf_blocks(f), BGZF_BATCH_BLOCKS))
+            yield from map_ordered(executor, inflate_bgzf_batch, tasks, threads)
+        return
+    
+    if threads > 1 and threaded_gzip is None and shutil.which('pigz'):
+        yield from read_process_chunks(['pigz', '-dc', '-p', str(threads), str(path)], chunk_size)
+        return
+    
+    if threads > 1 and threaded_gzip is not None:
+        f = threaded_gzip.open(path, 'rb', threads=1)
+    else:
+        f = codec_gzip.open(path, 'rb')
+    with f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+def write_chunks(path, chunks, compression='gzip', threads=1, level=DEFAULT_LEVEL):
+    """Write byte chunks to a plain, gzip or BGZF file.
+    
+    BGZF output is compressed block-parallel with threads worker threads and
+    can be read by htslib tools and by read_chunks in parallel. Gzip output is
+    compressed with the threaded ISA-L or zlib-ng writer, with pigz when
+    neither is installed, or with the single-threaded codec. The file is
+    written under a temporary name and moved into place when complete.
+    
+    Returns:
+        Number of uncompressed bytes written
+    """
+    temp_file = f"{path}.{os.getpid()}.tmp"
+    written = 0
+    try:
+        if compression == 'plain':
+            with open(temp_file, 'wb') as f:
+                for data in chunks:
+                    f.write(data)
+                    written += len(data)
+        
+        elif compression == 'bgzf':
+            def sized_chunks():
+                nonlocal written
+                for data in rechunk(chunks, BGZF_BLOCK_SIZE * BGZF_BATCH_BLOCKS):
+                    written += len(data)
+                    yield data, level
+            with open(temp_file, 'wb') as f, ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+                for blocks in map_ordered(executor, deflate_bgzf_batch, sized_chunks(), max(1, threads)):
+                    f.write(blocks)
+                f.write(BGZF_EOF)
+        
+        elif compression == 'gzip' and threads > 1 and threaded_gzip is None and shutil.which('pigz'):
+            cmd = ['pigz', '-c', f'-{level}', '-p', str(threads)]
+            with open(temp_file, 'wb') as f:
+                process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=f, stderr=subprocess.PIPE)
+                try:
+                    for data in chunks:
+                        process.stdin.write(data)
+                        written += len(data)
+                    process.stdin.close()
+                    stderr = process.stderr.read()
+                    if process.wait() != 0:
+                        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr.decode(errors='replace'))
+                finally:
+                    if process.poll() is None:
+                        process.kill()
+                        process.wait()
+                    process.stderr.close()
+        
+        elif compression == 'gzip':
+            if threads > 1 and threaded_gzip is not None:
+                f = threaded_gzip.open(temp_file, 'wb', compresslevel=codec_level(level), threads=threads)
+            else:
+                f = codec_gzip.open(temp_file, 'wb', compresslevel=codec_level(level))
+            with f:
+                for data in chunks:
+                    f.write(data)
+                    written += len(data)
+        
+        else:
+            raise ValueError(f"Unknown compression {compression}")
+        
+        os.replace(temp_file, path)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    
+    return written
+
+def rechunk(chunks, size):
+    """Regroup byte chunks into chunks of exactly size bytes (the last one may be shorter)."""
+    buffer = bytearray()
+    for data in chunks:
+        buffer += data
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
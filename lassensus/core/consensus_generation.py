@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import csv
 import subprocess
 import sys
 from pathlib import Path
 import argparse
 import logging
 import shutil
+import threading
 import multiprocessing
 
 # Import functions from reference_selection for rarefaction
 from .reference_selection import count_reads, rarefy_reads
+from .cache import get_index, evict_cache, DEFAULT_CACHE_MAX_SIZE
+from .compression import detect_compression, read_chunks, fastq_suffix, COMPRESSION_FORMATS, DEFAULT_COMPRESSION, DEFAULT_LEVEL
+from .pileup import pileup_bam, pileup_counts, insertion_candidates, insertion_sequences, call_consensus, save_pileup, normalize_depth, DROP_REASONS
 
 def setup_logging(output_dir):
     """Set up logging configuration."""
@@ -27,6 +33,30 @@ def setup_logging(output_dir):
 
 logger = logging.getLogger(__name__)
 
+# Memory per samtools sort thread before it spills to temporary files (samtools default)
+DEFAULT_SORT_MEMORY = '768M'
+
+# Map reads once against both segments ('combined') or once per segment ('separate')
+MAPPING_MODES = ['combined', 'separate']
+DEFAULT_MAPPING_MODE = 'combined'
+
+# Call consensus sequences with samtools mpileup | ivar consensus ('ivar') or in-process from the BAM file ('native')
+CONSENSUS_BACKENDS = ['ivar', 'native']
+DEFAULT_CONSENSUS_BACKEND = 'ivar'
+
+# Depth per position at which the per-segment alignments are capped before
+# consensus calling (0: no cap)
+DEFAULT_MAX_DEPTH = 0
+
+# Lowest fraction of the depth at which inserted sequences are saved with the pileup count matrix
+STORED_INSERTION_FRACTION = 0.25
+
+# Reference lengths for RefSeq
+REFSEQ_LENGTHS = {
+    'L': 7279,  # Reference length for L segment
+    'S': 3402   # Reference length for S segment
+}
+
 def get_cpu_count():
     """Get the number of available CPU cores."""
     try:
@@ -40,9 +70,9 @@ def get_cpu_count():
         logger.warning(f"Could not determine CPU count, using default of 4 cores: {e}")
         return 4
 
-def check_dependencies():
-    """Check if required tools are installed and install missing ones."""
-    dependencies = ['minimap2', 'samtools', 'ivar']
+def check_dependencies(consensus_backend=DEFAULT_CONSENSUS_BACKEND):
+    """Check if required tools are installed and install missing ones (ivar only for the ivar consensus backend)."""
+    dependencies = ['minimap2', 'samtools'] + (['ivar'] if consensus_backend == 'ivar' else [])
     missing = []
     
     for tool in dependencies:
@@ -63,17 +93,48 @@ def check_dependencies():
                 sys.exit(1)
         
         # Check again after installation
-        if shutil.which('ivar') is None:
+        if 'ivar' in missing and shutil.which('ivar') is None:
             logger.error("Failed to install ivar. Please install manually: conda install -y bioconda::ivar")
             sys.exit(1)
 
-def map_reads(fastq_file, reference_file, output_dir, sample_name, segment):
-    """Map reads to reference using minimap2."""
-    logger.info(f"Mapping reads to {segment}-segment reference for {sample_name}")
+def feed_reads(fastq_file, stream, threads, errors):
+    """Decompress a FASTQ file into a process's stdin; runs in a separate thread and records errors in errors."""
+    try:
+        for data in read_chunks(fastq_file, threads):
+            stream.write(data)
+    except BrokenPipeError:
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+def map_reads(fastq_file, reference_file, output_dir, sample_name, segment, cache_dir=None, sort_memory=DEFAULT_SORT_MEMORY, sort_temp_dir=None, index=True, threads=1):
+    """Map reads to reference using minimap2 and sort the alignments.
+    
+    minimap2 output is streamed straight into a multi-threaded samtools sort,
+    which writes the sorted BAM (and, if index is set, its index) without an
+    intermediate unsorted BAM. Each sort thread uses up to sort_memory before
+    spilling to temporary files in sort_temp_dir (default: next to the BAM).
+    The exit codes of every process in the pipeline are checked.
+    
+    segment is 'L', 'S' or 'LS' for the combined reference of both segments
+    (see combine_references). minimap2 decompresses gzip input with a single
+    thread, so compressed reads are decompressed by the parallel reader (see
+    compression.read_chunks) and streamed to minimap2's stdin instead.
+    """
+    logger.info(f"Mapping reads to {'+'.join(segment)}-segment reference for {sample_name}")
+    compressed = detect_compression(fastq_file) != 'plain'
     
     # Create output files
-    bam_file = output_dir / f"{sample_name}_{segment}.bam"
     sorted_bam = output_dir / f"{sample_name}_{segment}.sorted.bam"
+    bam_index = Path(f"{sorted_bam}.bai")
+    
+    # Reuse the cached minimap2 index for this reference
+    index_file = get_index(reference_file, cache_dir=cache_dir)
     
     # Run minimap2
     minimap_cmd = [
@@ -81,48 +142,163 @@ def map_reads(fastq_file, reference_file, output_dir, sample_name, segment):
         '-ax', 'map-ont',
         '-Y',  # Preserve soft-clipped bases
         '-L',  # Output CIGAR strings for long insertions/deletions
-        '-t', str(get_cpu_count()),
-        str(reference_file),
-        str(fastq_file)
+        '-t', str(threads),
+        str(index_file),
+        '-' if compressed else str(fastq_file)
     ]
     
-    # Pipe minimap2 output to samtools for BAM conversion
-    samtools_cmd = [
-        'samtools', 'view',
-        '-b',  # Output BAM
-        '-o', str(bam_file)
+    # Sort minimap2 output as it arrives, indexing the sorted BAM while writing it
+    sort_cmd = [
+        'samtools', 'sort',
+        '-@', str(threads),
+        '-m', sort_memory,
+        '-O', 'bam'
     ]
+    if sort_temp_dir:
+        Path(sort_temp_dir).mkdir(parents=True, exist_ok=True)
+        sort_cmd += ['-T', str(Path(sort_temp_dir) / f"{sample_name}_{segment}")]
+    if index:
+        sort_cmd += ['--write-index', '-o', f"{sorted_bam}##idx##{bam_index}"]
+    else:
+        sort_cmd += ['-o', str(sorted_bam)]
+    sort_cmd.append('-')
     
+    processes = []
+    feeder = None
+    errors = []
     try:
-        # Run minimap2 and pipe to samtools
-        minimap_process = subprocess.Popen(minimap_cmd, stdout=subprocess.PIPE)
-        subprocess.run(samtools_cmd, stdin=minimap_process.stdout, check=True)
+        minimap_process = subprocess.Popen(minimap_cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE if compressed else None)
+        processes.append((minimap_cmd, minimap_process))
+        sort_process = subprocess.Popen(sort_cmd, stdin=minimap_process.stdout)
+        processes.append((sort_cmd, sort_process))
+        # Only samtools reads minimap2's output, so minimap2 stops if samtools fails
+        minimap_process.stdout.close()
+        if compressed:
+            feeder = threading.Thread(target=feed_reads, args=(fastq_file, minimap_process.stdin, threads, errors), daemon=True)
+            feeder.start()
+        sort_process.wait()
         minimap_process.wait()
-        
-        # Sort BAM file
-        subprocess.run([
-            'samtools', 'sort',
-            '-o', str(sorted_bam),
-            str(bam_file)
-        ], check=True)
-        
-        # Index sorted BAM
-        subprocess.run([
-            'samtools', 'index',
-            str(sorted_bam)
-        ], check=True)
-        
-        # Remove unsorted BAM
-        os.remove(bam_file)
-        
-        return sorted_bam
-        
+    except OSError as e:
+        errors.append(e)
+    finally:
+        for cmd, process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        if feeder:
+            feeder.join()
+    
+    failed = [(cmd, process.returncode) for cmd, process in processes if process.returncode != 0]
+    if errors or failed:
+        for cmd, returncode in failed:
+            logger.error(f"Error mapping reads: {' '.join(cmd[:2])} exited with status {returncode}")
+        if errors:
+            logger.error(f"Error mapping reads from {fastq_file}: {errors[0]}")
+        for path in [sorted_bam, bam_index]:
+            if path.exists():
+                os.remove(path)
+        sys.exit(1)
+    
+    return sorted_bam
+
+def read_fasta_names(fasta_file):
+    """Return the names (first word of the header) of the records of a FASTA file."""
+    with open(fasta_file, 'r') as f:
+        return [line[1:].split()[0] for line in f if line.startswith('>') and line[1:].strip()]
+
+def combine_references(reference_files, combined_file):
+    """Write the references of several segments to one FASTA file.
+    
+    Args:
+        reference_files: Dictionary mapping segment to its single-record reference FASTA
+        combined_file: Output FASTA file
+    
+    Returns:
+        Dictionary mapping segment to the name of its contig, or None when the
+        references do not hold one uniquely named record each
+    """
+    contigs = {}
+    for segment, reference_file in reference_files.items():
+        names = read_fasta_names(reference_file)
+        if len(names) != 1 or names[0] in contigs.values():
+            return None
+        contigs[segment] = names[0]
+    
+    with open(combined_file, 'w') as f_out:
+        for reference_file in reference_files.values():
+            with open(reference_file, 'r') as f_in:
+                content = f_in.read()
+            f_out.write(content if content.endswith('\n') else content + '\n')
+    return contigs
+
+def split_bam_by_contig(bam_file, contigs, output_dir, sample_name, index=True, threads=1):
+    """Split a sorted and indexed BAM file into one sorted BAM file per segment, indexed if index is set.
+    
+    Args:
+        bam_file: Sorted, indexed BAM file of reads mapped to a combined reference
+        contigs: Dictionary mapping segment to the name of its contig
+    
+    Returns:
+        Dictionary mapping segment to its sorted BAM file
+    """
+    segment_bams = {}
+    try:
+        for segment, contig in contigs.items():
+            segment_bam = output_dir / f"{sample_name}_{segment}.sorted.bam"
+            view_cmd = ['samtools', 'view', '-b', '-@', str(threads)]
+            if index:
+                view_cmd += ['--write-index', '-o', f"{segment_bam}##idx##{segment_bam}.bai"]
+            else:
+                view_cmd += ['-o', str(segment_bam)]
+            subprocess.run(view_cmd + [str(bam_file), contig], check=True)
+            segment_bams[segment] = segment_bam
     except subprocess.CalledProcessError as e:
-        logger.error(f"Error mapping reads: {e}")
+        logger.error(f"Error splitting {bam_file} by segment: {e}")
         sys.exit(1)
+    return segment_bams
 
-def generate_consensus(bam_file, reference_file, output_dir, sample_name, segment, min_depth=50, min_quality=30, majority_threshold=0.7):
-    """Generate consensus sequence using ivar."""
+def normalize_bam(bam_file, reference_file, max_depth, index=True, threads=1):
+    """Cap the depth of a segment BAM file at max_depth alignments per position (see pileup.normalize_depth).
+    
+    The capped alignments are written to {sample}_{segment}.normalized.bam,
+    indexed if index is set; the sorted BAM file keeps all alignments.
+    
+    Returns:
+        Tuple of (normalized BAM file, statistics of the kept and dropped alignments)
+    """
+    bam_file = Path(bam_file)
+    normalized_bam = bam_file.with_name(bam_file.name.replace('.sorted.bam', '.normalized.bam'))
+    try:
+        contig = read_fasta_names(reference_file)[0]
+        stats = normalize_depth(bam_file, normalized_bam, contig, max_depth, threads)
+        if index:
+            subprocess.run(['samtools', 'index', '-@', str(threads), str(normalized_bam)], check=True)
+    except (OSError, ValueError, IndexError, subprocess.CalledProcessError) as e:
+        logger.error(f"Error normalizing the depth of {bam_file}: {e}")
+        sys.exit(1)
+    
+    dropped = ', '.join(f"{stats[reason]:,} {reason}" for reason in DROP_REASONS if stats[reason])
+    logger.info(f"Capped depth of {bam_file.name} at {max_depth}: kept {stats['kept']:,} of {stats['alignments']:,} alignments"
+                + (f" (dropped: {dropped})" if dropped else ""))
+    return normalized_bam, stats
+
+def write_normalization_report(report_file, max_depth, segment_stats):
+    """Write the alignments kept and dropped (by reason) per segment by normalize_bam as a TSV file."""
+    with open(report_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['segment', 'max_depth', 'alignments', 'kept'] + DROP_REASONS, delimiter='\t')
+        writer.writeheader()
+        for segment, stats in segment_stats.items():
+            writer.writerow({'segment': segment, 'max_depth': max_depth, **stats})
+
+def generate_consensus(bam_file, reference_file, output_dir, sample_name, segment, min_depth=50, min_quality=30, majority_threshold=0.7, threads=1, save_pileup=False):
+    """Generate consensus sequence using ivar.
+    
+    The pileup is restricted to the contig of reference_file, since BAM files
+    split from a combined mapping keep the header lines of both segments. This
+    needs a BAM index, which is built temporarily if the BAM file has none.
+    If save_pileup is set, the pileup count matrix is also counted and saved
+    next to the BAM file (see write_pileup), which takes another pass over it.
+    """
     logger.info(f"Generating consensus for {segment}-segment of {sample_name}")
     
     # Create output files
@@ -132,13 +308,20 @@ def generate_consensus(bam_file, reference_file, output_dir, sample_name, segmen
     # Create a temporary prefix for ivar output
     temp_prefix = output_dir / f"{sample_name}_{segment}"
     
+    index_file = Path(f"{bam_file}.bai")
+    temporary_index = not index_file.exists()
     try:
+        contig = read_fasta_names(reference_file)[0]
+        if temporary_index:
+            subprocess.run(['samtools', 'index', '-@', str(threads), str(bam_file)], check=True)
+        
         # First run samtools mpileup
         mpileup_cmd = [
             'samtools', 'mpileup',
             '-aa',  # Output all positions
             '-d', '0',  # No depth limit
             '-Q', '0',  # No base quality threshold
+            '-r', contig,  # Only this segment's contig
             '-f', str(reference_file),
             str(bam_file)
         ]
@@ -156,7 +339,10 @@ def generate_consensus(bam_file, reference_file, output_dir, sample_name, segmen
         # Run the pipeline
         mpileup_process = subprocess.Popen(mpileup_cmd, stdout=subprocess.PIPE)
         subprocess.run(ivar_cmd, stdin=mpileup_process.stdout, check=True)
-        mpileup_process.wait()
+        mpileup_process.stdout.close()
+        if mpileup_process.wait() != 0:
+            logger.error(f"samtools mpileup failed on {bam_file} with exit code {mpileup_process.returncode}")
+            sys.exit(1)
         
         # Check for output files in the correct location
         output_fasta = output_dir / f"{sample_name}_{segment}.fa"
@@ -177,11 +363,140 @@ def generate_consensus(bam_file, reference_file, output_dir, sample_name, segmen
         logger.info(f"Generated consensus sequence: {consensus_file}")
         logger.info(f"Generated quality file: {quality_file}")
         
-        return consensus_file, quality_file
-        
-    except subprocess.CalledProcessError as e:
+    except (OSError, IndexError, subprocess.CalledProcessError) as e:
         logger.error(f"Error generating consensus: {e}")
         sys.exit(1)
+    finally:
+        if temporary_index and index_file.exists():
+            os.remove(index_file)
+    
+    if save_pileup:
+        # Keep the pileup count matrix for re-calling with other parameters (lassensus recall)
+        write_pileup(bam_file, reference_file, majority_threshold, threads)
+    
+    return consensus_file, quality_file
+
+def get_pileup_file(bam_file):
+    """Return the file holding the pileup count matrix of a {sample}_{segment}.sorted.bam or .normalized.bam file."""
+    bam_file = Path(bam_file)
+    return bam_file.with_name(re.sub(r'\.(sorted|normalized)\.bam$', '', bam_file.name) + '.counts.npz')
+
+def count_pileup(bam_file, reference_file, insertion_fraction, threads=1):
+    """Count the pileup of a segment BAM file and collect the sequences inserted where insertions reach insertion_fraction of the depth.
+    
+    Returns:
+        Tuple of (contig, pileup, insertions), see pileup.pileup_bam and pileup.insertion_sequences
+    """
+    try:
+        contig = read_fasta_names(reference_file)[0]
+        pileup = pileup_bam(bam_file, contig, threads)
+        insertions = insertion_sequences(bam_file, contig, insertion_candidates(pileup, insertion_fraction), threads)
+    except (OSError, ValueError, IndexError) as e:
+        logger.error(f"Error counting the pileup of {bam_file}: {e}")
+        sys.exit(1)
+    return contig, pileup, insertions
+
+def write_pileup(bam_file, reference_file, majority_threshold=0.7, threads=1):
+    """Count the pileup of a segment BAM file and save it next to the BAM file.
+    
+    The inserted sequences are collected at the sites where insertions reach
+    majority_threshold, or STORED_INSERTION_FRACTION if that is lower, of the
+    depth, so the saved pileup can be re-called with lower thresholds too
+    (see recall).
+    
+    Returns:
+        Tuple of (pileup, insertions), see pileup.pileup_bam and pileup.insertion_sequences
+    """
+    insertion_fraction = min(majority_threshold, STORED_INSERTION_FRACTION)
+    contig, pileup, insertions = count_pileup(bam_file, reference_file, insertion_fraction, threads)
+    pileup_file = get_pileup_file(bam_file)
+    try:
+        save_pileup(pileup_file, pileup, contig, insertions, insertion_fraction)
+    except OSError as e:
+        logger.error(f"Error saving the pileup of {bam_file}: {e}")
+        sys.exit(1)
+    
+    logger.info(f"Saved pileup count matrix: {pileup_file}")
+    return pileup, insertions
+
+def write_consensus_files(consensus_file, quality_file, name, min_quality, majority_threshold, sequence, qualities):
+    """Write a consensus as FASTA with the header ivar gives it and its base qualities as a line of Phred+33 characters."""
+    with open(consensus_file, 'w') as f:
+        f.write(f">Consensus_{name}_threshold_{majority_threshold:g}_quality_{min_quality}\n{sequence}\n")
+    with open(quality_file, 'w') as f:
+        f.write(f"{qualities}\n")
+
+def generate_native_consensus(bam_file, reference_file, output_dir, sample_name, segment, min_depth=50, min_quality=30, majority_threshold=0.7, threads=1, save_pileup=False):
+    """Generate consensus sequence from a pileup counted in-process (see pileup.pileup_bam).
+    
+    Writes the same files as generate_consensus, and, if save_pileup is set,
+    the pileup count matrix next to the BAM file (see write_pileup).
+    """
+    logger.info(f"Generating consensus for {segment}-segment of {sample_name} (native pileup)")
+    
+    # Create output files
+    consensus_file = output_dir / f"{sample_name}_{segment}_consensus.fasta"
+    quality_file = output_dir / f"{sample_name}_{segment}_quality.txt"
+    
+    if save_pileup:
+        pileup, insertions = write_pileup(bam_file, reference_file, majority_threshold, threads)
+    else:
+        _, pileup, insertions = count_pileup(bam_file, reference_file, majority_threshold, threads)
+    sequence, qualities = call_consensus(pileup_counts(pileup, min_quality), min_depth, majority_threshold, insertions)
+    write_consensus_files(consensus_file, quality_file, f"{sample_name}_{segment}", min_quality, majority_threshold, sequence, qualities)
+    
+    logger.info(f"Generated consensus sequence: {consensus_file}")
+    logger.info(f"Generated quality file: {quality_file}")
+    
+    return consensus_file, quality_file
+
+def polish_consensus(fastq_file, draft_file, medaka_dir, threads=1):
+    """Polish a draft consensus with medaka and return the polished FASTA file in medaka_dir."""
+    medaka_cmd = [
+        'medaka_consensus',
+        '-i', str(fastq_file),
+        '-d', str(draft_file),
+        '-o', str(medaka_dir),
+        '-t', str(threads)
+    ]
+    subprocess.run(medaka_cmd, check=True)
+    return medaka_dir / "consensus.fasta"
+
+def split_fasta_by_name(fasta_file, names, output_files):
+    """Write the records of a FASTA file to one file per segment.
+    
+    A record belongs to a segment when its name is the segment's name, or
+    starts with it followed by '_' or ':' as medaka does for pieces of a contig.
+    
+    Args:
+        fasta_file: FASTA file to split
+        names: Dictionary mapping segment to record name
+        output_files: Dictionary mapping segment to output FASTA file
+    """
+    def segment_of(name):
+        for segment, prefix in names.items():
+            if name == prefix or (name.startswith(prefix) and name[len(prefix)] in '_:'):
+                return segment
+        return None
+    
+    records = {segment: [] for segment in names}
+    with open(fasta_file, 'r') as f:
+        segment = None
+        for line in f:
+            if line.startswith('>'):
+                segment = segment_of(line[1:].split()[0])
+                if segment is None:
+                    logger.error(f"Record {line[1:].strip()} of {fasta_file} matches none of {', '.join(names.values())}")
+                    sys.exit(1)
+            if segment is not None:
+                records[segment].append(line)
+    
+    for segment, lines in records.items():
+        if not lines:
+            logger.error(f"No {segment}-segment record in {fasta_file}")
+            sys.exit(1)
+        with open(output_files[segment], 'w') as f:
+            f.writelines(lines)
 
 def calculate_completeness(consensus_file, ref_file, refseq_length):
     """Calculate completeness statistics for a consensus sequence.
@@ -217,8 +532,16 @@ def calculate_completeness(consensus_file, ref_file, refseq_length):
         'completeness_vs_refseq': completeness_vs_refseq
     }
 
-def process_sample(sample_dir, sample_name, output_dir, min_depth=50, min_quality=30, majority_threshold=0.7, max_reads=1000000):
-    """Process a single sample to generate consensus sequences."""
+def process_sample(sample_dir, sample_name, output_dir, min_depth=50, min_quality=30, majority_threshold=0.7, max_reads=1000000, cache_dir=None, compression=DEFAULT_COMPRESSION, compression_level=DEFAULT_LEVEL, compression_threads=None, mapping_mode=DEFAULT_MAPPING_MODE, sort_memory=DEFAULT_SORT_MEMORY, sort_temp_dir=None, index_bam=True, consensus_backend=DEFAULT_CONSENSUS_BACKEND, max_depth=DEFAULT_MAX_DEPTH, threads=1, save_pileup=False):
+    """Process a single sample to generate consensus sequences.
+    
+    With mapping_mode 'combined' the reads are mapped and polished once against
+    both segments; with 'separate' once per segment. Unless max_depth is 0,
+    consensus sequences are called from alignments capped at max_depth per
+    position (see normalize_bam). External tools and the in-process pileup
+    use up to threads threads. If save_pileup is set, the pileup count matrix
+    of each segment is saved for lassensus recall.
+    """
     logger.info(f"\nProcessing sample: {sample_name}")
     
     # Find the actual input file (either .fastq or .fastq.gz)
@@ -242,74 +565,82 @@ def process_sample(sample_dir, sample_name, output_dir, min_depth=50, min_qualit
         return
     
     # Check if rarefaction is needed
-    total_reads = count_reads(fastq_file)
+    total_reads = count_reads(fastq_file, threads, cache_dir)
     logger.info(f"Total reads: {total_reads:,}")
     
     if total_reads > max_reads:
         logger.info(f"Rarefying reads from {total_reads:,} to {max_reads:,}")
-        rarefied_file = sample_dir / f"{sample_name}_rarefied_consensus.fastq.gz"
-        rarefy_reads(fastq_file, rarefied_file, max_reads)
+        rarefied_file = sample_dir / f"{sample_name}_rarefied_consensus{fastq_suffix(compression)}"
+        rarefy_reads(fastq_file, rarefied_file, max_reads, compression_threads or threads, compression, compression_level, cache_dir)
         fastq_file = rarefied_file
         logger.info(f"Using rarefied file: {rarefied_file}")
     else:
         logger.info(f"Using all {total_reads:,} reads (below max_reads threshold)")
     
-    # Get input files - references are already found above
-    # Process L segment
-    l_bam = map_reads(fastq_file, l_ref, sample_dir, sample_name, 'L')
-    l_consensus, l_quality = generate_consensus(l_bam, l_ref, sample_dir, sample_name, 'L', 
-                                               min_depth, min_quality, majority_threshold)
-    
-    # Process S segment
-    s_bam = map_reads(fastq_file, s_ref, sample_dir, sample_name, 'S')
-    s_consensus, s_quality = generate_consensus(s_bam, s_ref, sample_dir, sample_name, 'S',
-                                               min_depth, min_quality, majority_threshold)
+    # Map all reads once against both segments and split the alignments by
+    # contig, unless mapping separately was requested or the references
+    # cannot be combined
+    references = {'L': l_ref, 'S': s_ref}
+    contigs = None
+    if mapping_mode == 'combined':
+        combined_ref = sample_dir / f"{sample_name}_LS_reference.fasta"
+        contigs = combine_references(references, combined_ref)
+        if contigs is None:
+            logger.warning(f"References of {sample_name} do not hold one uniquely named record each, mapping segments separately")
+    
+    if contigs:
+        # The combined BAM is always indexed, since it is split by region
+        combined_bam = map_reads(fastq_file, combined_ref, sample_dir, sample_name, 'LS', cache_dir,
+                                 sort_memory, sort_temp_dir, index=True, threads=threads)
+        bams = split_bam_by_contig(combined_bam, contigs, sample_dir, sample_name, index_bam, threads)
+        for path in [combined_bam, Path(f"{combined_bam}.bai")]:
+            if path.exists():
+                os.remove(path)
+    else:
+        bams = {segment: map_reads(fastq_file, references[segment], sample_dir, sample_name, segment, cache_dir,
+                                   sort_memory, sort_temp_dir, index_bam, threads)
+                for segment in ['L', 'S']}
+    
+    if max_depth:
+        normalized = {segment: normalize_bam(bams[segment], references[segment], max_depth, index_bam, threads) for segment in ['L', 'S']}
+        report_file = sample_dir / f"{sample_name}_normalization.tsv"
+        write_normalization_report(report_file, max_depth, {segment: stats for segment, (_, stats) in normalized.items()})
+        logger.info(f"Depth normalization report: {report_file}")
+        bams = {segment: bam for segment, (bam, _) in normalized.items()}
+    
+    consensus_function = generate_native_consensus if consensus_backend == 'native' else generate_consensus
+    l_consensus, l_quality = consensus_function(bams['L'], l_ref, sample_dir, sample_name, 'L',
+                                                min_depth, min_quality, majority_threshold, threads, save_pileup)
+    s_consensus, s_quality = consensus_function(bams['S'], s_ref, sample_dir, sample_name, 'S',
+                                                min_depth, min_quality, majority_threshold, threads, save_pileup)
     
     # Create medaka output directory
     medaka_dir = sample_dir / "medaka_output"
     medaka_dir.mkdir(exist_ok=True)
     
-    # Polish L segment with medaka
-    logger.info(f"Polishing L segment consensus for {sample_name} with medaka")
-    medaka_cmd = [
-        'medaka_consensus',
-        '-i', str(fastq_file),
-        '-d', str(l_consensus),
-        '-o', str(medaka_dir),
-        '-t', str(get_cpu_count())
-    ]
-    subprocess.run(medaka_cmd, check=True)
-    
-    # Move and rename polished L consensus
-    l_polished = medaka_dir / "consensus.fasta"
     l_final = sample_dir / f"{sample_name}_L_consensus_polished.fasta"
-    shutil.move(l_polished, l_final)
-    
-    # Polish S segment with medaka
-    logger.info(f"Polishing S segment consensus for {sample_name} with medaka")
-    medaka_cmd = [
-        'medaka_consensus',
-        '-i', str(fastq_file),
-        '-d', str(s_consensus),
-        '-o', str(medaka_dir),
-        '-t', str(get_cpu_count())
-    ]
-    subprocess.run(medaka_cmd, check=True)
-    
-    # Move and rename polished S consensus
-    s_polished = medaka_dir / "consensus.fasta"
     s_final = sample_dir / f"{sample_name}_S_consensus_polished.fasta"
-    shutil.move(s_polished, s_final)
-    
-    # Reference lengths for RefSeq
-    refseq_lengths = {
-        'L': 7279,  # Reference length for L segment
-        'S': 3402   # Reference length for S segment
-    }
+    if contigs:
+        # Polish both segments in one medaka run on a two-record draft
+        logger.info(f"Polishing L and S segment consensus for {sample_name} with medaka")
+        draft = sample_dir / f"{sample_name}_LS_consensus.fasta"
+        drafts = {'L': l_consensus, 'S': s_consensus}
+        draft_names = combine_references(drafts, draft)
+        if draft_names is None:
+            logger.error(f"Consensus sequences of {sample_name} do not hold one uniquely named record each")
+            sys.exit(1)
+        polished = polish_consensus(fastq_file, draft, medaka_dir, threads)
+        split_fasta_by_name(polished, draft_names, {'L': l_final, 'S': s_final})
+        os.remove(draft)
+    else:
+        logger.info(f"Polishing L segment consensus for {sample_name} with medaka")
+        shutil.move(polish_consensus(fastq_file, l_consensus, medaka_dir, threads), l_final)
+        logger.info(f"Polishing S segment consensus for {sample_name} with medaka")
+        shutil.move(polish_consensus(fastq_file, s_consensus, medaka_dir, threads), s_final)
     
     # Calculate completeness statistics using polished consensus
-    l_stats = calculate_completeness(l_final, l_ref, refseq_lengths['L'])
-    s_stats = calculate_completeness(s_final, s_ref, refseq_lengths['S'])
+    l_stats = calculate_completeness(l_final, l_ref, REFSEQ_LENGTHS['L'])
+    s_stats = calculate_completeness(s_final, s_ref, REFSEQ_LENGTHS['S'])
     
     # Log completeness statistics
     logger.info(f"\nCompleteness statistics for {sample_name}:")
@@ -332,12 +663,12 @@ def process_sample(sample_dir, sample_name, output_dir, min_depth=50, min_qualit
     logger.info(f"\nGenerated and polished consensus sequences for {sample_name}")
     logger.info(f"L-segment polished consensus: {l_final}")
     logger.info(f"S-segment polished consensus: {s_final}")
-
+    
     # Remove the medaka_output directory after moving the polished consensus
     if os.path.exists(medaka_dir):
         shutil.rmtree(medaka_dir)
         logger.info(f"Removed temporary medaka output directory: {medaka_dir}")
-
+    
     # Create AllConsensus directory structure
     all_consensus_dir = os.path.join(output_dir, "AllConsensus")
     l_segment_dir = os.path.join(all_consensus_dir, "L_segment")
@@ -376,6 +707,19 @@ def main(args=None):
         parser.add_argument('--min_quality', type=int, default=30, help='Minimum quality for consensus calling (default: 30)')
         parser.add_argument('--majority_threshold', type=float, default=0.7, help='Majority rule threshold (default: 0.7)')
         parser.add_argument("--max_reads", type=int, default=1000000, help="Maximum number of reads to use for consensus generation (default: 1,000,000)")
+        parser.add_argument('--threads', type=int, default=None, help='Number of threads for mapping, sorting, pileup and polishing (default: all CPU cores but one)')
+        parser.add_argument('--cache_dir', default=None, help='Directory for cached minimap2 indexes (default: $LASSENSUS_CACHE_DIR or ~/.cache/lassensus)')
+        parser.add_argument('--cache_max_size', type=float, default=DEFAULT_CACHE_MAX_SIZE, help=f'Maximum size of the minimap2 index, FASTQ scan and score cache in GB (default: {DEFAULT_CACHE_MAX_SIZE})')
+        parser.add_argument('--output_compression', choices=COMPRESSION_FORMATS, default=DEFAULT_COMPRESSION, help='Compression of rarefied FASTQ files (bgzf=block gzip, readable in parallel; gzip; plain=uncompressed .fastq) (default: bgzf)')
+        parser.add_argument('--compression_level', type=int, default=DEFAULT_LEVEL, help='Compression level of rarefied FASTQ files, 1-9 (default: 6)')
+        parser.add_argument('--compression_threads', type=int, default=None, help='Threads for compressing rarefied FASTQ files (default: --threads, or all CPU cores but one)')
+        parser.add_argument('--sort_memory', default=DEFAULT_SORT_MEMORY, help='Memory per samtools sort thread, with K/M/G suffix (default: 768M)')
+        parser.add_argument('--sort_temp_dir', default=None, help='Directory for samtools sort temporary files (default: next to the BAM file)')
+        parser.add_argument('--no_bam_index', action='store_true', help='Do not index the per-segment sorted BAM files')
+        parser.add_argument('--consensus_backend', choices=CONSENSUS_BACKENDS, default=DEFAULT_CONSENSUS_BACKEND, help='Call consensus sequences with samtools mpileup | ivar consensus (ivar) or from an in-process pileup of the BAM file (native) (default: ivar)')
+        parser.add_argument('--max_depth', type=int, default=DEFAULT_MAX_DEPTH, help=f'Cap the depth per position at this many alignments before consensus calling, keeping regions below it intact; 0 disables the cap (default: {DEFAULT_MAX_DEPTH})')
+        parser.add_argument('--save_pileup', action='store_true', help='Save the pileup count matrix of every segment for lassensus recall')
+        parser.add_argument('--mapping_mode', choices=MAPPING_MODES, default=DEFAULT_MAPPING_MODE, help='Map and polish reads once against both segments (combined) or once per segment (separate) (default: combined)')
         args = parser.parse_args()
     
     # Convert input and output directories to Path objects
@@ -386,8 +730,24 @@ def main(args=None):
     # Set up logging
     setup_logging(output_dir)
     
+    if not 1 <= args.compression_level <= 9:
+        logger.error("--compression_level must be between 1 and 9")
+        sys.exit(1)
+    
+    if not re.fullmatch(r'[1-9][0-9]*[KMG]?', args.sort_memory):
+        logger.error("--sort_memory must be a number of bytes with an optional K, M or G suffix, e.g. 768M")
+        sys.exit(1)
+    
+    if args.max_depth < 0:
+        logger.error("--max_depth must not be negative")
+        sys.exit(1)
+    if 0 < args.max_depth < args.min_depth:
+        logger.error("--max_depth must be 0 or at least --min_depth")
+        sys.exit(1)
+    
     # Check dependencies
-    check_dependencies()
+    check_dependencies(args.consensus_backend)
+    threads = args.threads if args.threads else get_cpu_count()
     
     # Find samples to process
     samples = [d.name for d in consensus_dir.iterdir() if d.is_dir()]
@@ -402,7 +762,13 @@ def main(args=None):
     # Process each sample
     for sample in samples:
         sample_dir = consensus_dir / sample
-        process_sample(sample_dir, sample, output_dir, args.min_depth, args.min_quality, args.majority_threshold, args.max_reads)
+        process_sample(sample_dir, sample, output_dir, args.min_depth, args.min_quality, args.majority_threshold, args.max_reads,
+                       args.cache_dir, args.output_compression, args.compression_level, args.compression_threads,
+                       args.mapping_mode, args.sort_memory, args.sort_temp_dir, not args.no_bam_index,
+                       args.consensus_backend, args.max_depth, threads, args.save_pileup)
+    
+    # Trim the index, FASTQ scan and score cache once, after all mappings are done
+    evict_cache(args.cache_dir, args.cache_max_size)
     
     logger.info("\nConsensus generation complete!")
 
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import queue
+import threading
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from .cache import get_scan_cache_dir
+from .compression import read_chunks, write_chunks, DEFAULT_COMPRESSION, DEFAULT_LEVEL
+
+logger = logging.getLogger(__name__)
+
+# Version of the sidecar format; older sidecars are ignored
+SCAN_VERSION = 4
+
+# Seed of the random samples. Reads are picked by index (see select_read_indices),
+# so the samples differ from those of seqtk sample -s 42 in earlier versions
+DEFAULT_SEED = 42
+
+# Highest Phred score kept in the quality histogram (Sanger encoding, offset 33)
+MAX_QUALITY = 93
+
+def get_scan_file(fastq_file, cache_dir=None):
+    """Return the sidecar file holding the scan of a FASTQ file.
+    
+    Sidecars are kept in the cache directory (see cache.get_scan_cache_dir),
+    keyed by the resolved FASTQ path, so the input directory is never written to.
+    """
+    fastq_file = Path(fastq_file)
+    path_hash = hashlib.sha1(str(fastq_file.resolve()).encode()).hexdigest()[:16]
+    return get_scan_cache_dir(cache_dir) / f"{path_hash}_{fastq_file.name}.scan.json"
+
+def file_key(fastq_file):
+    """Identify the current version of a file by path, size and modification time."""
+    stat = os.stat(fastq_file)
+    return {'path': str(Path(fastq_file).resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def byte_histogram(values):
+    """Count the occurrences of every byte value in a uint8 array.
+    
+    Counting pairs of bytes as uint16 values halves the elements np.bincount
+    has to widen to integers, which is most of its cost.
+    """
+    n_pairs = len(values) // 2
+    pair_counts = np.bincount(values[:2 * n_pairs].view(np.uint16), minlength=65536).reshape(256, 256)
+    counts = pair_counts.sum(axis=0) + pair_counts.sum(axis=1)
+    if len(values) % 2:
+        counts[values[-1]] += 1
+    return counts
+
+def iter_record_blocks(chunks):
+    """Regroup chunks of FASTQ data into blocks of complete records, yielded as (data, line_ends) pairs.
+    
+    line_ends holds the position of every newline in data; a block always
+    ends with the last line of a record.
+    """
+    carry = b''
+    for data in chunks:
+        data = carry + data
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+        n_lines = len(newlines) // 4 * 4
+        if n_lines == 0:
+            carry = data
+            continue
+        end = newlines[n_lines - 1] + 1
+        yield data[:end], newlines[:n_lines]
+        carry = data[end:]
+    
+    # Last record without a final newline
+    if carry.strip():
+        data = carry if carry.endswith(b'\n') else carry + b'\n'
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+        if len(newlines) % 4:
+            logger.warning("Ignoring truncated FASTQ record at the end of the input")
+        n_lines = len(newlines) // 4 * 4
+        if n_lines:
+            yield data[:newlines[n_lines - 1] + 1], newlines[:n_lines]
+
+def scan_fastq(fastq_file, cache_dir=None, threads=1):
+    """Profile a FASTQ file in a single pass.
+    
+    The file is decompressed once, with threads decompression threads (see
+    compression.read_chunks). Per block of records, read and base counts,
+    the read length histogram and the base quality histogram are computed with
+    NumPy. The results are saved in a sidecar file (see get_scan_file), keyed
+    by path, size and modification time of the FASTQ file; if the sidecar
+    cannot be written, the scan is only returned.
+    
+    Returns:
+        Scan dictionary (see load_fastq_scan)
+    """
+    fastq_file = Path(fastq_file)
+    key = file_key(fastq_file)
+    n_reads = 0
+    n_bases = 0
+    length_counts = {}
+    quality_counts = np.zeros(256, dtype=np.int64)
+    
+    for data, line_ends in iter_record_blocks(read_chunks(fastq_file, threads)):
+        line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+        n_block = len(line_ends) // 4
+        
+        # Read lengths and base counts from the sequence lines
+        lengths = line_ends[1::4] - line_starts[1::4]
+        n_bases += int(lengths.sum())
+        for length, count in zip(*np.unique(lengths, return_counts=True)):
+            length_counts[int(length)] = length_counts.get(int(length), 0) + int(count)
+        
+        # Quality histogram over the bytes of the quality lines, selected by
+        # a mask built from alternating runs of other and quality bytes
+        quality_starts = line_starts[3::4]
+        quality_ends = line_ends[3::4]
+        runs = np.empty(2 * n_block, dtype=np.int64)
+        runs[0::2] = quality_starts - np.concatenate(([0], quality_ends[:-1]))
+        runs[1::2] = quality_ends - quality_starts
+        mask = np.repeat(np.tile([False, True], n_block), runs)
+        quality_counts += byte_histogram(np.frombuffer(data, dtype=np.uint8, count=len(mask))[mask])
+        
+        n_reads += n_block
+    
+    # Phred scores from the Sanger-encoded quality bytes
+    phred_counts = quality_counts[33:33 + MAX_QUALITY + 1].copy()
+    phred_counts[-1] += quality_counts[33 + MAX_QUALITY + 1:].sum()
+    
+    scan = {
+        'version': SCAN_VERSION,
+        **key,
+        'reads': n_reads,
+        'bases': n_bases,
+        'length_histogram': {str(length): length_counts[length] for length in sorted(length_counts)},
+        'quality_histogram': phred_counts.tolist()
+    }
+    scan_file = get_scan_file(fastq_file, cache_dir)
+    try:
+        scan_file.parent.mkdir(parents=True, exist_ok=True)
+        save_fastq_scan(scan_file, scan)
+    except OSError as e:
+        logger.warning(f"Could not save the FASTQ scan {scan_file}, {fastq_file.name} will be scanned again next time: {e}")
+    
+    logger.info(f"Scanned {fastq_file.name}: {n_reads:,} reads, {n_bases:,} bases")
+    return scan
+
+def select_read_indices(n_reads, size, seed=DEFAULT_SEED):
+    """Pick a uniform random subset of size read indices out of n_reads, sorted.
+    
+    Memory stays proportional to size: small samples are drawn as uniform
+    indices (with some extra to cover duplicates) of which size distinct ones
+    are kept, and only samples of more than a quarter of the reads draw from
+    the full index range. The subset only depends on n_reads, size and seed.
+    """
+    rng = np.random.default_rng(seed)
+    if size >= n_reads:
+        return np.arange(n_reads)
+    if 4 * size > n_reads:
+        return np.sort(rng.choice(n_reads, size, replace=False))
+    
+    # The distinct values of uniform draws are a uniform random subset given
+    # their number, and so is a uniform choice of size of them
+    candidates = np.empty(0, dtype=np.int64)
+    while len(candidates) < size:
+        candidates = np.union1d(candidates, rng.integers(0, n_reads, size + size // 10 + 100))
+    return np.sort(rng.choice(candidates, size, replace=False))
+
+def write_subsamples(fastq_file, n_reads, sample_files, seed=DEFAULT_SEED, threads=1, compression=DEFAULT_COMPRESSION, level=DEFAULT_LEVEL):
+    """Write random subsamples of a FASTQ file with a known number of reads in one streaming pass.
+    
+    The read indices of every subsample are chosen up front (see
+    select_read_indices), so memory holds integers rather than reads. The
+    file is then streamed once and the selected records are written in file
+    order, each subsample by its own writer thread with the given compression
+    and level (see compression.write_chunks).
+    
+    Args:
+        fastq_file: FASTQ file to sample from
+        n_reads: Number of reads in the file (from its scan)
+        sample_files: Dictionary mapping subsample size to output file
+    """
+    selected = {size: select_read_indices(n_reads, size, seed) for size in sample_files}
+    queues = {size: queue.Queue(maxsize=4) for size in sample_files}
+    errors = []
+    
+    def write_sample(size):
+        """Compress the chunks of one subsample; after an error, keep draining its queue."""
+        chunks = iter(queues[size].get, None)
+        try:
+            write_chunks(sample_files[size], chunks, compression, threads, level)
+        except Exception as e:
+            errors.append(e)
+            for _ in chunks:
+                pass
+    
+    writers = [threading.Thread(target=write_sample, args=(size,), daemon=True) for size in sample_files]
+    for writer in writers:
+        writer.start()
+    
+    try:
+        first_read = 0
+        for data, line_ends in iter_record_blocks(read_chunks(fastq_file, threads)):
+            n_block = len(line_ends) // 4
+            record_starts = np.concatenate(([0], line_ends[3::4][:-1] + 1))
+            record_ends = line_ends[3::4] + 1
+            for size, indices in selected.items():
+                chosen = indices[np.searchsorted(indices, first_read):np.searchsorted(indices, first_read + n_block)] - first_read
+                if len(chosen):
+                    queues[size].put(b''.join(data[start:end] for start, end in zip(record_starts[chosen], record_ends[chosen])))
+            first_read += n_block
+    finally:
+        for size in sample_files:
+            queues[size].put(None)
+        for writer in writers:
+            writer.join()
+    
+    if errors:
+        raise errors[0]
+    if first_read != n_reads:
+        raise ValueError(f"{fastq_file} holds {first_read:,} reads, but its scan counted {n_reads:,}")
+
+def save_fastq_scan(scan_file, scan):
+    """Write a scan sidecar atomically."""
+    temp_file = Path(f"{scan_file}.{os.getpid()}.tmp")
+    with open(temp_file, 'w') as f:
+        json.dump(scan, f)
+    os.replace(temp_file, scan_file)
+
+def load_fastq_scan(fastq_file, cache_dir=None, threads=1):
+    """Return the scan of a FASTQ file, scanning the file only if needed.
+    
+    A sidecar is reused when the path, size and modification time of the FASTQ
+    file are unchanged, and marked as recently used for cache eviction (see
+    cache.evict_cache). Otherwise the file is scanned again.
+    
+    Returns:
+        Dictionary with reads, bases, length_histogram (read length -> reads)
+        and quality_histogram (base counts per Phred score 0-93)
+    """
+    scan_file = get_scan_file(fastq_file, cache_dir)
+    scan = None
+    if scan_file.exists():
+        try:
+            with open(scan_file, 'r') as f:
+                scan = json.load(f)
+            if scan.get('version') != SCAN_VERSION or any(scan[field] != value for field, value in file_key(fastq_file).items()):
+                scan = None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable FASTQ scan {scan_file}: {e}")
+            scan = None
+    if scan is None:
+        return scan_fastq(fastq_file, cache_dir, threads)
+    
+    try:
+        os.utime(scan_file)
+    except OSError:
+        pass
+    return scan
+
+def copy_fastq_scan(source_file, target_file, cache_dir=None):
+    """Reuse the scan of a FASTQ file for a copy of it, so the copy is not scanned again.
+    
+    The sidecar is rewritten for the path of the copy.
+    """
+    scan_file = get_scan_file(source_file, cache_dir)
+    if not scan_file.exists():
+        return
+    try:
+        with open(scan_file, 'r') as f:
+            scan = json.load(f)
+        if scan.get('version') != SCAN_VERSION or scan['size'] != os.path.getsize(target_file):
+            return
+        scan.update(file_key(target_file))
+        target_scan_file = get_scan_file(target_file, cache_dir)
+        target_scan_file.parent.mkdir(parents=True, exist_ok=True)
+        save_fastq_scan(target_scan_file, scan)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Could not reuse the FASTQ scan {scan_file} for {target_file}: {e}")
+
+def write_fastq_sample(fastq_file, size, output_file, seed=DEFAULT_SEED, cache_dir=None, threads=1, compression=DEFAULT_COMPRESSION, level=DEFAULT_LEVEL):
+    """Write a random sample of size reads of a FASTQ file, scanning the file if needed.
+    
+    The read count comes from the file's scan, and the sample is streamed
+    straight to output_file with the given compression, level and threads
+    (see write_subsamples). Samples are not kept in the cache: the reads
+    only depend on the read count, size and seed (see select_read_indices).
+    
+    Returns:
+        Number of reads written
+    """
+    scan = load_fastq_scan(fastq_file, cache_dir, threads)
+    if size >= scan['reads']:
+        write_chunks(output_file, read_chunks(fastq_file, threads), compression, threads, level)
+        return scan['reads']
+    
+    write_subsamples(fastq_file, scan['reads'], {size: output_file}, seed, threads, compression, level)
+    return size
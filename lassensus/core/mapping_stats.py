@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+import re
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Number of alignment records parsed per NumPy batch
+BLOCK_SIZE = 10000
+
+# CIGAR operations and the column of each operation in the per-record length matrix
+CIGAR_OPS = 'MIDNSHP=X'
+OP_M, OP_I, OP_D, OP_N, OP_S, OP_H, OP_P, OP_EQ, OP_X = range(len(CIGAR_OPS))
+
+# Lookup table from ASCII to CIGAR operation column (-1 = digit or invalid)
+_OP_CODE = np.full(256, -1, dtype=np.int64)
+for _i, _op in enumerate(CIGAR_OPS):
+    _OP_CODE[ord(_op)] = _i
+
+# Separator between the sample prefix and the read name in multiplexed alignments
+MULTIPLEX_SEPARATOR = '|'
+
+NM_RE = re.compile(r'\tNM:i:(\d+)')
+AS_RE = re.compile(r'\tAS:i:(-?\d+)')
+CG_RE = re.compile(r'\tcg:Z:([0-9MIDNSHP=X]+)')
+
+def cigar_op_lengths(cigars):
+    """Sum the lengths of every CIGAR operation for a block of CIGAR strings.
+    
+    All CIGARs of the block are parsed at once: the strings are concatenated,
+    the operation characters located with a lookup table, and the digits in
+    front of each operation are combined into its length with NumPy.
+    
+    Returns:
+        Array of shape (len(cigars), len(CIGAR_OPS)) with summed operation lengths
+    """
+    n_records = len(cigars)
+    result = np.zeros((n_records, len(CIGAR_OPS)), dtype=np.int64)
+    data = np.frombuffer(''.join(cigars).encode(), dtype=np.uint8)
+    if len(data) == 0:
+        return result
+    
+    codes = _OP_CODE[data]
+    op_pos = np.flatnonzero(codes >= 0)
+    digit_pos = np.flatnonzero(codes < 0)
+    
+    # Every digit belongs to the next operation; its place value is given by
+    # its distance to that operation
+    owner = np.searchsorted(op_pos, digit_pos)
+    place = op_pos[owner] - digit_pos - 1
+    values = (data[digit_pos].astype(np.int64) - 48) * (10 ** place)
+    lengths = np.bincount(owner, weights=values, minlength=len(op_pos))
+    
+    # Assign every operation to its record and sum per (record, operation)
+    ends = np.cumsum([len(cigar) for cigar in cigars])
+    records = np.searchsorted(ends, op_pos, side='right')
+    flat = np.bincount(records * len(CIGAR_OPS) + codes[op_pos], weights=lengths,
+                       minlength=n_records * len(CIGAR_OPS))
+    result[:] = flat.reshape(n_records, len(CIGAR_OPS)).round().astype(np.int64)
+    
+    return result
+
+def parse_paf_line(line):
+    """Parse a PAF line into (read, reference, ref_length, ref_start, ref_end, cigar, nm, score).
+    
+    Alignments without a cg:Z tag (minimap2 run without -c) are approximated by a
+    single match block of the alignment length with (length - matches) edits.
+    The score is the AS:i alignment score, or the number of matching bases
+    when minimap2 did not compute one.
+    """
+    fields = line.split('\t', 12)
+    if len(fields) < 12:
+        return None
+    
+    cigar_match = CG_RE.search(line)
+    if cigar_match:
+        cigar = cigar_match.group(1)
+        nm_match = NM_RE.search(line)
+        nm = int(nm_match.group(1)) if nm_match else 0
+    else:
+        block_length = int(fields[10])
+        cigar = f"{block_length}M"
+        nm = block_length - int(fields[9])
+    
+    score_match = AS_RE.search(line)
+    score = int(score_match.group(1)) if score_match else int(fields[9])
+    
+    return fields[0], fields[5], int(fields[6]), int(fields[7]), int(fields[8]), cigar, nm, score
+
+def parse_sam_line(line, ref_lengths):
+    """Parse a SAM line into (read, reference, ref_length, ref_start, None, cigar, nm, score).
+    
+    Header lines are used to fill ref_lengths and return None, as do unmapped reads.
+    The reference end is derived from the CIGAR later.
+    """
+    if line.startswith('@'):
+        if line.startswith('@SQ'):
+            tags = dict(field.split(':', 1) for field in line.rstrip('\n').split('\t')[1:] if ':' in field)
+            if 'SN' in tags and 'LN' in tags:
+                ref_lengths[tags['SN']] = int(tags['LN'])
+        return None
+    
+    fields = line.split('\t', 11)
+    if len(fields) < 11:
+        return None
+    
+    if int(fields[1]) & 0x4 or fields[5] == '*':  # unmapped
+        return None
+    
+    nm_match = NM_RE.search(line)
+    nm = int(nm_match.group(1)) if nm_match else 0
+    score_match = AS_RE.search(line)
+    score = int(score_match.group(1)) if score_match else 0
+    
+    return fields[0], fields[2], ref_lengths.get(fields[2], 0), int(fields[3]) - 1, None, fields[5], nm, score
+
+def merge_intervals(starts, ends):
+    """Merge half-open intervals [start, end) into sorted, disjoint intervals.
+    
+    Returns:
+        Tuple of (starts, ends) arrays of the merged intervals
+    """
+    nonempty = ends > starts
+    starts, ends = starts[nonempty], ends[nonempty]
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    # An interval starts a new merged interval when it begins after all earlier ones end
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > reach[:-1]
+    last = np.append(np.flatnonzero(first)[1:] - 1, len(starts) - 1)
+    return starts[first], reach[last]
+
+def empty_totals(ref_length=0):
+    """Return zeroed accumulated totals for one reference.
+    
+    The breadth of coverage is tracked as the merged intervals covered by
+    alignments, which stay few however many alignments are added, rather
+    than as a per-position array.
+    """
+    return {
+        'mapped_reads': 0,
+        'aligned_length': 0,
+        'matches': 0,
+        'mismatches': 0,
+        'insertions': 0,
+        'deletions': 0,
+        'ref_length': ref_length,
+        'covered_starts': np.zeros(0, dtype=np.int64),
+        'covered_ends': np.zeros(0, dtype=np.int64)
+    }
+
+def add_block(totals, records, new_read, read_scores=None):
+    """Add a block of parsed alignment records to the per-reference totals.
+    
+    If read_scores is a list, the (reads, references, scores, identities)
+    arrays of the block are appended to it.
+    """
+    reads, references, ref_lengths, starts, ends, cigars, nms, scores = zip(*records)
+    ops = cigar_op_lengths(cigars)
+    nms = np.array(nms, dtype=np.int64)
+    starts = np.array(starts, dtype=np.int64)
+    
+    aligned = ops[:, OP_M] + ops[:, OP_EQ] + ops[:, OP_X]
+    insertions = ops[:, OP_I]
+    deletions = ops[:, OP_D]
+    # NM counts mismatches plus inserted and deleted bases
+    mismatches = np.clip(nms - insertions - deletions, 0, aligned)
+    matches = aligned - mismatches
+    alignment_columns = aligned + insertions + deletions
+    
+    if read_scores is not None:
+        identities = np.divide(matches, alignment_columns, out=np.zeros(len(records)), where=alignment_columns > 0) * 100
+        read_scores.append((np.array(reads), np.array(references), np.array(scores, dtype=np.int64), identities))
+    
+    if ends[0] is None:
+        ends = starts + aligned + deletions + ops[:, OP_N]
+    else:
+        ends = np.array(ends, dtype=np.int64)
+    
+    names, ref_ids = np.unique(np.array(references), return_inverse=True)
+    n_refs = len(names)
+    sums = {
+        'mapped_reads': np.bincount(ref_ids, weights=new_read, minlength=n_refs),
+        'aligned_length': np.bincount(ref_ids, weights=alignment_columns, minlength=n_refs),
+        'matches': np.bincount(ref_ids, weights=matches, minlength=n_refs),
+        'mismatches': np.bincount(ref_ids, weights=mismatches, minlength=n_refs),
+        'insertions': np.bincount(ref_ids, weights=insertions, minlength=n_refs),
+        'deletions': np.bincount(ref_ids, weights=deletions, minlength=n_refs)
+    }
+    lengths = np.array(ref_lengths, dtype=np.int64)
+    
+    # Group records by reference for the breadth of coverage
+    order = np.argsort(ref_ids, kind='stable')
+    boundaries = np.searchsorted(ref_ids[order], np.arange(n_refs + 1))
+    
+    for j, name in enumerate(names):
+        name = str(name)
+        members = order[boundaries[j]:boundaries[j + 1]]
+        ref_length = max(int(lengths[members].max()), int(ends[members].max()))
+        ref_totals = totals.get(name)
+        if ref_totals is None:
+            ref_totals = totals[name] = empty_totals(ref_length)
+        elif ref_length > ref_totals['ref_length']:
+            # Reference length unknown (SAM without header): grow as alignments extend it
+            ref_totals['ref_length'] = ref_length
+        
+        for key, values in sums.items():
+            ref_totals[key] += int(round(values[j]))
+        
+        ref_totals['covered_starts'], ref_totals['covered_ends'] = merge_intervals(
+            np.concatenate([ref_totals['covered_starts'], starts[members]]),
+            np.concatenate([ref_totals['covered_ends'], ends[members]]))
+
+def accumulate_mapping_totals(alignment_lines, alignment_format='paf', block_size=BLOCK_SIZE, demultiplex=False, read_scores=None):
+    """Accumulate per-reference alignment totals from a stream of PAF or SAM lines.
+    
+    Records are parsed line by line but their CIGAR and NM statistics are
+    computed in NumPy batches of block_size records. A read is counted once per
+    reference, however many (secondary or supplementary) alignments it has to it;
+    this relies on minimap2 reporting all alignments of a read consecutively.
+    
+    With demultiplex=True, read names are expected to carry a sample prefix
+    ("<sample>|<read>", see MULTIPLEX_SEPARATOR) and totals are kept per sample.
+    
+    If read_scores is a list, the per-alignment scores and identities are
+    collected in it (see best_read_scores).
+    
+    Returns:
+        Dictionary mapping reference name to accumulated totals, or with
+        demultiplex=True, sample prefix to such a dictionary
+    """
+    totals = defaultdict(dict)
+    ref_lengths = {}
+    records = defaultdict(list)
+    new_read = defaultdict(list)
+    current_read = None
+    current_refs = set()
+    
+    for line in alignment_lines:
+        if alignment_format == 'sam':
+            record = parse_sam_line(line, ref_lengths)
+        else:
+            record = parse_paf_line(line)
+        if record is None:
+            continue
+        
+        read, reference = record[0], record[1]
+        if read != current_read:
+            current_read = read
+            current_refs = set()
+        key = read.split(MULTIPLEX_SEPARATOR, 1)[0] if demultiplex else None
+        new_read[key].append(0 if reference in current_refs else 1)
+        current_refs.add(reference)
+        records[key].append(record)
+        
+        if len(records[key]) >= block_size:
+            add_block(totals[key], records[key], new_read[key], read_scores)
+            records[key] = []
+            new_read[key] = []
+    
+    for key in records:
+        if records[key]:
+            add_block(totals[key], records[key], new_read[key], read_scores)
+    
+    if demultiplex:
+        return dict(totals)
+    return totals[None]
+
+def covered_bases(totals):
+    """Count the reference positions covered by at least one alignment."""
+    starts = np.clip(totals['covered_starts'], 0, totals['ref_length'])
+    ends = np.clip(totals['covered_ends'], 0, totals['ref_length'])
+    return int((ends - starts).sum())
+
+def format_mapping_stats(totals, covered=None):
+    """Build the mapping statistics dictionary from accumulated totals."""
+    aligned_length = totals['aligned_length']
+    ref_length = totals['ref_length']
+    if covered is None:
+        covered = covered_bases(totals)
+    
+    return {
+        'mapped_reads': totals['mapped_reads'],
+        'coverage': aligned_length / 1000,  # Approximate coverage
+        'avg_identity': (totals['matches'] / aligned_length * 100) if aligned_length > 0 else 0,
+        'aligned_length': aligned_length,
+        'matches': totals['matches'],
+        'mismatches': totals['mismatches'],
+        'insertions': totals['insertions'],
+        'deletions': totals['deletions'],
+        'breadth': (covered / ref_length * 100) if ref_length > 0 else 0
+    }
+
+def calculate_mapping_stats_by_reference(alignment_lines, alignment_format='paf', read_scores=None):
+    """Calculate mapping statistics for each reference from a stream of PAF or SAM lines."""
+    totals = accumulate_mapping_totals(alignment_lines, alignment_format, read_scores=read_scores)
+    return {reference: format_mapping_stats(ref_totals) for reference, ref_totals in totals.items()}
+
+def calculate_mapping_stats_by_sample(alignment_lines, alignment_format='paf'):
+    """Calculate per-reference mapping statistics for each sample of a multiplexed alignment stream."""
+    totals = accumulate_mapping_totals(alignment_lines, alignment_format, demultiplex=True)
+    return {
+        sample: {reference: format_mapping_stats(ref_totals) for reference, ref_totals in sample_totals.items()}
+        for sample, sample_totals in totals.items()
+    }
+
+def calculate_mapping_stats(alignment_lines, alignment_format='paf', read_scores=None):
+    """Calculate combined mapping statistics over all references in a stream of PAF or SAM lines."""
+    totals = accumulate_mapping_totals(alignment_lines, alignment_format, read_scores=read_scores)
+    if not totals:
+        return format_mapping_stats(empty_totals())
+    
+    combined = empty_totals()
+    for ref_totals in totals.values():
+        for key in ['mapped_reads', 'aligned_length', 'matches', 'mismatches', 'insertions', 'deletions', 'ref_length']:
+            combined[key] += ref_totals[key]
+    
+    # Breadth over all references together
+    covered = sum(covered_bases(ref_totals) for ref_totals in totals.values())
+    
+    return format_mapping_stats(combined, covered)
+
+def best_read_scores(read_scores):
+    """Reduce collected alignment scores to the best alignment of every read to every reference.
+    
+    Returns:
+        Tuple of (reads, references, scores, identities) arrays with one entry
+        per aligned (read, reference) pair; the best alignment has the highest
+        score, ties broken by identity
+    """
+    if not read_scores:
+        return np.empty(0, dtype=str), np.empty(0, dtype=str), np.empty(0, dtype=np.int64), np.empty(0)
+    
+    reads, references, scores, identities = (np.concatenate(arrays) for arrays in zip(*read_scores))
+    
+    # Sort pairs with their best alignment first and keep the first of each pair
+    order = np.lexsort((-identities, -scores, references, reads))
+    reads, references, scores, identities = reads[order], references[order], scores[order], identities[order]
+    first = np.ones(len(reads), dtype=bool)
+    first[1:] = (reads[1:] != reads[:-1]) | (references[1:] != references[:-1])
+    
+    return reads[first], references[first], scores[first], identities[first]
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+
+import struct
+import logging
+
+import numpy as np
+
+from .compression import read_chunks, write_chunks
+
+logger = logging.getLogger(__name__)
+
+# Columns of the pileup count matrix: bases, deletions and insertions after the position
+PILEUP_COLUMNS = ['A', 'C', 'G', 'T', 'del', 'ins']
+
+# Highest base quality counted separately; higher qualities are counted as this one
+MAX_QUALITY = 93
+
+# Version of the saved pileup format; other versions are not loaded
+PILEUP_VERSION = 1
+
+# Alignments skipped like samtools mpileup does by default: unmapped,
+# secondary, QC-failed and duplicate
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# Reasons for dropping an alignment when normalizing depth, in the order
+# they are checked; all but 'depth' are alignments the pileup skips anyway
+DROP_REASONS = ['unmapped', 'secondary', 'qc_fail', 'duplicate', 'other_contig', 'no_sequence', 'depth']
+DROP_FLAGS = {'unmapped': 0x4, 'secondary': 0x100, 'qc_fail': 0x200, 'duplicate': 0x400}
+
+# Alignments whose depth cap is checked together when normalizing depth
+NORMALIZE_CHUNK = 4096
+
+# CIGAR operations by BAM code (M I D N S H P = X) that consume query bases,
+# consume reference bases, or align a query base to a reference base
+CIGAR_QUERY = np.array([1, 1, 0, 0, 1, 0, 0, 1, 1], dtype=bool)
+CIGAR_REFERENCE = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1], dtype=bool)
+CIGAR_MATCH = np.array([1, 0, 0, 0, 0, 0, 0, 1, 1], dtype=bool)
+
+# Count matrix column of every 4-bit BAM base code; ambiguous bases (-1) only add to the depth
+BASE_COLUMN = np.full(16, -1, dtype=np.int64)
+BASE_COLUMN[[1, 2, 4, 8]] = [0, 1, 2, 3]
+
+# Column of the base in the high (first 256 entries) or low nibble of a packed sequence byte
+NIBBLE_COLUMN = np.concatenate([BASE_COLUMN[np.arange(256) >> 4], BASE_COLUMN[np.arange(256) & 0xf]]).astype(np.int8)
+
+# Bit of each base in a 4-bit BAM base code, which is also the index of the IUPAC code of a set of bases
+BASE_BITS = np.array([1, 2, 4, 8, 0])
+IUPAC = np.array(list('NACMGRSVTWYHKDBN'))
+BAM_BASES = '=ACMGRSVTWYHKDBN'
+
+# Phred+33 character of every quality up to MAX_QUALITY
+PHRED_CHARACTERS = np.array([chr(33 + quality) for quality in range(MAX_QUALITY + 1)])
+
+def parse_bam_header(buffer):
+    """Parse the header of a decompressed BAM stream.
+    
+    Returns:
+        Tuple of (references, header size) with references a list of
+        (name, length), or None if buffer does not hold the whole header yet
+    """
+    if len(buffer) < 8:
+        return None
+    if bytes(buffer[:4]) != b'BAM\x01':
+        raise ValueError("Not a BAM file")
+    offset = 8 + struct.unpack_from('<i', buffer, 4)[0]
+    if len(buffer) < offset + 4:
+        return None
+    n_references = struct.unpack_from('<i', buffer, offset)[0]
+    offset += 4
+    references = []
+    for _ in range(n_references):
+        if len(buffer) < offset + 4:
+            return None
+        name_length = struct.unpack_from('<i', buffer, offset)[0]
+        if len(buffer) < offset + 8 + name_length:
+            return None
+        name = bytes(buffer[offset + 4:offset + 3 + name_length]).decode()
+        references.append((name, struct.unpack_from('<i', buffer, offset + 4 + name_length)[0]))
+        offset += 8 + name_length
+    return references, offset
+
+def iter_bam_blocks(bam_file, threads=1):
+    """Yield blocks of complete alignment records of a BAM file.
+    
+    The file is decompressed with threads threads (see compression.read_chunks).
+    
+    Yields:
+        Tuples of (references, data, record_starts): the (name, length) of
+        the reference sequences, the records as a uint8 array and the offset
+        of every record in it
+    """
+    buffer = bytearray()
+    references = None
+    yielded = False
+    for chunk in read_chunks(bam_file, threads):
+        buffer += chunk
+        if references is None:
+            header = parse_bam_header(buffer)
+            if header is None:
+                continue
+            references, header_size = header
+            del buffer[:header_size]
+        
+        record_starts = []
+        offset = 0
+        while offset + 4 <= len(buffer):
+            end = offset + 4 + struct.unpack_from('<i', buffer, offset)[0]
+            if end > len(buffer):
+                break
+            record_starts.append(offset)
+            offset = end
+        if record_starts:
+            yield references, np.frombuffer(bytes(buffer[:offset]), dtype=np.uint8), np.array(record_starts, dtype=np.int64)
+            yielded = True
+            del buffer[:offset]
+    
+    if references is None:
+        raise ValueError(f"{bam_file} holds no complete BAM header")
+    if buffer:
+        raise ValueError(f"{bam_file} ends with a truncated alignment record")
+    if not yielded:
+        # No alignments: an empty block still tells the reference sequences
+        yield references, np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64)
+
+def read_integers(data, offsets, size, signed=False):
+    """Read little-endian integers of size bytes at the given offsets of a uint8 array."""
+    values = np.zeros(len(offsets), dtype=np.int64)
+    for i in range(size):
+        values |= data[offsets + i].astype(np.int64) << (8 * i)
+    if signed:
+        values = np.where(values >= 1 << (8 * size - 1), values - (1 << (8 * size)), values)
+    return values
+
+def expand_ranges(starts, lengths):
+    """Return the ranges [start, start + length) concatenated into one array.
+    
+    The values are the running sum of steps of one, with a jump to the start
+    of every range where it begins, which avoids repeating per-range values.
+    """
+    starts = starts[lengths > 0]
+    lengths = lengths[lengths > 0]
+    steps = np.ones(lengths.sum(), dtype=np.int64)
+    if len(starts):
+        range_starts = np.cumsum(lengths) - lengths
+        steps[range_starts[1:]] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+        steps[0] = starts[0]
+    return np.cumsum(steps)
+
+def long_cigar(data, record_start, aux_start):
+    """Return the CIGAR stored in the CG tag of a record (minimap2 -L, over 65,535 operations), or None."""
+    offset = aux_start
+    record_end = record_start + 4 + int(read_integers(data, np.array([record_start]), 4)[0])
+    sizes = {'A': 1, 'c': 1, 'C': 1, 's': 2, 'S': 2, 'i': 4, 'I': 4, 'f': 4}
+    while offset + 3 <= record_end:
+        tag = bytes(data[offset:offset + 2]).decode()
+        value_type = chr(data[offset + 2])
+        offset += 3
+        if value_type in sizes:
+            offset += sizes[value_type]
+        elif value_type in 'ZH':
+            offset = int(np.flatnonzero(data[offset:record_end] == 0)[0]) + offset + 1
+        elif value_type == 'B':
+            subtype = chr(data[offset])
+            count = int(read_integers(data, np.array([offset + 1]), 4)[0])
+            if tag == 'CG' and subtype == 'I':
+                return np.frombuffer(data[offset + 5:offset + 5 + 4 * count].tobytes(), dtype='<u4').astype(np.int64)
+            offset += 5 + count * sizes[subtype]
+        else:
+            raise ValueError(f"Unknown BAM tag type {value_type}")
+    return None
+
+def parse_alignments(data, record_starts, reference_id):
+    """Parse the alignments of a block of BAM records to one reference sequence.
+    
+    Returns:
+        Dictionary with the per-alignment arrays pos, seq_start and qual_start,
+        and the per-CIGAR-operation arrays op, length, alignment (index of the
+        alignment), ref_start (reference position), query_start (index in
+        the read), nibble_start (index of the 4-bit base code in data) and
+        qual_offset (index of the base quality in data)
+    """
+    flags = read_integers(data, record_starts + 18, 2)
+    reference_ids = read_integers(data, record_starts + 4, 4, signed=True)
+    seq_lengths = read_integers(data, record_starts + 20, 4)
+    keep = (reference_ids == reference_id) & (flags & SKIP_FLAGS == 0) & (seq_lengths > 0)
+    starts = record_starts[keep]
+    seq_lengths = seq_lengths[keep]
+    
+    pos = read_integers(data, starts + 8, 4, signed=True)
+    n_cigar = read_integers(data, starts + 16, 2)
+    cigar_start = starts + 36 + data[starts + 12]
+    seq_start = cigar_start + 4 * n_cigar
+    qual_start = seq_start + (seq_lengths + 1) // 2
+    
+    alignment = np.repeat(np.arange(len(starts)), n_cigar)
+    first_op = np.cumsum(n_cigar) - n_cigar
+    values = read_integers(data, cigar_start[alignment] + 4 * (np.arange(len(alignment)) - first_op[alignment]), 4)
+    
+    # Alignments with more than 65,535 operations hold a placeholder CIGAR
+    # (soft clip of the read, skip of the reference span) and the real one in the CG tag
+    replaced = {}
+    if len(values):
+        first_values = values[np.minimum(first_op, len(values) - 1)]
+        for i in np.flatnonzero((n_cigar == 2) & (first_values & 0xf == 4) & (first_values >> 4 == seq_lengths)):
+            if values[first_op[i] + 1] & 0xf == 3:
+                cigar = long_cigar(data, starts[i], qual_start[i] + seq_lengths[i])
+                if cigar is not None:
+                    replaced[i] = cigar
+    if replaced:
+        parts = np.split(values, np.cumsum(n_cigar)[:-1])
+        for i, cigar in replaced.items():
+            parts[i] = cigar
+            n_cigar[i] = len(cigar)
+        values = np.concatenate(parts)
+        alignment = np.repeat(np.arange(len(starts)), n_cigar)
+    
+    op = values & 0xf
+    length = values >> 4
+    if len(op) and op.max() >= len(CIGAR_QUERY):
+        raise ValueError(f"Invalid CIGAR operation {op.max()}")
+    
+    # Offsets of every operation in the reference and the read, from the
+    # running totals of the lengths of the operations consuming them
+    offsets = {}
+    for name, consumes in [('ref', CIGAR_REFERENCE), ('query', CIGAR_QUERY)]:
+        consumed = np.where(consumes[op], length, 0)
+        totals = np.concatenate(([0], np.cumsum(consumed)))
+        offsets[name] = totals[:-1] - totals[np.cumsum(n_cigar) - n_cigar][alignment]
+    
+    return {
+        'pos': pos,
+        'seq_start': seq_start,
+        'qual_start': qual_start,
+        'op': op,
+        'length': length,
+        'alignment': alignment,
+        'ref_start': pos[alignment] + offsets['ref'],
+        'query_start': offsets['query'],
+        'nibble_start': 2 * seq_start[alignment] + offsets['query'],
+        'qual_offset': qual_start[alignment] + offsets['query']
+    }
+
+def pileup_bam(bam_file, contig, threads=1):
+    """Count the bases, deletions and insertions at every position of one contig of a sorted BAM file.
+    
+    CIGARs are walked block-wise with NumPy instead of through mpileup text.
+    As with samtools mpileup, unmapped, secondary, QC-failed and duplicate
+    alignments are skipped; base qualities are used as stored (no BAQ).
+    Bases are counted per quality, so that any minimum base quality can be
+    applied afterwards (see pileup_counts).
+    
+    Returns:
+        Dictionary with quality_counts (positions x A, C, G, T x quality
+        0-MAX_QUALITY), deletions, insertions (following the position) and
+        depth (aligned bases of any quality, including ambiguous ones, and deletions)
+    """
+    quality_counts = None
+    for references, data, record_starts in iter_bam_blocks(bam_file, threads):
+        if quality_counts is None:
+            names = [name for name, _ in references]
+            if contig not in names:
+                raise ValueError(f"{contig} is not a reference sequence of {bam_file}")
+            reference_id = names.index(contig)
+            length = references[reference_id][1]
+            quality_counts = np.zeros(length * 4 * (MAX_QUALITY + 1), dtype=np.int64)
+            deletions = np.zeros(length, dtype=np.int64)
+            insertions = np.zeros(length, dtype=np.int64)
+            depth = np.zeros(length, dtype=np.int64)
+        
+        alignments = parse_alignments(data, record_starts, reference_id)
+        op = alignments['op']
+        
+        # Bases aligned to reference positions, counted by position, base and
+        # quality; ambiguous bases only add to the depth
+        match = CIGAR_MATCH[op]
+        lengths = alignments['length'][match]
+        positions = expand_ranges(alignments['ref_start'][match], lengths)
+        nibbles = expand_ranges(alignments['nibble_start'][match], lengths)
+        qualities = np.minimum(data[expand_ranges(alignments['qual_offset'][match], lengths)], MAX_QUALITY)
+        columns = NIBBLE_COLUMN[(nibbles & 1) << 8 | data[nibbles >> 1]]
+        if len(positions) and (positions.min() < 0 or positions.max() >= length):
+            inside = (positions >= 0) & (positions < length)
+            positions, columns, qualities = positions[inside], columns[inside], qualities[inside]
+        depth += np.bincount(positions, minlength=length)
+        known = columns >= 0
+        quality_counts += np.bincount((positions[known] * 4 + columns[known]) * (MAX_QUALITY + 1) + qualities[known],
+                                      minlength=len(quality_counts))
+        
+        # Deleted reference positions
+        deletion = op == 2
+        positions = expand_ranges(alignments['ref_start'][deletion], alignments['length'][deletion])
+        positions = positions[(positions >= 0) & (positions < length)]
+        deleted = np.bincount(positions, minlength=length)
+        deletions += deleted
+        depth += deleted
+        
+        # Insertions, counted at the reference position they follow
+        positions = alignments['ref_start'][op == 1] - 1
+        positions = positions[(positions >= 0) & (positions < length)]
+        insertions += np.bincount(positions, minlength=length)
+    
+    return {
+        'quality_counts': quality_counts.reshape(length, 4, MAX_QUALITY + 1),
+        'deletions': deletions,
+        'insertions': insertions,
+        'depth': depth
+    }
+
+def pileup_counts(pileup, min_quality=0):
+    """Apply a minimum base quality to a pileup (see pileup_bam).
+    
+    Returns:
+        Dictionary with counts (positions x PILEUP_COLUMNS; bases of at least
+        min_quality, deletions and insertions), quality_sums (positions x A,
+        C, G, T; summed qualities of the counted bases) and depth
+    """
+    quality_counts = pileup['quality_counts'][:, :, max(0, min_quality):].astype(np.int64)
+    counts = np.empty((len(pileup['depth']), 6), dtype=np.int64)
+    counts[:, :4] = quality_counts.sum(axis=2)
+    counts[:, 4] = pileup['deletions']
+    counts[:, 5] = pileup['insertions']
+    return {
+        'counts': counts,
+        'quality_sums': quality_counts @ np.arange(max(0, min_quality), MAX_QUALITY + 1),
+        'depth': pileup['depth']
+    }
+
+def insertion_sequences(bam_file, contig, positions, threads=1):
+    """Collect the inserted sequences following some positions of one contig of a sorted BAM file.
+    
+    Returns:
+        Dictionary mapping position to a dictionary of inserted sequence ->
+        [number of reads, summed base quality]
+    """
+    positions = np.asarray(sorted(positions), dtype=np.int64)
+    insertions = {int(position): {} for position in positions}
+    if not len(positions):
+        return insertions
+    
+    for references, data, record_starts in iter_bam_blocks(bam_file, threads):
+        reference_id = [name for name, _ in references].index(contig)
+        alignments = parse_alignments(data, record_starts, reference_id)
+        selected = np.flatnonzero((alignments['op'] == 1) & np.isin(alignments['ref_start'] - 1, positions))
+        for i in selected:
+            nibbles = alignments['nibble_start'][i] + np.arange(alignments['length'][i])
+            packed = data[nibbles >> 1]
+            sequence = ''.join(BAM_BASES[code] for code in np.where(nibbles & 1, packed & 0xf, packed >> 4))
+            quality = int(data[alignments['qual_offset'][i]:alignments['qual_offset'][i] + alignments['length'][i]].sum())
+            entry = insertions[int(alignments['ref_start'][i] - 1)].setdefault(sequence, [0, 0])
+            entry[0] += 1
+            entry[1] += quality
+    return insertions
+
+def read_bam_header(bam_file):
+    """Return the header of a BAM file (magic, text and reference sequences) as uncompressed bytes."""
+    buffer = bytearray()
+    for chunk in read_chunks(bam_file):
+        buffer += chunk
+        header = parse_bam_header(buffer)
+        if header is not None:
+            return bytes(buffer[:header[1]])
+    raise ValueError(f"{bam_file} holds no complete BAM header")
+
+def coverage_depth(starts, ends, length):
+    """Return the number of [start, end) ranges covering every position of a sequence of the given length."""
+    return np.cumsum(np.bincount(starts, minlength=length + 1) - np.bincount(ends, minlength=length + 1))[:length]
+
+def range_minimum(values, starts, ends):
+    """Return the minimum of values[start:end] for every range, or 0 for empty ranges, from a sparse table."""
+    table = [values]
+    while 2 ** len(table) <= len(values):
+        half = 2 ** (len(table) - 1)
+        table.append(np.minimum(table[-1][:-half], table[-1][half:]))
+    minimum = np.zeros(len(starts), dtype=values.dtype)
+    lengths = ends - starts
+    levels = np.zeros(len(starts), dtype=np.int64)
+    levels[lengths > 0] = np.floor(np.log2(lengths[lengths > 0])).astype(np.int64)
+    for level in np.unique(levels[lengths > 0]):
+        selected = (lengths > 0) & (levels == level)
+        minimum[selected] = np.minimum(table[level][starts[selected]], table[level][ends[selected] - 2 ** level])
+    return minimum
+
+def normalize_depth(bam_file, output_file, contig, max_depth, threads=1):
+    """Write the alignments of one contig of a sorted BAM file with the depth capped at max_depth.
+    
+    The reference span of every alignment is read in a first pass. Alignments
+    are then kept when any position they cover has fewer than max_depth kept
+    alignments, taking alignments from the least covered regions first (and
+    the longest first among those), so regions below max_depth keep all of
+    their alignments and deep regions get few more than max_depth. Alignments
+    the pileup skips (unmapped, secondary, QC-failed, duplicate, on another
+    contig or without a sequence) are dropped too. A second pass copies the
+    kept records unchanged, still sorted, to a BGZF-compressed BAM file.
+    
+    Returns:
+        Dictionary with the number of alignments read ('alignments'), kept
+        ('kept') and dropped for each of DROP_REASONS
+    """
+    # First pass: the first reason that applies to every alignment, as an
+    # index of DROP_REASONS, and the reference span of the alignments the
+    # pileup uses (the same selection as parse_alignments)
+    reasons, starts, ends = [], [], []
+    for references, data, record_starts in iter_bam_blocks(bam_file, threads):
+        names = [name for name, _ in references]
+        if contig not in names:
+            raise ValueError(f"{contig} is not a reference sequence of {bam_file}")
+        reference_id = names.index(contig)
+        length = references[reference_id][1]
+        
+        flags = read_integers(data, record_starts + 18, 2)
+        block_reasons = np.full(len(record_starts), len(DROP_REASONS))
+        checks = [flags & DROP_FLAGS[reason] != 0 for reason in DROP_REASONS[:4]]
+        checks.append(read_integers(data, record_starts + 4, 4, signed=True) != reference_id)
+        checks.append(read_integers(data, record_starts + 20, 4) == 0)
+        for i, check in reversed(list(enumerate(checks))):
+            block_reasons[check] = i
+        reasons.append(block_reasons)
+        
+        alignments = parse_alignments(data, record_starts, reference_id)
+        spans = np.bincount(alignments['alignment'], weights=np.where(CIGAR_REFERENCE[alignments['op']], alignments['length'], 0),
+                            minlength=len(alignments['pos'])).astype(np.int64)
+        starts.append(np.clip(alignments['pos'], 0, length))
+        ends.append(np.clip(alignments['pos'] + spans, 0, length))
+    reasons = np.concatenate(reasons)
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    
+    # Greedy selection, least covered regions first. Alignments covering a
+    # position below max_depth are always kept, all at once; the rest are
+    # taken in chunks, and alignments already covered max_depth times at the
+    # start of their chunk are dropped at once too, since the coverage only
+    # grows. Only the few alignments left are checked one by one, so deep
+    # samples cost little more than the two passes over the BAM file.
+    depth = coverage_depth(starts, ends, length)
+    minimum_depth = range_minimum(depth, starts, ends)
+    order = np.lexsort((starts - ends, minimum_depth))
+    n_below = np.searchsorted(minimum_depth[order], max_depth)
+    coverage = coverage_depth(starts[order[:n_below]], ends[order[:n_below]], length)
+    dropped = np.zeros(len(starts), dtype=bool)
+    for chunk in range(n_below, len(order), NORMALIZE_CHUNK):
+        indices = order[chunk:chunk + NORMALIZE_CHUNK]
+        saturated = (ends[indices] > starts[indices]) & (range_minimum(coverage, starts[indices], ends[indices]) >= max_depth)
+        dropped[indices[saturated]] = True
+        for i in indices[~saturated]:
+            start, end = starts[i], ends[i]
+            if end > start and coverage[start:end].min() >= max_depth:
+                dropped[i] = True
+            else:
+                coverage[start:end] += 1
+    usable = np.flatnonzero(reasons == len(DROP_REASONS))
+    reasons[usable[dropped]] = DROP_REASONS.index('depth')
+    
+    # Second pass: copy the kept records
+    kept = reasons == len(DROP_REASONS)
+    
+    def kept_records():
+        yield read_bam_header(bam_file)
+        offset = 0
+        for _, data, record_starts in iter_bam_blocks(bam_file, threads):
+            record_ends = np.append(record_starts[1:], len(data))
+            block_kept = kept[offset:offset + len(record_starts)]
+            offset += len(record_starts)
+            yield data[expand_ranges(record_starts[block_kept], (record_ends - record_starts)[block_kept])].tobytes()
+    
+    write_chunks(output_file, kept_records(), 'bgzf', threads)
+    
+    counted = np.bincount(reasons, minlength=len(DROP_REASONS) + 1)
+    stats = {'alignments': len(reasons), 'kept': int(counted[-1])}
+    stats.update({reason: int(count) for reason, count in zip(DROP_REASONS, counted)})
+    return stats
+
+def call_consensus(pileup, min_depth=50, majority_threshold=0.7, insertions=None):
+    """Call a consensus sequence from pileup counts (see pileup_counts) following ivar consensus -k.
+    
+    Positions with a depth below min_depth are left out. Elsewhere the fewest
+    alleles (bases or deletion, most frequent first) that together reach
+    majority_threshold of the counted alleles are called, as an IUPAC code for
+    several bases; positions where a deletion is the most frequent allele are
+    left out and positions without counted bases become N. The most frequent
+    sequence inserted after a position (see insertion_sequences) is added
+    when insertions make up at least majority_threshold of the depth.
+    
+    Returns:
+        Tuple of (sequence, qualities): the consensus and the mean quality of
+        the bases supporting every consensus base as Phred+33 characters
+    """
+    counts = pileup['counts']
+    alleles = counts[:, :5]
+    total = alleles.sum(axis=1)
+    order = np.argsort(-alleles, axis=1, kind='stable')
+    cumulative = np.cumsum(np.take_along_axis(alleles, order, axis=1), axis=1)
+    n_alleles = np.minimum((cumulative < majority_threshold * total[:, None]).sum(axis=1) + 1, 5)
+    selected = np.arange(5)[None, :] < n_alleles[:, None]
+    
+    masks = np.where(selected, BASE_BITS[order], 0).sum(axis=1)
+    masks[total == 0] = 0
+    bases = IUPAC[masks]
+    
+    base_counts = np.where(selected, np.take_along_axis(np.hstack([counts[:, :4], np.zeros((len(counts), 1), dtype=np.int64)]), order, axis=1), 0).sum(axis=1)
+    quality_sums = np.where(selected, np.take_along_axis(np.hstack([pileup['quality_sums'], np.zeros((len(counts), 1), dtype=np.int64)]), order, axis=1), 0).sum(axis=1)
+    mean_qualities = np.where(base_counts > 0, quality_sums // np.maximum(base_counts, 1), 0)
+    qualities = PHRED_CHARACTERS[np.minimum(mean_qualities, MAX_QUALITY)]
+    
+    called = (pileup['depth'] >= min_depth) & ~((order[:, 0] == 4) & (total > 0))
+    sequence = bases.astype(object)
+    quality = qualities.astype(object)
+    for position, sequences in (insertions or {}).items():
+        if not called[position] or not sequences or counts[position, 5] < majority_threshold * pileup['depth'][position]:
+            continue
+        inserted, (reads, quality_sum) = max(sequences.items(), key=lambda item: (item[1][0], item[0]))
+        sequence[position] += inserted
+        quality[position] += PHRED_CHARACTERS[min(quality_sum // (reads * len(inserted)), MAX_QUALITY)] * len(inserted)
+    
+    return ''.join(sequence[called]), ''.join(quality[called])
+
+def insertion_candidates(pileup, min_fraction=0.7):
+    """Return the positions where at least min_fraction of the depth (and at least one read) has an insertion."""
+    insertions = pileup['insertions']
+    return np.flatnonzero((insertions > 0) & (insertions >= min_fraction * pileup['depth'])).tolist()
+
+def save_pileup(pileup_file, pileup, contig, insertions, insertion_fraction):
+    """Save a pileup and the inserted sequences at its frequent insertion sites to a compressed NPZ file.
+    
+    The file is compressed rather than written as memory-mappable .npy
+    arrays: the quality counts take 4 x 94 counters per position (about
+    11 MB for an L segment), nearly all zero, and compress to a small
+    fraction of that. lassensus recall reads every file once in full, so
+    mapping it into memory would gain little for the disk it costs.
+    
+    Args:
+        pileup_file: Output .npz file
+        pileup: Pileup counted by pileup_bam
+        contig: Name of the reference sequence
+        insertions: Inserted sequences by position (see insertion_sequences)
+        insertion_fraction: Fraction of the depth from which insertion sites were collected
+    """
+    sites = [(position, sequence, reads, quality) for position, sequences in sorted(insertions.items())
+             for sequence, (reads, quality) in sorted(sequences.items())]
+    np.savez_compressed(
+        pileup_file,
+        version=PILEUP_VERSION,
+        contig=contig,
+        quality_counts=pileup['quality_counts'].astype(np.uint32),
+        deletions=pileup['deletions'].astype(np.uint32),
+        insertions=pileup['insertions'].astype(np.uint32),
+        depth=pileup['depth'].astype(np.uint32),
+        insertion_fraction=insertion_fraction,
+        insertion_positions=np.array([site[0] for site in sites], dtype=np.int64),
+        insertion_sequences=np.array([site[1] for site in sites], dtype=str),
+        insertion_reads=np.array([site[2] for site in sites], dtype=np.int64),
+        insertion_qualities=np.array([site[3] for site in sites], dtype=np.int64)
+    )
+
+def load_pileup(pileup_file):
+    """Load a pileup saved by save_pileup.
+    
+    Returns:
+        Tuple of (pileup, contig, insertions, insertion_fraction)
+    """
+    with np.load(pileup_file) as data:
+        if int(data['version']) != PILEUP_VERSION:
+            raise ValueError(f"{pileup_file} was written by an incompatible version")
+        pileup = {key: data[key].astype(np.int64) for key in ['deletions', 'insertions', 'depth']}
+        pileup['quality_counts'] = data['quality_counts']
+        insertions = {}
+        for position, sequence, reads, quality in zip(data['insertion_positions'], data['insertion_sequences'],
+                                                      data['insertion_reads'], data['insertion_qualities']):
+            insertions.setdefault(int(position), {})[str(sequence)] = [int(reads), int(quality)]
+        return pileup, str(data['contig']), insertions, float(data['insertion_fraction'])
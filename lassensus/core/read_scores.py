@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from .mapping_stats import best_read_scores
+
+logger = logging.getLogger(__name__)
+
+# Number of best candidates per segment competing in the bootstrap
+BOOTSTRAP_CANDIDATES = 10
+
+# Number of bootstrap resamples computed per matrix product
+BOOTSTRAP_CHUNK_SIZE = 100
+
+def save_read_scores(output_file, reads, references, scores, identities, accessions, segments):
+    """Save per-read best alignments as a sparse read x reference matrix.
+    
+    The matrix is stored in coordinate form in a compressed NPZ file: for every
+    aligned (read, reference) pair its row, column, alignment score and
+    identity, plus the read names and the accession and segment of every column.
+    
+    Args:
+        output_file: NPZ file to write
+        reads, references, scores, identities: Arrays from mapping_stats.best_read_scores
+        accessions: Accessions of all evaluated references, in column order
+        segments: Segment of every accession
+    """
+    accessions = np.array(accessions, dtype=str)
+    read_names, rows = np.unique(reads, return_inverse=True)
+    
+    # Map reference names to columns, dropping alignments to unknown references
+    column_of = {str(accession): i for i, accession in enumerate(accessions)}
+    names, name_index = np.unique(references, return_inverse=True)
+    columns = np.array([column_of.get(str(name), -1) for name in names], dtype=np.int64)[name_index]
+    known = columns >= 0
+    
+    np.savez_compressed(
+        output_file,
+        reads=read_names,
+        accessions=accessions,
+        segments=np.array(segments, dtype=str),
+        row=rows[known].astype(np.int32),
+        col=columns[known].astype(np.int32),
+        score=scores[known].astype(np.int32),
+        identity=identities[known].astype(np.float32)
+    )
+    logger.info(f"Saved {int(known.sum()):,} read alignments to {len(accessions)} references in {output_file}")
+
+def load_read_scores(read_scores_file):
+    """Load a read x reference score matrix saved by save_read_scores into a dictionary of arrays."""
+    with np.load(read_scores_file) as data:
+        return {key: data[key] for key in data.files}
+
+def best_hits(matrix):
+    """Return for every aligned read the column of its best-scoring reference within the read's segment.
+    
+    Returns:
+        Tuple of (rows, columns) with one entry per (read, segment) pair
+    """
+    rows = matrix['row']
+    columns = matrix['col']
+    segment_codes = np.unique(matrix['segments'], return_inverse=True)[1][columns] if len(columns) else columns
+    
+    # Highest score first within every (read, segment), ties broken by identity then column
+    order = np.lexsort((columns, -matrix['identity'], -matrix['score'], segment_codes, rows))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (rows[order][1:] != rows[order][:-1]) | (segment_codes[order][1:] != segment_codes[order][:-1])
+    return rows[order][first], columns[order][first]
+
+def summarize_read_scores(matrix, min_identity=0):
+    """Calculate per-reference selection criteria from a read x reference score matrix.
+    
+    Returns:
+        Dictionary mapping accession to reads_above_min_identity (reads aligned
+        with at least min_identity percent identity), median_identity of the
+        aligned reads and best_hits (reads scoring best on this reference
+        among all references of its segment)
+    """
+    n_columns = len(matrix['accessions'])
+    columns = matrix['col']
+    identity = matrix['identity']
+    
+    passing = np.bincount(columns[identity >= min_identity], minlength=n_columns)
+    hits = np.bincount(best_hits(matrix)[1], minlength=n_columns)
+    
+    # Median identity per column from the identities sorted within every column
+    order = np.lexsort((identity, columns))
+    counts = np.bincount(columns, minlength=n_columns)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sorted_identity = identity[order]
+    medians = np.zeros(n_columns)
+    has_reads = counts > 0
+    lower = sorted_identity[(starts + (counts - 1) // 2)[has_reads]]
+    upper = sorted_identity[(starts + counts // 2)[has_reads]]
+    medians[has_reads] = (lower + upper) / 2
+    
+    return {
+        str(accession): {
+            'reads_above_min_identity': int(passing[i]),
+            'median_identity': round(float(medians[i]), 2),
+            'best_hits': int(hits[i])
+        }
+        for i, accession in enumerate(matrix['accessions'])
+    }
+
+def save_read_score_part(part_file, read_scores):
+    """Save the best alignment of every read from one alignment run (see mapping_stats.best_read_scores)."""
+    reads, references, scores, identities = best_read_scores(read_scores)
+    np.savez(part_file, reads=reads, references=references, scores=scores, identities=identities)
+
+def merge_read_score_files(read_scores_dir):
+    """Concatenate the per-alignment read score files written by the evaluation workers."""
+    parts = []
+    for part_file in sorted(Path(read_scores_dir).glob('*.npz')):
+        with np.load(part_file) as data:
+            parts.append((data['reads'], data['references'], data['scores'], data['identities']))
+    if not parts:
+        return np.empty(0, dtype=str), np.empty(0, dtype=str), np.empty(0, dtype=np.int64), np.empty(0)
+    return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+def bootstrap_confidence(matrix, n_resamples=1000, seed=42, n_candidates=BOOTSTRAP_CANDIDATES, chunk_size=BOOTSTRAP_CHUNK_SIZE):
+    """Estimate how robust the best-reference call of each segment is to read sampling.
+    
+    The reads aligned to a segment are resampled with replacement, and in every
+    resample each candidate is scored by its number of mapped reads, the
+    criterion used to select the best reference. Resamples are drawn as
+    Poisson(1) read weights (the Poisson bootstrap) and scored together by
+    multiplying a resamples x reads weight matrix with a read x candidate
+    alignment indicator, in chunks to bound memory. Reads with the same
+    alignment pattern are interchangeable, so one weight is drawn per distinct
+    pattern. Only the n_candidates best candidates of each segment compete.
+    
+    Returns:
+        Dictionary mapping segment to the resample count, the best reference
+        on all reads with the fraction of resamples it wins ('confidence'),
+        the win fraction of every candidate, and the median and 95% interval
+        of its lead in mapped reads over the best other candidate
+    """
+    rng = np.random.default_rng(seed)
+    segments = matrix['segments']
+    mapped = np.bincount(matrix['col'], minlength=len(matrix['accessions']))
+    results = {}
+    
+    for segment in ['L', 'S']:
+        segment_columns = np.flatnonzero(segments == segment)
+        if len(segment_columns) == 0:
+            continue
+        
+        # Keep the best candidates, ordered by mapped reads on all reads (ties by column)
+        order = np.lexsort((segment_columns, -mapped[segment_columns]))
+        candidates = segment_columns[order][:n_candidates]
+        if mapped[candidates[0]] == 0:
+            continue
+        
+        # Read x candidate indicator over the reads aligned to any candidate,
+        # collapsed to the distinct alignment patterns and their read counts
+        position = np.full(len(matrix['accessions']), -1)
+        position[candidates] = np.arange(len(candidates))
+        candidate_index = position[matrix['col']]
+        in_candidates = candidate_index >= 0
+        rows, row_index = np.unique(matrix['row'][in_candidates], return_inverse=True)
+        indicator = np.zeros((len(rows), len(candidates)), dtype=bool)
+        indicator[row_index, candidate_index[in_candidates]] = True
+        patterns, pattern_reads = np.unique(indicator, axis=0, return_counts=True)
+        patterns = patterns.astype(np.float32)
+        
+        # The Poisson(1) weights of the reads sharing a pattern sum to a Poisson(count) weight
+        wins = np.zeros(len(candidates), dtype=np.int64)
+        gaps = []
+        for start in range(0, n_resamples, chunk_size):
+            size = min(chunk_size, n_resamples - start)
+            weights = rng.poisson(pattern_reads, size=(size, len(pattern_reads))).astype(np.float32)
+            scores = weights @ patterns
+            wins += np.bincount(np.argmax(scores, axis=1), minlength=len(candidates))
+            others = scores[:, 1:].max(axis=1) if len(candidates) > 1 else np.zeros(size, dtype=np.float32)
+            gaps.append(scores[:, 0] - others)
+        gaps = np.concatenate(gaps)
+        
+        accessions = [str(matrix['accessions'][column]) for column in candidates]
+        results[segment] = {
+            'resamples': n_resamples,
+            'best_reference': accessions[0],
+            'confidence': round(float(wins[0] / n_resamples), 4),
+            'win_fractions': {accession: round(float(win / n_resamples), 4) for accession, win in zip(accessions, wins) if win > 0},
+            'runner_up': accessions[1] if len(accessions) > 1 else None,
+            'gap_median': float(np.median(gaps)),
+            'gap_ci95': [float(np.percentile(gaps, 2.5)), float(np.percentile(gaps, 97.5))]
+        }
+    
+    return results
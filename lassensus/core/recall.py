@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import csv
+import sys
+import argparse
+import logging
+import itertools
+from pathlib import Path
+
+from .pileup import load_pileup, pileup_counts, call_consensus, MAX_QUALITY
+from .consensus_generation import get_pileup_file, write_consensus_files, calculate_completeness, REFSEQ_LENGTHS
+
+logger = logging.getLogger(__name__)
+
+# Columns of the recall summary table
+SUMMARY_COLUMNS = ['sample', 'segment', 'min_depth', 'min_quality', 'majority_threshold', 'total_length', 'n_count',
+                   'non_n_length', 'ref_length', 'completeness_vs_ref', 'completeness_vs_refseq', 'consensus_file']
+
+def find_pileup_files(consensus_dir, samples=None):
+    """Return (sample, segment, pileup file, reference file) of every saved pileup in a consensus directory.
+    
+    Args:
+        consensus_dir: The consensus directory of a pipeline output directory
+        samples: Names of the samples to include (default: all)
+    """
+    found = []
+    for sample_dir in sorted(d for d in Path(consensus_dir).iterdir() if d.is_dir()):
+        sample = sample_dir.name
+        if samples and sample not in samples:
+            continue
+        for segment in ['L', 'S']:
+            pileup_file = get_pileup_file(sample_dir / f"{sample}_{segment}.sorted.bam")
+            reference_file = sample_dir / f"{sample}_{segment}_reference.fasta"
+            if not pileup_file.exists():
+                logger.warning(f"No pileup count matrix for the {segment} segment of {sample}: {pileup_file} (saved by consensus generation with --save_pileup)")
+                continue
+            found.append((sample, segment, pileup_file, reference_file))
+    return found
+
+def recall_segment(pileup_file, reference_file, sample, segment, parameter_sets, output_dir):
+    """Re-call the consensus of one segment from its saved pileup for every parameter set.
+    
+    The pileup is loaded once and reduced once per minimum base quality; every
+    consensus call is vectorized over all positions (see pileup.call_consensus).
+    
+    Args:
+        parameter_sets: List of (min_depth, min_quality, majority_threshold)
+        output_dir: Directory for the consensus and quality files
+    
+    Returns:
+        List of summary rows (see SUMMARY_COLUMNS)
+    """
+    pileup, contig, insertions, insertion_fraction = load_pileup(pileup_file)
+    if any(threshold < insertion_fraction for _, _, threshold in parameter_sets):
+        logger.warning(f"{pileup_file} holds inserted sequences only where insertions reach {insertion_fraction:g} of the depth; "
+                       f"lower majority thresholds do not add insertions elsewhere")
+    
+    rows = []
+    for min_quality in sorted({min_quality for _, min_quality, _ in parameter_sets}):
+        counts = pileup_counts(pileup, min_quality)
+        for min_depth, _, majority_threshold in (p for p in parameter_sets if p[1] == min_quality):
+            sequence, qualities = call_consensus(counts, min_depth, majority_threshold, insertions)
+            prefix = f"{sample}_{segment}_d{min_depth}_q{min_quality}_t{majority_threshold:g}"
+            consensus_file = output_dir / f"{prefix}_consensus.fasta"
+            quality_file = output_dir / f"{prefix}_quality.txt"
+            write_consensus_files(consensus_file, quality_file, f"{sample}_{segment}", min_quality, majority_threshold, sequence, qualities)
+            
+            stats = calculate_completeness(consensus_file, reference_file, REFSEQ_LENGTHS[segment])
+            rows.append({
+                'sample': sample,
+                'segment': segment,
+                'min_depth': min_depth,
+                'min_quality': min_quality,
+                'majority_threshold': majority_threshold,
+                **stats,
+                'completeness_vs_ref': round(stats['completeness_vs_ref'], 2),
+                'completeness_vs_refseq': round(stats['completeness_vs_refseq'], 2),
+                'consensus_file': str(consensus_file)
+            })
+    return rows
+
+def main(args=None):
+    """Main function for re-calling consensus sequences from saved pileups."""
+    if args is None:
+        parser = argparse.ArgumentParser(description='Re-call consensus sequences from saved pileup count matrices; the calls are not polished with medaka, so their completeness can differ from the polished consensus reported by the pipeline')
+        parser.add_argument('-o', '--output_dir', required=True, help='Pipeline output directory holding the consensus directory')
+        parser.add_argument('--samples', nargs='+', default=None, help='Samples to re-call (default: all)')
+        parser.add_argument('--min_depth', type=int, nargs='+', default=[50], help='Minimum depth(s) for consensus calling (default: 50)')
+        parser.add_argument('--min_quality', type=int, nargs='+', default=[30], help='Minimum quality score(s) for consensus calling (default: 30)')
+        parser.add_argument('--majority_threshold', type=float, nargs='+', default=[0.7], help='Majority rule threshold(s) (default: 0.7)')
+        parser.add_argument('--recall_dir', default=None, help='Directory for re-called consensus sequences (default: <output_dir>/recall)')
+        args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    output_dir = Path(args.output_dir)
+    consensus_dir = output_dir / 'consensus'
+    recall_dir = Path(args.recall_dir) if args.recall_dir else output_dir / 'recall'
+    
+    if any(min_depth < 0 for min_depth in args.min_depth):
+        logger.error("--min_depth must not be negative")
+        sys.exit(1)
+    if any(not 0 <= min_quality <= MAX_QUALITY for min_quality in args.min_quality):
+        logger.error(f"--min_quality must be between 0 and {MAX_QUALITY}")
+        sys.exit(1)
+    if any(not 0 <= threshold <= 1 for threshold in args.majority_threshold):
+        logger.error("--majority_threshold must be between 0 and 1")
+        sys.exit(1)
+    if not consensus_dir.is_dir():
+        logger.error(f"Consensus directory not found: {consensus_dir}")
+        sys.exit(1)
+    
+    parameter_sets = list(itertools.product(sorted(set(args.min_depth)), sorted(set(args.min_quality)), sorted(set(args.majority_threshold))))
+    pileup_files = find_pileup_files(consensus_dir, args.samples)
+    if not pileup_files:
+        logger.error(f"No pileup count matrices found in {consensus_dir}; run consensus generation with --save_pileup first")
+        sys.exit(1)
+    logger.info(f"Re-calling {len(pileup_files)} segments with {len(parameter_sets)} parameter sets")
+    
+    rows = []
+    for sample, segment, pileup_file, reference_file in pileup_files:
+        sample_dir = recall_dir / sample
+        sample_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            rows.extend(recall_segment(pileup_file, reference_file, sample, segment, parameter_sets, sample_dir))
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Error re-calling the {segment} segment of {sample}: {e}")
+            sys.exit(1)
+    
+    summary_file = recall_dir / 'recall_summary.tsv'
+    with open(summary_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(rows)
+    
+    logger.info(f"Wrote {len(rows)} consensus sequences to {recall_dir}")
+    logger.info(f"Completeness summary: {summary_file}")
+
+if __name__ == '__main__':
+    main()
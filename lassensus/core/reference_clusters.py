@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import json
+import hashlib
+import logging
+from pathlib import Path
+from collections import defaultdict
+
+import numpy as np
+
+from .cache import hash_files
+from .sketch import load_reference_sketches, DEFAULT_KMER_SIZE, DEFAULT_SCALED
+
+logger = logging.getLogger(__name__)
+
+def sequence_hash(sequence):
+    """Hash a reference sequence, ignoring case."""
+    return hashlib.sha1(sequence.upper().encode()).hexdigest()
+
+def get_clusters_file(references_dir, identity):
+    """Return the path of the cached cluster assignment for a reference set."""
+    return Path(references_dir) / 'FASTA' / f"clusters_i{identity:g}_k{DEFAULT_KMER_SIZE}_s{DEFAULT_SCALED}.json"
+
+def build_clusters(reference_files, identity, segment_of):
+    """Group references into exact-duplicate sets and then greedy identity clusters.
+    
+    Unique sequences are processed from longest to shortest; each joins the
+    first cluster whose representative contains it at the requested identity,
+    or founds a new cluster. Identity is estimated from the k-mer containment c
+    of the sequence in the representative as c ** (1 / k).
+    
+    Args:
+        reference_files: List of (ref_file, ref_info) tuples from get_reference_files
+        identity: Minimum estimated identity (percent) to join a cluster
+        segment_of: Function returning the segment of a reference file
+    Returns:
+        List of clusters, each a list of accessions with the representative first
+    """
+    min_containment = (identity / 100) ** DEFAULT_KMER_SIZE
+    
+    # Load the cached sketches of every reference
+    references_by_file = defaultdict(list)
+    for ref_file, ref_info in reference_files:
+        references_by_file[ref_file].append(ref_info)
+    sketches = {}
+    for ref_file, references in references_by_file.items():
+        sketches.update(load_reference_sketches(ref_file, references))
+    
+    clusters = []
+    for segment in ['L', 'S']:
+        # Collapse identical sequences, keeping the first accession of each
+        duplicates = {}
+        unique = []
+        for ref_file, ref_info in reference_files:
+            if segment_of(ref_file) != segment:
+                continue
+            seq_hash = sequence_hash(ref_info['sequence'])
+            if seq_hash in duplicates:
+                duplicates[seq_hash].append(ref_info['accession'])
+            else:
+                duplicates[seq_hash] = [ref_info['accession']]
+                unique.append((len(ref_info['sequence']), len(unique), seq_hash, ref_info['accession']))
+        
+        unique.sort(key=lambda item: (-item[0], item[1]))
+        representatives = []
+        segment_clusters = []
+        for _, _, seq_hash, accession in unique:
+            sketch = sketches[accession]
+            cluster = None
+            for i, rep_sketch in enumerate(representatives):
+                shared = len(np.intersect1d(sketch, rep_sketch, assume_unique=True))
+                if len(sketch) > 0 and shared / len(sketch) >= min_containment:
+                    cluster = i
+                    break
+            if cluster is None:
+                representatives.append(sketch)
+                segment_clusters.append([])
+                cluster = len(segment_clusters) - 1
+            segment_clusters[cluster].extend(duplicates[seq_hash])
+        
+        n_references = sum(len(cluster) for cluster in segment_clusters)
+        logger.info(f"Clustered {n_references} {segment}-segment references into {len(duplicates)} unique sequences "
+                    f"and {len(segment_clusters)} clusters at {identity:g}% identity")
+        clusters.extend(segment_clusters)
+    
+    return clusters
+
+def load_reference_clusters(references_dir, reference_files, identity, segment_of):
+    """Load the cached cluster assignment of a reference set, building it if needed.
+    
+    The assignment is stored in the references FASTA directory and reused as long
+    as the reference FASTA files are unchanged, so it is computed once per download.
+    """
+    clusters_file = get_clusters_file(references_dir, identity)
+    reference_hash = hash_files(sorted({Path(ref_file) for ref_file, _ in reference_files}))
+    
+    if clusters_file.exists():
+        try:
+            with open(clusters_file, 'r') as f:
+                cached = json.load(f)
+            if cached.get('reference_hash') == reference_hash:
+                return cached['clusters']
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable cluster cache {clusters_file}: {e}")
+    
+    clusters = build_clusters(reference_files, identity, segment_of)
+    
+    try:
+        with open(clusters_file, 'w') as f:
+            json.dump({
+                'reference_hash': reference_hash,
+                'identity': identity,
+                'kmer_size': DEFAULT_KMER_SIZE,
+                'scaled': DEFAULT_SCALED,
+                'clusters': clusters
+            }, f, indent=2)
+    except OSError as e:
+        logger.warning(f"Could not cache reference clusters to {clusters_file}: {e}")
+    
+    return clusters
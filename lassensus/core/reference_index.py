@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import json
+import hashlib
+import shutil
+import sqlite3
+import logging
+from pathlib import Path
+
+from .reference_store import list_fasta_files
+from .cache import get_content_hash, references_current, record_references_source, REFERENCE_SOURCE_FILE
+
+logger = logging.getLogger(__name__)
+
+# Name of the metadata index, stored next to the downloaded files
+INDEX_FILE = 'metadata.sqlite'
+
+# Length of the complete L and S segments (Josiah strain, NC_004297 and NC_004296)
+# used to estimate the completeness of a sequence
+SEGMENT_LENGTHS = {'L': 7279, 'S': 3402}
+
+# Host names (lower case) counted as human or rodent hosts
+HUMAN_HOSTS = ['homo sapiens', 'human']
+RODENT_HOSTS = ['rodent', 'mastomys', 'rattus', 'mus musculus', 'hylomyscus', 'praomys', 'lophuromys', 'murinae', 'muridae']
+
+# Metadata table columns (lower case) recognised for each field
+ACCESSION_COLUMNS = ['accession', 'accession_id', 'accession_number', 'genbank_accession', 'genbank']
+HOST_COLUMNS = ['host', 'host_species', 'host_name']
+LOCATION_COLUMNS = ['country', 'location', 'geo_loc_name', 'geographic_location']
+DATE_COLUMNS = ['collection_date', 'date', 'year', 'collection_year']
+
+MISSING_VALUES = {'', 'na', 'n/a', 'nan', 'none', 'unknown', 'missing', 'not applicable', 'not collected'}
+
+def strip_version(accession):
+    """Remove the version suffix of an accession (MH157036.1 -> MH157036)."""
+    return accession.split('.')[0]
+
+def host_group(host):
+    """Classify a host name as 'human', 'rodent' or None."""
+    if not host:
+        return None
+    host = host.lower()
+    if any(name in host for name in HUMAN_HOSTS):
+        return 'human'
+    if any(name in host for name in RODENT_HOSTS):
+        return 'rodent'
+    return None
+
+def find_column(fieldnames, candidates):
+    """Return the first column whose lower-case name is in candidates."""
+    for candidate in candidates:
+        for name in fieldnames:
+            if name.strip().lower() == candidate:
+                return name
+    return None
+
+def read_metadata_tables(data_dir):
+    """Read host, location and date per accession from the metadata tables of a download.
+    
+    Every CSV or TSV file with a recognisable accession column is used.
+    
+    Returns:
+        Dictionary mapping unversioned accession to a dictionary with host,
+        location and date (None when unknown)
+    """
+    metadata = {}
+    for table in sorted(Path(data_dir).rglob('*')):
+        if table.suffix.lower() not in ['.csv', '.tsv'] or not table.is_file():
+            continue
+        delimiter = '\t' if table.suffix.lower() == '.tsv' else ','
+        with open(table, 'r', newline='') as f:
+            reader = csv.DictReader(f, delimiter=delimiter)
+            if not reader.fieldnames:
+                continue
+            accession_column = find_column(reader.fieldnames, ACCESSION_COLUMNS)
+            if accession_column is None:
+                continue
+            columns = {
+                'host': find_column(reader.fieldnames, HOST_COLUMNS),
+                'location': find_column(reader.fieldnames, LOCATION_COLUMNS),
+                'date': find_column(reader.fieldnames, DATE_COLUMNS)
+            }
+            for row in reader:
+                accession = (row.get(accession_column) or '').strip()
+                if not accession:
+                    continue
+                entry = metadata.setdefault(strip_version(accession), {'host': None, 'location': None, 'date': None})
+                for field, column in columns.items():
+                    value = (row.get(column) or '').strip() if column else ''
+                    if value.lower() not in MISSING_VALUES:
+                        entry[field] = value
+    return metadata
+
+def scan_fasta_records(fasta_file):
+    """Yield (accession, description, byte offset, byte length, sequence length) for every FASTA record."""
+    record = None
+    offset = 0
+    with open(fasta_file, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if record:
+                    yield record[0], record[1], record[2], offset - record[2], record[3]
+                fields = line[1:].decode().split()
+                record = [fields[0] if fields else '', ' '.join(fields[1:]), offset, 0]
+            elif record:
+                record[3] += len(line.strip())
+            offset += len(line)
+    if record:
+        yield record[0], record[1], record[2], offset - record[2], record[3]
+
+def data_fingerprint(data_dir):
+    """Identify the FASTA files of a download by relative path and size."""
+    data_dir = Path(data_dir)
+    return repr([[str(f.relative_to(data_dir)), f.stat().st_size] for f in list_fasta_files(data_dir / 'FASTA')])
+
+def build_metadata_index(data_dir, index_file):
+    """Build a SQLite index over the references of an unfiltered download.
+    
+    For every FASTA record the index holds its accession, segment, estimated
+    completeness, host, location and collection date, and where the record
+    is stored (file, byte offset, byte length) so that subsets can be written
+    without parsing the FASTA files again.
+    """
+    data_dir = Path(data_dir)
+    fasta_dir = data_dir / 'FASTA'
+    fasta_files = list_fasta_files(fasta_dir)
+    metadata = read_metadata_tables(data_dir)
+    if not metadata:
+        logger.warning(f"No metadata table found in {data_dir}; host and metadata filters will exclude all references")
+    
+    temp_file = Path(f"{index_file}.{os.getpid()}.tmp")
+    if temp_file.exists():
+        os.remove(temp_file)
+    connection = sqlite3.connect(temp_file)
+    with connection:
+        connection.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('''CREATE TABLE reference (
+            accession TEXT, description TEXT, segment TEXT, completeness REAL,
+            host TEXT, host_group TEXT, location TEXT, date TEXT,
+            file TEXT, offset INTEGER, length INTEGER)''')
+        rows = []
+        for fasta_file in fasta_files:
+            segment = fasta_file.parent.name.split('_')[0]
+            relative_file = str(fasta_file.relative_to(data_dir))
+            for accession, description, offset, length, sequence_length in scan_fasta_records(fasta_file):
+                completeness = min(100.0, sequence_length / SEGMENT_LENGTHS[segment] * 100) if segment in SEGMENT_LENGTHS else None
+                info = metadata.get(strip_version(accession), {})
+                rows.append((accession, description, segment, completeness,
+                             info.get('host'), host_group(info.get('host')), info.get('location'), info.get('date'),
+                             relative_file, offset, length))
+        connection.executemany('INSERT INTO reference VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        connection.execute('CREATE INDEX reference_filters ON reference (segment, completeness, host_group)')
+        connection.execute("INSERT INTO info VALUES ('fingerprint', ?)", (data_fingerprint(data_dir),))
+    connection.close()
+    os.replace(temp_file, index_file)
+    
+    logger.info(f"Built metadata index of {len(rows)} references ({len(metadata)} with metadata) in {index_file}")
+
+def load_metadata_index(data_dir):
+    """Open the metadata index of a download, building it on first use.
+    
+    The index is stored next to the download directory (in the cache entry),
+    so it is built once per download and shared by all filter combinations.
+    """
+    index_file = Path(data_dir).parent / INDEX_FILE
+    if index_file.exists():
+        connection = sqlite3.connect(index_file)
+        try:
+            fingerprint = connection.execute("SELECT value FROM info WHERE key = 'fingerprint'").fetchone()
+            if fingerprint and fingerprint[0] == data_fingerprint(data_dir):
+                return connection
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"Rebuilding unreadable metadata index {index_file}: {e}")
+        connection.close()
+    
+    build_metadata_index(data_dir, index_file)
+    return sqlite3.connect(index_file)
+
+def select_references(data_dir, genome=1, completeness=90, host=4, metadata=4):
+    """Select the references of an unfiltered download matching the lassaseq filters.
+    
+    Completeness is estimated as the sequence length relative to the complete
+    segment (see SEGMENT_LENGTHS); host and metadata filters use the metadata
+    tables of the download.
+    
+    Args:
+        data_dir: Directory with the unfiltered lassaseq download
+        genome: Genome completeness filter (1=complete only, 2=partial, 3=no filter)
+        completeness: Minimum sequence completeness (1-100) when genome=2
+        host: Host filter (1=human, 2=rodent, 3=both, 4=no filter)
+        metadata: Metadata filter (1=known location, 2=known date, 3=both, 4=no filter)
+    Returns:
+        List of (accession, file, offset, length) tuples in download order
+    """
+    conditions = []
+    parameters = []
+    if genome == 1:
+        conditions.append('completeness > 99')
+    elif genome == 2:
+        conditions.append('completeness >= ?')
+        parameters.append(completeness)
+    if host == 1:
+        conditions.append("host_group = 'human'")
+    elif host == 2:
+        conditions.append("host_group = 'rodent'")
+    elif host == 3:
+        conditions.append("host_group IN ('human', 'rodent')")
+    if metadata in [1, 3]:
+        conditions.append('location IS NOT NULL')
+    if metadata in [2, 3]:
+        conditions.append('date IS NOT NULL')
+    
+    query = 'SELECT accession, file, offset, length FROM reference'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY rowid'
+    
+    connection = load_metadata_index(data_dir)
+    try:
+        records = connection.execute(query, parameters).fetchall()
+        total = connection.execute('SELECT COUNT(*) FROM reference').fetchone()[0]
+    finally:
+        connection.close()
+    
+    logger.info(f"Local filter (genome={genome}, completeness={completeness}%, host={host}, metadata={metadata}) "
+                f"selected {len(records)} of {total} references")
+    return records
+
+def write_reference_subset(data_dir, records, output_dir):
+    """Write the selected FASTA records into a run's references directory.
+    
+    Records are copied byte for byte from the downloaded FASTA files into files
+    of the same name under output_dir, replacing any earlier references.
+    Nothing is written when the directory already holds the same selection
+    of the same download, so the caches kept next to the FASTA files survive.
+    
+    Returns:
+        True if the references were written, False if they were current
+    """
+    data_dir = Path(data_dir)
+    fasta_dir = Path(output_dir) / 'FASTA'
+    source = hashlib.sha256(json.dumps({'download': get_content_hash(data_dir), 'records': records}).encode()).hexdigest()
+    if references_current(output_dir, source):
+        logger.info(f"References in {output_dir} are up to date")
+        return False
+    (Path(output_dir) / REFERENCE_SOURCE_FILE).unlink(missing_ok=True)
+    if fasta_dir.exists():
+        shutil.rmtree(fasta_dir)
+    
+    by_file = {}
+    for accession, file, offset, length in records:
+        by_file.setdefault(file, []).append((offset, length))
+    
+    for file, spans in by_file.items():
+        output_file = Path(output_dir) / file
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(data_dir / file, 'rb') as f_in, open(output_file, 'wb') as f_out:
+            for offset, length in spans:
+                f_in.seek(offset)
+                data = f_in.read(length)
+                f_out.write(data if data.endswith(b'\n') else data + b'\n')
+    record_references_source(output_dir, source)
+    return True
@@ -10,8 +10,24 @@ import shutil
 import json
 import gzip
 import multiprocessing
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import numpy as np
+
+from .cache import get_index, evict_cache, hash_reads, get_minimap2_version, get_score_table_file, load_score_table, save_score_table, reference_filters, find_cached_references, store_references, materialize_references, format_filters, DEFAULT_CACHE_MAX_SIZE
+from .sketch import containment_scores, open_text
+from .reference_clusters import load_reference_clusters, sequence_hash
+from .compression import describe_backend, fastq_suffix, COMPRESSION_FORMATS, DEFAULT_COMPRESSION, DEFAULT_LEVEL
+from .fastq_scan import load_fastq_scan, DEFAULT_SEED, copy_fastq_scan, write_fastq_sample
+from .read_scores import save_read_score_part, save_read_scores, merge_read_score_files, load_read_scores, summarize_read_scores, bootstrap_confidence
+from .reference_index import select_references, write_reference_subset
+from .reference_store import sequence_hashes, diff_reference_sets, load_reference_store, read_sequence, write_reference_fasta
+from .mapping_stats import calculate_mapping_stats, calculate_mapping_stats_by_reference, calculate_mapping_stats_by_sample, format_mapping_stats, empty_totals, MULTIPLEX_SEPARATOR
+
 def setup_logging(output_dir):
     """Set up logging configuration."""
     log_file = Path(output_dir) / 'lassensus.log'
@@ -27,6 +43,23 @@ def setup_logging(output_dir):
 
 logger = logging.getLogger(__name__)
 
+# Number of reads sampled from every sample for reference selection
+RAREFIED_READS = 10000
+
+# Occurrences per reference above which minimap2 ignores a minimizer in
+# competitive mapping (-f), the lower bound of its default limit (-U 10).
+# The default fraction (-f 0.0002) would drop the minimizers shared by many
+# near-identical references, and with them the seeds of most reads.
+COMPETITIVE_OCCURRENCE = 10
+
+def ranking_key(stats):
+    """Rank references by mapped reads, breaking ties on identity and then matching bases.
+    
+    Near-identical references often map the same reads, most of all in
+    competitive mode; without a tie-break the first one in file order won.
+    """
+    return (stats['mapped_reads'], stats['avg_identity'], stats['matches'])
+
 def get_cpu_count():
     """Get the number of available CPU cores."""
     try:
@@ -40,25 +73,17 @@ def get_cpu_count():
         logger.warning(f"Could not determine CPU count, using default of 4 cores: {e}")
         return 4
 
-def count_reads(fastq_file):
-    """Count the number of reads in a FASTQ file (handles both .fastq and .fastq.gz)."""
+def count_reads(fastq_file, threads=1, cache_dir=None):
+    """Count the number of reads in a FASTQ file (handles both .fastq and .fastq.gz).
+    
+    The count comes from the file's scan sidecar, so the file is only read
+    again after it changed (see fastq_scan.load_fastq_scan), decompressing
+    with up to threads threads. When the sidecar cannot be written to the
+    cache directory, the file is scanned without it.
+    """
     try:
-        fastq_file = Path(fastq_file)
-        if str(fastq_file).endswith(".gz"):
-            # Compressed file
-            cmd = ["zcat", str(fastq_file)]
-        else:
-            # Uncompressed file
-            cmd = ["cat", str(fastq_file)]
-        
-        # Count lines and divide by 4
-        cat_process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        wc_result = subprocess.run(["wc", "-l"], stdin=cat_process.stdout, capture_output=True, text=True, check=True)
-        cat_process.wait()
-        
-        line_count = int(wc_result.stdout.strip())
-        return line_count // 4  # Divide by 4 as each read has 4 lines
-    except subprocess.CalledProcessError as e:
+        return load_fastq_scan(fastq_file, cache_dir=cache_dir, threads=threads)['reads']
+    except (OSError, subprocess.CalledProcessError) as e:
         logger.error(f"Error counting reads in {fastq_file}: {e}")
         sys.exit(1)
     except Exception as e:
@@ -90,22 +115,14 @@ def setup_directories(output_dir):
     
     return dirs
 
-def download_references(output_dir, genome=1, completeness=90, host=4, metadata=4):
-    """Download Lassa virus references using lassaseq.
-    
-    Args:
-        output_dir: Directory to save references
-        genome: Genome completeness filter (1=complete only, 2=partial, 3=no filter)
-        completeness: Minimum sequence completeness (1-100) when genome=2
-        host: Host filter (1=human, 2=rodent, 3=both, 4=no filter)
-        metadata: Metadata filter (1=known location, 2=known date, 3=both, 4=no filter)
-    """
+def run_lassaseq(download_dir, genome=1, completeness=90, host=4, metadata=4):
+    """Download Lassa virus references with lassaseq into download_dir."""
     logger.info("Downloading Lassa virus references...")
     logger.info(f"Using parameters: genome={genome}, completeness={completeness}%, host={host}, metadata={metadata}")
     
     cmd = [
         'lassaseq',
-        '-o', output_dir,
+        '-o', str(download_dir),
         '--genome', str(genome),
         '--host', str(host),
         '--metadata', str(metadata)
@@ -121,64 +138,566 @@ def download_references(output_dir, genome=1, completeness=90, host=4, metadata=
         logger.error(f"Error downloading references: {e.stderr}")
         sys.exit(1)
 
-def get_reference_info(ref_file):
-    """Extract information from reference FASTA header."""
-    references = []
-    current_ref = None
-    current_seq = []
-    
-    with open(ref_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('>'):
-                # Save previous reference if exists
-                if current_ref:
-                    references.append({
-                        'accession': current_ref['accession'],
-                        'description': current_ref['description'],
-                        'sequence': ''.join(current_seq)
-                    })
-                
-                # Start new reference
-                header = line[1:]
-                fields = header.split()
-                current_ref = {
-                    'accession': fields[0],
-                    'description': ' '.join(fields[1:])
-                }
-                current_seq = []
-            else:
-                current_seq.append(line)
+def fetch_references(work_dir, genome=1, completeness=90, host=4, metadata=4, cache_dir=None, offline=False, version=None, refresh=False):
+    """Get the lassaseq download for a filter combination from the cache, downloading it if needed.
+    
+    Returns:
+        Tuple of (data_dir, temp_dir): the directory with the downloaded files,
+        and a temporary directory to remove once they are used (None when the
+        files are served from the cache)
+    """
+    filters = reference_filters(genome, completeness, host, metadata)
+    
+    if not refresh:
+        cached = find_cached_references(filters, version, cache_dir)
+        if cached:
+            logger.info(f"Using cached references ({format_filters(filters)}, version {cached['version']}) from {cached['dir']}")
+            return cached['dir'] / 'data', None
+    
+    if offline:
+        version_text = f" version {version}" if version else ""
+        logger.error(f"No cached references for {format_filters(filters)}{version_text} and --offline is set; "
+                     f"import a snapshot with 'lassensus cache import --snapshot <file>'")
+        sys.exit(1)
+    
+    # Download into a fresh directory so that only lassaseq output is cached
+    temp_dir = Path(tempfile.mkdtemp(prefix='lassaseq_', dir=work_dir))
+    download_dir = temp_dir / 'data'
+    download_dir.mkdir()
+    try:
+        run_lassaseq(download_dir, genome, completeness, host, metadata)
+    except SystemExit:
+        shutil.rmtree(temp_dir)
+        raise
+    
+    if version is None:
+        version = datetime.now().strftime('%Y-%m-%d')
+    try:
+        cached = store_references(download_dir, filters, version, cache_dir)
+        logger.info(f"Cached references as version {version} in {cached.parent}")
+        shutil.rmtree(temp_dir)
+        return cached, None
+    except OSError as e:
+        logger.warning(f"Could not cache downloaded references: {e}")
+        return download_dir, temp_dir
+
+def download_references(output_dir, genome=1, completeness=90, host=4, metadata=4, cache_dir=None, offline=False, version=None, refresh=False, local_filter=False):
+    """Download Lassa virus references using lassaseq, reusing cached downloads.
+    
+    Downloads are cached per filter combination and dataset version (see
+    cache.store_references), so lassaseq only runs when no cached download
+    matches or a refresh is requested.
+    
+    Args:
+        output_dir: Directory to save references
+        genome: Genome completeness filter (1=complete only, 2=partial, 3=no filter)
+        completeness: Minimum sequence completeness (1-100) when genome=2
+        host: Host filter (1=human, 2=rodent, 3=both, 4=no filter)
+        metadata: Metadata filter (1=known location, 2=known date, 3=both, 4=no filter)
+        cache_dir: Cache directory (see cache.get_cache_dir)
+        offline: Never run lassaseq; fail if no cached download matches
+        version: Dataset version label; defaults to the newest cached version,
+            or today's date for a new download
+        refresh: Download again even if a cached download matches
+        local_filter: Download the unfiltered database once and apply the
+            filters locally with a metadata index (see reference_index)
+    """
+    # Remember the current reference set to report what the update changes
+    fasta_dir = Path(output_dir) / 'FASTA'
+    previous = sequence_hashes(fasta_dir)
+    
+    if local_filter:
+        # One unfiltered download serves every filter combination
+        data_dir, temp_dir = fetch_references(output_dir, 3, completeness, 4, 4, cache_dir, offline, version, refresh)
+        records = select_references(data_dir, genome, completeness, host, metadata)
+        write_reference_subset(data_dir, records, output_dir)
+    else:
+        data_dir, temp_dir = fetch_references(output_dir, genome, completeness, host, metadata, cache_dir, offline, version, refresh)
+        materialize_references(data_dir, output_dir)
+    
+    if temp_dir:
+        shutil.rmtree(temp_dir)
     
-    # Add the last reference
-    if current_ref:
-        references.append({
-            'accession': current_ref['accession'],
-            'description': current_ref['description'],
-            'sequence': ''.join(current_seq)
-        })
+    if previous:
+        changes = diff_reference_sets(previous, sequence_hashes(fasta_dir))
+        changes['date'] = datetime.now().isoformat(timespec='seconds')
+        with open(Path(output_dir) / 'reference_changes.json', 'w') as f:
+            json.dump(changes, f, indent=2)
+        logger.info(f"Reference update: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+                    f"{len(changes['removed'])} removed, {changes['unchanged']} unchanged")
+
+def get_reference_info(ref_file):
+    """Get the accession, description and sequence of every reference in a FASTA file.
     
-    return references
+    References are read from the reference store of the FASTA directory
+    (see reference_store), so the FASTA text is only parsed once per download.
+    """
+    fasta_dir = Path(ref_file).parent.parent
+    references, _, sequences = load_reference_store(fasta_dir)
+    return [
+        {
+            'accession': entry['accession'],
+            'description': entry['description'],
+            'sequence': read_sequence(sequences, entry)
+        }
+        for entry in references if entry['file'] == str(ref_file)
+    ]
 
 def get_reference_files(references_dir):
     """Get all reference files from segment-specific directories."""
-    reference_files = []
-    fasta_dir = os.path.join(references_dir, 'FASTA')
-    
-    # Look in L and S segment directories
-    for segment in ['L_segment', 'S_segment']:
-        segment_dir = os.path.join(fasta_dir, segment)
-        if os.path.exists(segment_dir):
-            for ext in ['*.fasta', '*.fa']:
-                for ref_file in Path(segment_dir).glob(ext):
-                    references = get_reference_info(ref_file)
-                    for ref in references:
-                        reference_files.append((ref_file, ref))
-    
-    return reference_files
-
-def find_best_reference(sample_fastq, references_dir, output_dir):
-    """Find the best matching reference for a sample using minimap2."""
+    references, _, sequences = load_reference_store(os.path.join(references_dir, 'FASTA'))
+    
+    return [
+        (
+            Path(entry['file']),
+            {
+                'accession': entry['accession'],
+                'description': entry['description'],
+                'sequence': read_sequence(sequences, entry)
+            }
+        )
+        for entry in references
+    ]
+
+def get_segment(ref_file):
+    """Determine the segment (L or S) of a reference from its file path."""
+    return 'L' if 'L_segment' in str(ref_file) else 'S'
+
+def prescreen_references(reference_files, sample_fastq, top_k):
+    """Keep only the top_k references per segment with the highest k-mer containment in the reads.
+    
+    Returns the filtered list of (ref_file, ref_info) tuples in the original order.
+    """
+    scores = containment_scores(reference_files, sample_fastq)
+    
+    # Rank references within each segment
+    ranked = {'L': [], 'S': []}
+    for i, ((ref_file, ref_info), score) in enumerate(zip(reference_files, scores)):
+        ranked[get_segment(ref_file)].append((score, i))
+    
+    keep = set()
+    for segment in ['L', 'S']:
+        if not ranked[segment]:
+            continue
+        ranked[segment].sort(key=lambda item: (-item[0], item[1]))
+        top = ranked[segment][:top_k]
+        keep.update(i for _, i in top)
+        logger.info(f"Pre-screen kept {len(top)} of {len(ranked[segment])} {segment}-segment references "
+                    f"(k-mer containment {top[-1][0]:.3f}-{top[0][0]:.3f})")
+    
+    return [ref for i, ref in enumerate(reference_files) if i in keep]
+
+def evaluate_reference(ref_file, ref_info, sample_fastq, temp_dir, threads, cache_dir=None, read_scores_dir=None):
+    """Map reads to a single reference and return its mapping statistics (None on failure).
+    
+    With read_scores_dir, the best alignment score and identity of every read
+    are saved there for the read x reference score matrix.
+    """
+    # Create temporary FASTA with just this reference
+    temp_fasta = temp_dir / f"temp_{ref_info['accession']}.fasta"
+    with open(temp_fasta, 'w') as f:
+        f.write(f">{ref_info['accession']} {ref_info['description']}\n")
+        f.write(ref_info['sequence'] + "\n")
+    
+    # Reuse the cached minimap2 index for this reference
+    index_file = get_index(temp_fasta, cache_dir=cache_dir)
+    
+    # Run minimap2
+    minimap_cmd = [
+        'minimap2',
+        '-c',  # PAF output with base-level alignment
+        '-x', 'map-ont',  # Nanopore preset
+        '-t', str(threads), # Threads for this alignment
+        str(index_file),
+        str(sample_fastq)
+    ]
+    
+    try:
+        # Calculate mapping statistics directly from the minimap2 output stream
+        read_scores = [] if read_scores_dir else None
+        stats = calculate_mapping_stats(run_minimap2(minimap_cmd), read_scores=read_scores)
+        stats.update(ref_info)  # Add reference info to stats
+        if read_scores_dir:
+            save_read_score_part(Path(read_scores_dir) / f"{ref_info['accession']}.npz", read_scores)
+        return stats
+        
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"Error aligning to {ref_info['accession']}: {e.stderr}")
+        return None
+        
+    finally:
+        # Clean up temporary files
+        os.remove(temp_fasta)
+
+def evaluate_references(reference_files, sample_fastq, temp_dir, threads, cache_dir=None, workers=1, read_scores_dir=None):
+    """Map reads to each reference individually and return (ref_file, ref_info, stats) tuples.
+    
+    With workers > 1 the alignments run concurrently in a process pool, each
+    minimap2 getting threads // workers threads so the total stays within the
+    thread budget. Results are returned in the order of reference_files.
+    """
+    workers = max(1, min(workers, len(reference_files)))
+    threads_per_alignment = max(1, threads // workers)
+    
+    if workers == 1:
+        all_stats = [
+            evaluate_reference(ref_file, ref_info, sample_fastq, temp_dir, threads_per_alignment, cache_dir, read_scores_dir)
+            for ref_file, ref_info in reference_files
+        ]
+    else:
+        logger.info(f"Evaluating {len(reference_files)} references with {workers} workers x {threads_per_alignment} threads")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(evaluate_reference, ref_file, ref_info, sample_fastq, temp_dir, threads_per_alignment, cache_dir, read_scores_dir)
+                for ref_file, ref_info in reference_files
+            ]
+            all_stats = [future.result() for future in futures]
+    
+    return [
+        (ref_file, ref_info, stats)
+        for (ref_file, ref_info), stats in zip(reference_files, all_stats)
+        if stats is not None
+    ]
+
+def evaluate_segment_competitive(segment, segment_refs, sample_fastq, temp_dir, threads, cache_dir=None, read_scores_dir=None):
+    """Map reads once against all references of one segment and return (ref_file, ref_info, stats) tuples."""
+    results = []
+    
+    # Create temporary multi-FASTA with all references of this segment
+    temp_fasta = temp_dir / f"temp_{segment}_references.fasta"
+    with open(temp_fasta, 'w') as f:
+        for ref_file, ref_info in segment_refs:
+            f.write(f">{ref_info['accession']} {ref_info['description']}\n")
+            f.write(ref_info['sequence'] + "\n")
+    
+    # Reuse the cached minimap2 index for this reference set
+    index_file = get_index(temp_fasta, cache_dir=cache_dir)
+    
+    # Run minimap2 once, keeping secondary alignments to every reference
+    minimap_cmd = [
+        'minimap2',
+        '-c',  # PAF output with base-level alignment
+        '-x', 'map-ont',  # Nanopore preset
+        '--secondary=yes',  # Report secondary alignments
+        '-N', str(len(segment_refs)),  # Allow a secondary alignment to every reference
+        '-p', '0',  # Do not drop secondary alignments with low scores
+        '-f', str(COMPETITIVE_OCCURRENCE * len(segment_refs)),  # Keep minimizers shared by all references
+        '-t', str(threads),
+        str(index_file),
+        str(sample_fastq)
+    ]
+    
+    logger.info(f"Mapping reads once against {len(segment_refs)} {segment}-segment references")
+    
+    try:
+        # Calculate mapping statistics for every reference from the single alignment stream
+        read_scores = [] if read_scores_dir else None
+        stats_by_reference = calculate_mapping_stats_by_reference(run_minimap2(minimap_cmd), read_scores=read_scores)
+        if read_scores_dir:
+            save_read_score_part(Path(read_scores_dir) / f"{segment}_segment.npz", read_scores)
+        for ref_file, ref_info in segment_refs:
+            stats = stats_by_reference.get(ref_info['accession'], format_mapping_stats(empty_totals(len(ref_info['sequence']))))
+            stats.update(ref_info)  # Add reference info to stats
+            results.append((ref_file, ref_info, stats))
+        
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"Error aligning to {segment}-segment references: {e.stderr}")
+    
+    os.remove(temp_fasta)
+    
+    return results
+
+def evaluate_references_competitive(reference_files, sample_fastq, temp_dir, threads, cache_dir=None, workers=1, read_scores_dir=None):
+    """Map reads once per segment against all references and return (ref_file, ref_info, stats) tuples.
+    
+    All references of a segment are combined into a single multi-sequence target and
+    secondary alignments are retained for every reference, so the per-reference
+    statistics are derived from one alignment stream instead of one minimap2 run
+    per reference. With workers > 1 the L and S segments are mapped concurrently,
+    splitting the thread budget between them.
+    """
+    segments = []
+    for segment in ['L', 'S']:
+        segment_refs = [(ref_file, ref_info) for ref_file, ref_info in reference_files if get_segment(ref_file) == segment]
+        if segment_refs:
+            segments.append((segment, segment_refs))
+    
+    workers = max(1, min(workers, len(segments)))
+    threads_per_alignment = max(1, threads // workers)
+    
+    if workers == 1:
+        segment_results = [
+            evaluate_segment_competitive(segment, segment_refs, sample_fastq, temp_dir, threads_per_alignment, cache_dir, read_scores_dir)
+            for segment, segment_refs in segments
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(evaluate_segment_competitive, segment, segment_refs, sample_fastq, temp_dir, threads_per_alignment, cache_dir, read_scores_dir)
+                for segment, segment_refs in segments
+            ]
+            segment_results = [future.result() for future in futures]
+    
+    return [result for results in segment_results for result in results]
+
+def evaluate_candidates(reference_files, sample_fastq, temp_dir, threads, selection_mode='per-reference', cache_dir=None, workers=1, score_cache=True, read_scores_dir=None):
+    """Evaluate a set of candidate references with the requested selection mode.
+    
+    With score_cache, statistics are looked up in a table keyed by the hash of
+    the reads and the aligner parameters (see cache.get_score_table_file), and
+    only references missing from it are aligned. Competitive scores depend on
+    all references of a segment, so there the hash of the segment's reference
+    set is part of the key and a segment is aligned again if any reference misses.
+    
+    With read_scores_dir, per-read scores are needed, so every candidate is
+    aligned and the cache is only updated.
+    """
+    if not score_cache:
+        return run_evaluation(reference_files, sample_fastq, temp_dir, threads, selection_mode, cache_dir, workers, read_scores_dir)
+    
+    parameters = {
+        'aligner': 'minimap2',
+        'version': get_minimap2_version(),
+        'options': '-c -x map-ont' + (f' -f {COMPETITIVE_OCCURRENCE}/reference' if selection_mode == 'competitive' else ''),
+        'selection_mode': selection_mode
+    }
+    table_file = get_score_table_file(hash_reads(sample_fastq, threads), parameters, cache_dir)
+    table = load_score_table(table_file)
+    
+    # Key every candidate by its sequence, and by its segment's reference set when competing
+    keys = [sequence_hash(ref_info['sequence']) for ref_file, ref_info in reference_files]
+    if selection_mode == 'competitive':
+        set_hashes = {}
+        for segment in ['L', 'S']:
+            segment_keys = sorted(key for key, (ref_file, ref_info) in zip(keys, reference_files) if get_segment(ref_file) == segment)
+            set_hashes[segment] = sequence_hash(''.join(segment_keys))
+        keys = [f"{set_hashes[get_segment(ref_file)]}:{key}" for key, (ref_file, ref_info) in zip(keys, reference_files)]
+    
+    misses = [i for i, key in enumerate(keys) if key not in table or read_scores_dir]
+    if selection_mode == 'competitive':
+        missing_segments = {get_segment(reference_files[i][0]) for i in misses}
+        misses = [i for i, (ref_file, ref_info) in enumerate(reference_files) if get_segment(ref_file) in missing_segments]
+    logger.info(f"Score cache: {len(reference_files) - len(misses)} hits, {len(misses)} misses")
+    
+    if misses:
+        index_of = {(str(reference_files[i][0]), reference_files[i][1]['accession']): i for i in misses}
+        for ref_file, ref_info, stats in run_evaluation([reference_files[i] for i in misses], sample_fastq, temp_dir, threads,
+                                                        selection_mode, cache_dir, workers, read_scores_dir):
+            index = index_of[(str(ref_file), ref_info['accession'])]
+            table[keys[index]] = {key: value for key, value in stats.items() if key not in ref_info}
+        save_score_table(table_file, table)
+    
+    results = []
+    for key, (ref_file, ref_info) in zip(keys, reference_files):
+        if key in table:
+            stats = dict(table[key])
+            stats.update(ref_info)  # Add reference info to stats
+            results.append((ref_file, ref_info, stats))
+    return results
+
+def run_evaluation(reference_files, sample_fastq, temp_dir, threads, selection_mode='per-reference', cache_dir=None, workers=1, read_scores_dir=None):
+    """Align the reads to a set of references with the requested selection mode."""
+    if selection_mode == 'competitive':
+        return evaluate_references_competitive(reference_files, sample_fastq, temp_dir, threads, cache_dir, workers, read_scores_dir)
+    return evaluate_references(reference_files, sample_fastq, temp_dir, threads, cache_dir, workers, read_scores_dir)
+
+def evaluate_by_cluster(reference_files, clusters, sample_fastq, temp_dir, threads, selection_mode='per-reference', cache_dir=None, workers=1, score_cache=True):
+    """Evaluate cluster representatives first, then the members of each segment's winning cluster.
+    
+    Identical sequences are aligned only once; their duplicates receive a copy of the
+    statistics. Results are returned in the order of reference_files.
+    """
+    cluster_of = {accession: i for i, cluster in enumerate(clusters) for accession in cluster}
+    representative_of = {i: cluster[0] for i, cluster in enumerate(clusters)}
+    
+    # Collapse identical sequences among the candidates
+    first_with_sequence = {}
+    duplicate_of = {}
+    unique = []
+    for index, (ref_file, ref_info) in enumerate(reference_files):
+        seq_hash = sequence_hash(ref_info['sequence'])
+        if seq_hash in first_with_sequence:
+            duplicate_of[index] = first_with_sequence[seq_hash]
+        else:
+            first_with_sequence[seq_hash] = index
+            unique.append(index)
+    
+    # Pick one representative per cluster, preferring the cluster's own representative
+    cluster_candidates = defaultdict(list)
+    for index in unique:
+        accession = reference_files[index][1]['accession']
+        cluster_candidates[cluster_of.get(accession, accession)].append(index)
+    representatives = []
+    for cluster, members in cluster_candidates.items():
+        preferred = [i for i in members if reference_files[i][1]['accession'] == representative_of.get(cluster)]
+        representatives.append((preferred or members)[0])
+    representatives.sort()
+    
+    logger.info(f"Evaluating {len(representatives)} cluster representatives out of {len(reference_files)} references")
+    stats_by_index = {}
+    rep_results = evaluate_candidates([reference_files[i] for i in representatives], sample_fastq, temp_dir, threads,
+                                      selection_mode, cache_dir, workers, score_cache=score_cache)
+    index_of = {reference_files[i][1]['accession']: i for i in unique}
+    for ref_file, ref_info, stats in rep_results:
+        stats_by_index[index_of[ref_info['accession']]] = stats
+    
+    # Descend into the winning cluster of each segment
+    descend = []
+    for segment in ['L', 'S']:
+        segment_reps = [i for i in representatives if get_segment(reference_files[i][0]) == segment and i in stats_by_index]
+        if not segment_reps:
+            continue
+        winner = max(segment_reps, key=lambda i: (ranking_key(stats_by_index[i]), -i))
+        if stats_by_index[winner]['mapped_reads'] == 0:
+            continue
+        accession = reference_files[winner][1]['accession']
+        members = [i for i in cluster_candidates[cluster_of.get(accession, accession)] if i not in stats_by_index]
+        logger.info(f"Best {segment}-segment cluster representative: {accession}, evaluating {len(members)} more cluster members")
+        descend.extend(members)
+    
+    if descend:
+        member_results = evaluate_candidates([reference_files[i] for i in sorted(descend)], sample_fastq, temp_dir, threads,
+                                             selection_mode, cache_dir, workers, score_cache=score_cache)
+        for ref_file, ref_info, stats in member_results:
+            stats_by_index[index_of[ref_info['accession']]] = stats
+    
+    # Identical sequences share the statistics of the evaluated copy
+    for index, original in duplicate_of.items():
+        if original in stats_by_index:
+            stats = dict(stats_by_index[original])
+            stats.update(reference_files[index][1])
+            stats_by_index[index] = stats
+    
+    return [(reference_files[i][0], reference_files[i][1], stats_by_index[i]) for i in sorted(stats_by_index)]
+
+def write_read_subset(sample_fastq, subset_fastq, n_reads, total_reads, seed=DEFAULT_SEED):
+    """Write a random subset of n_reads of the total_reads reads of a FASTQ file and return the number written.
+    
+    The rarefied reads are in file order, so a prefix would favour the reads
+    sequenced first. Reads are instead ranked by a seeded random permutation
+    and those ranked below n_reads are kept, so the subsets of successive
+    tournament rounds are nested.
+    """
+    keep = np.random.default_rng(seed).permutation(total_reads) < n_reads
+    written = 0
+    with open_text(sample_fastq) as f_in, open(subset_fastq, 'w') as f_out:
+        for i, line in enumerate(f_in):
+            if keep[i // 4]:
+                f_out.write(line)
+                if i % 4 == 3:
+                    written += 1
+    return written
+
+def mapping_margin(leader, runner_up):
+    """Compare the mapped reads of the leader and runner-up of a round.
+    
+    The z-score treats both counts as Poisson and tests their difference,
+    (a - b) / sqrt(a + b); values above ~3 mean the lead is unlikely to be noise.
+    """
+    a = leader['mapped_reads']
+    b = runner_up['mapped_reads'] if runner_up else 0
+    return {
+        'leader': leader['accession'],
+        'runner_up': runner_up['accession'] if runner_up else None,
+        'margin': a - b,
+        'z_score': round((a - b) / (a + b) ** 0.5, 2) if a + b > 0 else 0.0
+    }
+
+def evaluate_tournament(reference_files, sample_fastq, temp_dir, threads, start_reads, selection_mode='per-reference', cache_dir=None, workers=1, score_cache=True):
+    """Evaluate references in a successive-halving tournament.
+    
+    All references are first scored on start_reads reads. After each round the
+    better half of every segment advances and the number of reads is doubled,
+    until the remaining references (at least the top two per segment) are
+    scored on all reads in a final round.
+    
+    Returns:
+        Tuple of (results, final_results, rounds): results holds the latest
+        statistics of every reference in the order of reference_files,
+        final_results only those of the full-depth round, and rounds the
+        per-segment leader and margin over the runner-up of every round
+    """
+    total_reads = sum(1 for _ in open_text(sample_fastq)) // 4
+    candidates = list(range(len(reference_files)))
+    stats_by_index = {}
+    rounds = {'L': [], 'S': []}
+    n_reads = start_reads
+    
+    while True:
+        # Go to full depth once the subset would hold all reads or only the last two references of each segment are left
+        segment_sizes = [sum(1 for i in candidates if get_segment(reference_files[i][0]) == segment) for segment in ['L', 'S']]
+        final = n_reads >= total_reads or max(segment_sizes) <= 2
+        if final:
+            round_fastq = sample_fastq
+            n_reads = total_reads
+        else:
+            round_fastq = temp_dir / f"tournament_{n_reads}_reads.fastq"
+            write_read_subset(sample_fastq, round_fastq, n_reads, total_reads)
+        
+        logger.info(f"Tournament round on {n_reads:,} reads: {len(candidates)} references")
+        round_results = evaluate_candidates([reference_files[i] for i in candidates], round_fastq, temp_dir, threads,
+                                            selection_mode, cache_dir, workers, score_cache=score_cache)
+        index_of = {(str(reference_files[i][0]), reference_files[i][1]['accession']): i for i in candidates}
+        round_stats = {}
+        for ref_file, ref_info, stats in round_results:
+            stats['tournament_reads'] = n_reads
+            round_stats[index_of[(str(ref_file), ref_info['accession'])]] = stats
+        stats_by_index.update(round_stats)
+        
+        # Rank every segment and keep the better half, but at least two references to
+        # measure the winner's margin over the runner-up in the final round
+        advancing = []
+        for segment in ['L', 'S']:
+            ranked = sorted((i for i in round_stats if get_segment(reference_files[i][0]) == segment),
+                            key=lambda i: (tuple(-value for value in ranking_key(round_stats[i])), i))
+            if not ranked:
+                continue
+            result = mapping_margin(round_stats[ranked[0]], round_stats[ranked[1]] if len(ranked) > 1 else None)
+            result.update({'reads': n_reads, 'references': len(ranked)})
+            rounds[segment].append(result)
+            advancing.extend(ranked[:max(2, (len(ranked) + 1) // 2)])
+        
+        if final:
+            break
+        
+        os.remove(round_fastq)
+        candidates = sorted(advancing)
+        n_reads *= 2
+    
+    results = [(reference_files[i][0], reference_files[i][1], stats_by_index[i]) for i in sorted(stats_by_index)]
+    final_results = [(reference_files[i][0], reference_files[i][1], round_stats[i]) for i in sorted(round_stats)]
+    return results, final_results, rounds
+
+def find_best_reference(sample_fastq, references_dir, output_dir, selection_mode='per-reference', cache_dir=None, prescreen_top_k=0, cluster_identity=0, threads=None, workers=1, tournament_reads=0, previous_stats=None, score_cache=True, read_scores_file=None):
+    """Find the best matching reference for a sample using minimap2.
+    
+    Args:
+        sample_fastq: Rarefied FASTQ file of the sample
+        references_dir: Directory containing the downloaded references
+        output_dir: Directory for temporary reference files
+        selection_mode: 'per-reference' maps to every reference separately,
+            'competitive' maps once per segment against all references
+        cache_dir: Directory for cached minimap2 indexes
+        prescreen_top_k: If > 0, only align to the top-k references per segment
+            ranked by k-mer containment in the reads
+        cluster_identity: If > 0, cluster references at this identity (percent),
+            evaluate cluster representatives first and then only the members of
+            the winning cluster
+        threads: Total number of threads for alignment (default: all but one core)
+        workers: Number of alignments run concurrently within the thread budget
+        tournament_reads: If > 0, run a successive-halving tournament starting
+            with this many reads (see evaluate_tournament) instead of aligning
+            all reads to every reference
+        score_cache: Reuse and store per-reference statistics in the score
+            cache (see evaluate_candidates)
+        previous_stats: Statistics of an earlier run on the same reads by
+            accession (see load_previous_stats); references with an unchanged
+            sequence reuse them and only added or changed references are aligned
+        read_scores_file: If given, save the best alignment score and identity
+            of every read to every reference as a sparse matrix (see
+            read_scores.save_read_scores); not available with tournaments,
+            clustering or incremental updates
+    """
     logger.info(f"Finding best reference for {sample_fastq}")
     
     # Get all reference files with their info
@@ -190,115 +709,364 @@ def find_best_reference(sample_fastq, references_dir, output_dir):
     
     logger.info(f"Found {len(reference_files)} reference sequences")
     
-    # Get number of CPU cores to use
-    threads = get_cpu_count()
+    # The incremental update only aligns added or changed references, so
+    # options that decide which references are scored, or need all of them
+    # scored, are not applied there
+    if previous_stats:
+        skipped = [option for option, value in [('the k-mer pre-screen', prescreen_top_k), ('clustering', cluster_identity),
+                                                ('the tournament', tournament_reads)] if value]
+        if skipped:
+            logger.warning(f"Incremental update cannot apply {' or '.join(skipped)}; evaluating all references")
+            previous_stats = None
+        elif read_scores_file:
+            logger.warning("Incremental update does not align unchanged references, so no read scores are saved")
+    if previous_stats:
+        return find_best_reference_incremental(reference_files, previous_stats, sample_fastq, output_dir, selection_mode,
+                                               cache_dir, threads, workers, score_cache=score_cache)
     
-    # Track statistics for all references by segment
-    segment_stats = {'L': [], 'S': []}
-    best_refs = {'L': None, 'S': None}
-    best_coverage = {'L': 0, 'S': 0}
-    best_stats = {'L': None, 'S': None}
+    # Cluster the full reference set (cached per download)
+    if cluster_identity > 0 and tournament_reads == 0:
+        clusters = load_reference_clusters(references_dir, reference_files, cluster_identity, get_segment)
+    
+    # Prune candidates with a k-mer sketch pre-screen before aligning
+    if prescreen_top_k > 0:
+        reference_files = prescreen_references(reference_files, sample_fastq, prescreen_top_k)
+    
+    # Get number of CPU cores to use
+    if threads is None:
+        threads = get_cpu_count()
     
     # Create temporary directory for this sample
     sample_name = Path(sample_fastq).stem.split('_rarefied')[0]
     temp_dir = Path(output_dir) / 'references' / 'selection_best_references' / sample_name / 'temp'
     temp_dir.mkdir(parents=True, exist_ok=True)
     
-    for ref_file, ref_info in reference_files:
-        # Determine segment from file path
-        segment = 'L' if 'L_segment' in str(ref_file) else 'S'
+    # Per-read scores are collected in the plain evaluation, where every candidate sees all reads
+    read_scores_dir = None
+    if read_scores_file and tournament_reads == 0 and cluster_identity == 0:
+        read_scores_dir = temp_dir / 'read_scores'
+        read_scores_dir.mkdir(exist_ok=True)
+    
+    if tournament_reads > 0:
+        results, final_results, rounds = evaluate_tournament(reference_files, sample_fastq, temp_dir, threads, tournament_reads,
+                                                             selection_mode, cache_dir, workers, score_cache=score_cache)
+    elif cluster_identity > 0:
+        results = evaluate_by_cluster(reference_files, clusters, sample_fastq, temp_dir, threads, selection_mode, cache_dir, workers, score_cache=score_cache)
+    else:
+        results = evaluate_candidates(reference_files, sample_fastq, temp_dir, threads, selection_mode, cache_dir, workers,
+                                      score_cache=score_cache, read_scores_dir=read_scores_dir)
+    
+    if read_scores_dir:
+        save_read_scores(read_scores_file, *merge_read_score_files(read_scores_dir),
+                         [ref_info['accession'] for ref_file, ref_info in reference_files],
+                         [get_segment(ref_file) for ref_file, ref_info in reference_files])
+    
+    # Clean up temporary directory
+    shutil.rmtree(temp_dir)
+    
+    if tournament_reads > 0:
+        # The winner is decided by the full-depth round; eliminated references keep their earlier statistics
+        best_refs, best_stats, _ = select_best_references(final_results)
+        _, _, segment_stats = select_best_references(results)
+        for segment in ['L', 'S']:
+            if best_stats[segment] and rounds[segment]:
+                best_stats[segment]['tournament'] = {
+                    'margin': rounds[segment][-1]['margin'],
+                    'z_score': rounds[segment][-1]['z_score'],
+                    'runner_up': rounds[segment][-1]['runner_up'],
+                    'rounds': rounds[segment]
+                }
+                logger.info(f"{segment}-segment tournament winner {best_refs[segment]['accession']} leads "
+                            f"{rounds[segment][-1]['runner_up']} by {rounds[segment][-1]['margin']} reads "
+                            f"(z = {rounds[segment][-1]['z_score']})")
+        return best_refs, best_stats, segment_stats
+    
+    return select_best_references(results)
+
+def find_best_reference_incremental(reference_files, previous_stats, sample_fastq, output_dir, selection_mode='per-reference', cache_dir=None, threads=None, workers=1, score_cache=True):
+    """Update an earlier reference selection, aligning only added or changed references.
+    
+    References whose accession and sequence are unchanged since the earlier run
+    keep their statistics; removed references drop out of the results.
+    """
+    reused = {}
+    to_evaluate = []
+    for index, (ref_file, ref_info) in enumerate(reference_files):
+        stats = previous_stats.get(ref_info['accession'])
+        if stats and stats.get('sequence') == ref_info['sequence']:
+            stats = dict(stats)
+            stats.update(ref_info)
+            reused[index] = stats
+        else:
+            to_evaluate.append(index)
+    
+    logger.info(f"Incremental update: reusing scores of {len(reused)} unchanged references, "
+                f"evaluating {len(to_evaluate)} added or changed references")
+    
+    results_by_index = dict(reused)
+    if to_evaluate:
+        if threads is None:
+            threads = get_cpu_count()
+        sample_name = Path(sample_fastq).stem.split('_rarefied')[0]
+        temp_dir = Path(output_dir) / 'references' / 'selection_best_references' / sample_name / 'temp'
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        
+        candidates = [reference_files[i] for i in to_evaluate]
+        index_of = {(str(reference_files[i][0]), reference_files[i][1]['accession']): i for i in to_evaluate}
+        for ref_file, ref_info, stats in evaluate_candidates(candidates, sample_fastq, temp_dir, threads, selection_mode,
+                                                             cache_dir, workers, score_cache=score_cache):
+            results_by_index[index_of[(str(ref_file), ref_info['accession'])]] = stats
         
-        # Create temporary FASTA with just this reference
-        temp_fasta = temp_dir / f"temp_{ref_info['accession']}.fasta"
-        with open(temp_fasta, 'w') as f:
+        shutil.rmtree(temp_dir)
+    
+    return select_best_references([(reference_files[i][0], reference_files[i][1], results_by_index[i]) for i in sorted(results_by_index)])
+
+def load_previous_stats(json_file, selection):
+    """Load the per-reference statistics of an earlier run of a sample.
+    
+    The statistics are only reused when they were computed on the same
+    rarefied reads with the same settings (the 'selection' block saved by
+    save_results) and on all reads rather than in a tournament.
+    
+    Returns:
+        Dictionary mapping accession to its statistics, empty if nothing can be reused
+    """
+    json_file = Path(json_file)
+    if not json_file.exists():
+        logger.warning(f"No earlier results in {json_file}; evaluating all references")
+        return {}
+    try:
+        with open(json_file, 'r') as f:
+            previous = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable earlier results {json_file}: {e}")
+        return {}
+    
+    if selection.get('tournament_reads'):
+        logger.warning("Tournament results only score eliminated references on part of the reads; evaluating all references")
+        return {}
+    previous_selection = previous.get('selection') or {}
+    changed = sorted(key for key in set(selection) | set(previous_selection) if previous_selection.get(key) != selection.get(key))
+    if changed:
+        logger.warning(f"Earlier results in {json_file} were computed with other {', '.join(changed)}; evaluating all references")
+        return {}
+    
+    return {
+        stats['accession']: stats
+        for segment in ['L', 'S']
+        for stats in previous.get('segment_stats', {}).get(segment, [])
+        if 'accession' in stats and 'sequence' in stats
+    }
+
+def select_best_references(results):
+    """Pick the reference with the most mapped reads per segment (see ranking_key).
+    
+    Args:
+        results: List of (ref_file, ref_info, stats) tuples
+    Returns:
+        Tuple of (best_refs, best_stats, segment_stats) dictionaries keyed by segment
+    """
+    # Track statistics for all references by segment
+    segment_stats = {'L': [], 'S': []}
+    best_refs = {'L': None, 'S': None}
+    best_stats = {'L': None, 'S': None}
+    
+    for ref_file, ref_info, stats in results:
+        segment = get_segment(ref_file)
+        segment_stats[segment].append(stats)
+        
+        if stats['mapped_reads'] > 0 and (best_stats[segment] is None or ranking_key(stats) > ranking_key(best_stats[segment])):
+            best_refs[segment] = {
+                'file': str(ref_file),
+                'accession': ref_info['accession'],
+                'description': ref_info['description']
+            }
+            best_stats[segment] = stats
+    
+    return best_refs, best_stats, segment_stats
+
+def write_multiplexed_reads(sample_fastqs, stream):
+    """Write the reads of several samples to a stream, prefixing read names with the sample index."""
+    try:
+        for index, fastq_file in enumerate(sample_fastqs):
+            with open_text(fastq_file) as f:
+                for i, line in enumerate(f):
+                    if i % 4 == 0:
+                        line = f"@{index}{MULTIPLEX_SEPARATOR}{line[1:]}"
+                    stream.write(line)
+    except BrokenPipeError:
+        # minimap2 exited early; its exit status is reported by run_minimap2
+        pass
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+def evaluate_segment_multiplexed(segment, segment_refs, sample_fastqs, temp_dir, threads, cache_dir=None):
+    """Map the reads of all samples in one minimap2 run against all references of one segment.
+    
+    Returns:
+        List with, for every sample in sample_fastqs, a list of (ref_file, ref_info, stats) tuples
+    """
+    results = [[] for _ in sample_fastqs]
+    
+    # Create temporary multi-FASTA with all references of this segment
+    temp_fasta = temp_dir / f"temp_{segment}_references.fasta"
+    with open(temp_fasta, 'w') as f:
+        for ref_file, ref_info in segment_refs:
             f.write(f">{ref_info['accession']} {ref_info['description']}\n")
             f.write(ref_info['sequence'] + "\n")
+    
+    # Reuse the cached minimap2 index for this reference set
+    index_file = get_index(temp_fasta, cache_dir=cache_dir)
+    
+    # Run minimap2 once for all samples, reading the multiplexed reads from stdin
+    minimap_cmd = [
+        'minimap2',
+        '-c',  # PAF output with base-level alignment
+        '-x', 'map-ont',  # Nanopore preset
+        '--secondary=yes',  # Report secondary alignments
+        '-N', str(len(segment_refs)),  # Allow a secondary alignment to every reference
+        '-p', '0',  # Do not drop secondary alignments with low scores
+        '-f', str(COMPETITIVE_OCCURRENCE * len(segment_refs)),  # Keep minimizers shared by all references
+        '-t', str(threads),
+        str(index_file),
+        '-'
+    ]
+    
+    logger.info(f"Mapping reads of {len(sample_fastqs)} samples once against {len(segment_refs)} {segment}-segment references")
+    
+    try:
+        # Demultiplex the single alignment stream into per-sample statistics
+        stats_by_sample = calculate_mapping_stats_by_sample(
+            run_minimap2(minimap_cmd, write_input=lambda stream: write_multiplexed_reads(sample_fastqs, stream))
+        )
+        for index in range(len(sample_fastqs)):
+            stats_by_reference = stats_by_sample.get(str(index), {})
+            for ref_file, ref_info in segment_refs:
+                stats = stats_by_reference.get(ref_info['accession'], format_mapping_stats(empty_totals(len(ref_info['sequence']))))
+                stats.update(ref_info)  # Add reference info to stats
+                results[index].append((ref_file, ref_info, stats))
         
-        # Run minimap2
-        output_sam = temp_dir / f"{Path(sample_fastq).stem}_{ref_info['accession']}.sam"
-        minimap_cmd = [
-            'minimap2',
-            '-ax', 'map-ont',  # Nanopore preset
-            '-t', str(threads), # Use available CPU cores
-            str(temp_fasta),
-            str(sample_fastq)
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"Error aligning to {segment}-segment references: {e.stderr}")
+    
+    os.remove(temp_fasta)
+    
+    return results
+
+def find_best_references_batch(rarefied_files, references_dir, output_dir, cache_dir=None, prescreen_top_k=0, threads=None, workers=1):
+    """Find the best matching references for all samples with one minimap2 run per segment.
+    
+    The rarefied reads of all samples are streamed into a single competitive
+    alignment per segment with the sample index carried in the read name, and
+    the statistics are demultiplexed into per-sample reference tables.
+    
+    Args:
+        rarefied_files: Dictionary mapping sample name to its rarefaction info
+        references_dir: Directory containing the downloaded references
+        output_dir: Directory for pipeline output
+        cache_dir: Directory for cached minimap2 indexes
+        prescreen_top_k: If > 0, only align to the union of every sample's
+            top-k references per segment ranked by k-mer containment
+        threads: Total number of threads for alignment (default: all but one core)
+        workers: Number of segments mapped concurrently within the thread budget
+    Returns:
+        Dictionary mapping sample name to (best_refs, best_stats, segment_stats)
+    """
+    samples = list(rarefied_files)
+    sample_fastqs = [rarefied_files[sample]['rarefied_file'] for sample in samples]
+    logger.info(f"Finding best references for {len(samples)} samples in one batch")
+    
+    # Get all reference files with their info
+    reference_files = get_reference_files(references_dir)
+    
+    if not reference_files:
+        logger.error(f"No reference files found in {references_dir}")
+        sys.exit(1)
+    
+    logger.info(f"Found {len(reference_files)} reference sequences")
+    
+    # Keep the union of the pre-screened candidates of all samples
+    if prescreen_top_k > 0:
+        keep = set()
+        for sample_fastq in sample_fastqs:
+            for ref_file, ref_info in prescreen_references(reference_files, sample_fastq, prescreen_top_k):
+                keep.add((str(ref_file), ref_info['accession']))
+        reference_files = [(ref_file, ref_info) for ref_file, ref_info in reference_files if (str(ref_file), ref_info['accession']) in keep]
+        logger.info(f"Pre-screen kept {len(reference_files)} references across all samples")
+    
+    # Get number of CPU cores to use
+    if threads is None:
+        threads = get_cpu_count()
+    
+    temp_dir = Path(output_dir) / 'references' / 'selection_best_references' / 'batch_temp'
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    
+    segments = []
+    for segment in ['L', 'S']:
+        segment_refs = [(ref_file, ref_info) for ref_file, ref_info in reference_files if get_segment(ref_file) == segment]
+        if segment_refs:
+            segments.append((segment, segment_refs))
+    
+    workers = max(1, min(workers, len(segments)))
+    threads_per_alignment = max(1, threads // workers)
+    
+    if workers == 1:
+        segment_results = [
+            evaluate_segment_multiplexed(segment, segment_refs, sample_fastqs, temp_dir, threads_per_alignment, cache_dir)
+            for segment, segment_refs in segments
         ]
-        
-        try:
-            with open(output_sam, 'w') as f:
-                subprocess.run(minimap_cmd, check=True, stdout=f, stderr=subprocess.PIPE, text=True)
-            
-            # Calculate mapping statistics
-            stats = calculate_mapping_stats(output_sam)
-            stats.update(ref_info)  # Add reference info to stats
-            
-            segment_stats[segment].append(stats)
-            
-            if stats['mapped_reads'] > best_coverage[segment]:
-                best_coverage[segment] = stats['mapped_reads']
-                best_refs[segment] = {
-                    'file': str(ref_file),
-                    'accession': ref_info['accession'],
-                    'description': ref_info['description']
-                }
-                best_stats[segment] = stats
-            
-            # Clean up temporary files
-            os.remove(temp_fasta)
-            os.remove(output_sam)
-            
-        except subprocess.CalledProcessError as e:
-            logger.warning(f"Error aligning to {ref_info['accession']}: {e.stderr}")
-            os.remove(temp_fasta)
-            continue
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(evaluate_segment_multiplexed, segment, segment_refs, sample_fastqs, temp_dir, threads_per_alignment, cache_dir)
+                for segment, segment_refs in segments
+            ]
+            segment_results = [future.result() for future in futures]
     
     # Clean up temporary directory
     shutil.rmtree(temp_dir)
     
-    return best_refs, best_stats, segment_stats
+    return {
+        sample: select_best_references([result for results in segment_results for result in results[index]])
+        for index, sample in enumerate(samples)
+    }
 
-def calculate_mapping_stats(sam_file):
-    """Calculate mapping statistics from SAM file."""
-    mapped_reads = 0
-    total_length = 0
-    total_matches = 0
+def run_minimap2(minimap_cmd, write_input=None):
+    """Run minimap2 and yield its output lines as they are produced.
     
-    with open(sam_file, 'r') as f:
-        for line in f:
-            if line.startswith('@'):
-                continue
-            
-            fields = line.strip().split('\t')
-            if len(fields) < 11:
-                continue
-                
-            flag = int(fields[1])
-            if flag & 0x4:  # unmapped
-                continue
-                
-            mapped_reads += 1
-            
-            # Parse CIGAR string for alignment statistics
-            cigar = fields[5]
-            matches = sum(int(n) for n in ''.join(c if c.isdigit() else ' ' for c in cigar).split())
-            total_length += matches
-            
-            # Calculate identity from optional NM field
-            for field in fields[11:]:
-                if field.startswith('NM:i:'):
-                    nm = int(field.split(':')[2])
-                    total_matches += matches - nm
-                    break
-    
-    stats = {
-        'mapped_reads': mapped_reads,
-        'coverage': total_length / 1000,  # Approximate coverage
-        'avg_identity': (total_matches / total_length * 100) if total_length > 0 else 0
-    }
+    Nothing is written to disk except minimap2's log messages, which are kept
+    in an anonymous temporary file and attached to the CalledProcessError that
+    is raised when minimap2 exits with an error.
     
-    return stats
+    Args:
+        minimap_cmd: minimap2 command line
+        write_input: Optional function writing the query reads to minimap2's
+            stdin (use '-' as query file); it runs in a separate thread
+    """
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(minimap_cmd, stdin=subprocess.PIPE if write_input else None,
+                                   stdout=subprocess.PIPE, stderr=stderr, text=True)
+        feeder = None
+        if write_input:
+            feeder = threading.Thread(target=write_input, args=(process.stdin,), daemon=True)
+            feeder.start()
+        try:
+            for line in process.stdout:
+                yield line
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+            if feeder:
+                feeder.join()
+        
+        if returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(returncode, minimap_cmd, stderr=stderr.read().decode(errors='replace'))
 
-def rarefy_all_samples(samples, input_dir, output_dir, n_reads=10000):
+def rarefy_all_samples(samples, input_dir, output_dir, n_reads=RAREFIED_READS, threads=1, compression=DEFAULT_COMPRESSION, level=DEFAULT_LEVEL, cache_dir=None):
     """Rarefy all samples to specified number of reads."""
     logger.info(f"\nRarefying all samples to {n_reads:,} reads...")
     rarefied_files = {}
@@ -315,7 +1083,7 @@ def rarefy_all_samples(samples, input_dir, output_dir, n_reads=10000):
         if input_file is None:
             logger.error(f"Could not find input file for {sample} (looked for .fastq and .fastq.gz)")
             continue
-        total_reads = count_reads(input_file)
+        total_reads = count_reads(input_file, threads, cache_dir)
         logger.info(f"\nProcessing {sample}:")
         logger.info(f"Total reads: {total_reads:,}")
         
@@ -324,8 +1092,8 @@ def rarefy_all_samples(samples, input_dir, output_dir, n_reads=10000):
         sample_dir.mkdir(parents=True, exist_ok=True)
         
         # Create rarefied FASTQ
-        rarefied_file = sample_dir / f"{sample}_rarefied.fastq.gz"
-        rarefy_reads(input_file, rarefied_file, n_reads)
+        rarefied_file = sample_dir / f"{sample}_rarefied{fastq_suffix(compression)}"
+        rarefy_reads(input_file, rarefied_file, n_reads, threads, compression, level, cache_dir)
         logger.info(f"Created rarefied FASTQ with {n_reads:,} reads")
         
         rarefied_files[sample] = {
@@ -335,43 +1103,97 @@ def rarefy_all_samples(samples, input_dir, output_dir, n_reads=10000):
     
     return rarefied_files
 
-def process_sample(sample, rarefied_info, references_dir, output_dir, min_identity):
+def process_sample(sample, rarefied_info, references_dir, output_dir, min_identity, selection_mode='per-reference', cache_dir=None, prescreen_top_k=0, cluster_identity=0, threads=None, workers=1, tournament_reads=0, incremental=False, score_cache=True, read_scores=False, bootstrap=0):
     """Process a single sample to find the best reference."""
     logger.info(f"\nProcessing sample: {sample}")
     
+    # Settings that determine which references are scored and their
+    # statistics, saved to validate incremental updates
+    selection = {
+        'selection_mode': selection_mode,
+        'rarefied_hash': hash_reads(rarefied_info['rarefied_file']),
+        'tournament_reads': tournament_reads,
+        'prescreen_top_k': prescreen_top_k,
+        'cluster_identity': cluster_identity,
+        'read_scores': read_scores,
+        'min_identity': min_identity
+    }
+    previous_stats = None
+    if incremental:
+        json_file = Path(output_dir) / 'references' / 'selection_best_references' / sample / f"{sample}_reference_selection.json"
+        previous_stats = load_previous_stats(json_file, selection)
+    
+    read_scores_file = None
+    if read_scores:
+        read_scores_file = Path(output_dir) / 'references' / 'selection_best_references' / sample / f"{sample}_read_scores.npz"
+        read_scores_file.parent.mkdir(parents=True, exist_ok=True)
+        if read_scores_file.exists():
+            os.remove(read_scores_file)
+    
     # Map rarefied reads to references
     best_refs, best_stats, segment_stats = find_best_reference(
         rarefied_info['rarefied_file'],
         references_dir,
-        output_dir / sample
+        output_dir / sample,
+        selection_mode=selection_mode,
+        cache_dir=cache_dir,
+        prescreen_top_k=prescreen_top_k,
+        cluster_identity=cluster_identity,
+        threads=threads,
+        workers=workers,
+        tournament_reads=tournament_reads,
+        previous_stats=previous_stats,
+        score_cache=score_cache,
+        read_scores_file=read_scores_file
     )
     
+    # Add the criteria derived from the per-read scores, applying the identity threshold
+    if read_scores_file and read_scores_file.exists():
+        matrix = load_read_scores(read_scores_file)
+        summary = summarize_read_scores(matrix, min_identity)
+        for segment in ['L', 'S']:
+            for stats in segment_stats[segment]:
+                stats.update(summary.get(stats['accession'], {}))
+        
+        # Resample the reads to estimate how stable the best-reference call is
+        if bootstrap > 0:
+            confidence = bootstrap_confidence(matrix, n_resamples=bootstrap)
+            for segment, result in confidence.items():
+                if best_stats[segment] and best_stats[segment]['accession'] == result['best_reference']:
+                    best_stats[segment]['bootstrap'] = result
+                    logger.info(f"{segment}-segment reference {result['best_reference']} wins {result['confidence']:.1%} of "
+                                f"{bootstrap} bootstrap resamples (median lead {result['gap_median']:g} reads over {result['runner_up']})")
+    
     # Save results including total read count
-    save_results(sample, best_refs, best_stats, segment_stats, rarefied_info['total_reads'], output_dir)
+    save_results(sample, best_refs, best_stats, segment_stats, rarefied_info['total_reads'], output_dir, selection)
     
     return best_refs
 
-def rarefy_reads(input_file, output_file, n_reads):
-    """Rarefy FASTQ file to specified number of reads."""
+def rarefy_reads(input_file, output_file, n_reads, threads=1, compression=DEFAULT_COMPRESSION, level=DEFAULT_LEVEL, cache_dir=None):
+    """Rarefy FASTQ file to specified number of reads.
+    
+    The reads are picked using the read count of the file's scan and
+    streamed to output_file with the given compression format ('bgzf',
+    'gzip' or 'plain'), level and threads (see fastq_scan.write_fastq_sample).
+    """
     try:
-        # Use seqtk to randomly sample reads
-        cmd = ['seqtk', 'sample', '-s', '42', str(input_file), str(n_reads)]
-        with open(output_file, 'w') as f:
-            subprocess.run(cmd, stdout=f, check=True)
-    except subprocess.CalledProcessError as e:
+        write_fastq_sample(input_file, n_reads, output_file, cache_dir=cache_dir, threads=threads, compression=compression, level=level)
+    except (OSError, subprocess.CalledProcessError) as e:
         logger.error(f"Error rarefying reads: {e}")
         sys.exit(1)
 
-def save_results(sample, best_refs, best_stats, segment_stats, total_reads, output_dir):
+def save_results(sample, best_refs, best_stats, segment_stats, total_reads, output_dir, selection=None):
     """Save mapping statistics and best reference to JSON file and save best reference sequences as FASTA."""
     results = {
         'sample': sample,
         'total_reads': total_reads,
-        'rarefied_reads': 10000,
+        'rarefied_reads': RAREFIED_READS,
         'best_references': best_refs,
         'best_stats': best_stats,
         'segment_stats': segment_stats
     }
+    if selection:
+        results['selection'] = selection
     
     # Save everything in the sample's directory
     sample_dir = Path(output_dir) / 'references' / 'selection_best_references' / sample
@@ -385,23 +1207,12 @@ def save_results(sample, best_refs, best_stats, segment_stats, total_reads, outp
     # Save best reference sequences as FASTA in sample directory
     for segment in ['L', 'S']:
         if best_refs[segment]:
-            # Read the original reference file
-            ref_file = Path(best_refs[segment]['file'])
+            # Look up the best reference sequence by accession in the reference store
+            fasta_dir = Path(best_refs[segment]['file']).parent.parent
             fasta_file = sample_dir / f"{sample}_{segment}_best_reference.fasta"
-            
-            # Extract only the best reference sequence
-            with open(ref_file, 'r') as f_in, open(fasta_file, 'w') as f_out:
-                write_sequence = False
-                for line in f_in:
-                    if line.startswith('>'):
-                        # Check if this is our best reference
-                        if best_refs[segment]['accession'] in line:
-                            write_sequence = True
-                            f_out.write(line)
-                        else:
-                            write_sequence = False
-                    elif write_sequence:
-                        f_out.write(line)
+            if not write_reference_fasta(fasta_dir, best_refs[segment]['accession'], fasta_file):
+                logger.error(f"Best {segment}-segment reference {best_refs[segment]['accession']} not found in {fasta_dir}")
+                sys.exit(1)
             
             logger.info(f"Saved best {segment}-segment reference sequence to {fasta_file}")
     
@@ -419,9 +1230,8 @@ def find_samples(input_dir):
         elif name.endswith(".fastq"):
             sample_names.add(name[:-6])
     return list(sample_names)
-    return [f.stem.split('.')[0] for f in fastq_files]
 
-def setup_consensus_directories(output_dir, samples, input_dir):
+def setup_consensus_directories(output_dir, samples, input_dir, cache_dir=None):
     """Set up directories for consensus generation."""
     consensus_dir = output_dir / 'consensus'
     consensus_dir.mkdir(exist_ok=True)
@@ -454,6 +1264,7 @@ def setup_consensus_directories(output_dir, samples, input_dir):
         
         if fastq_file is not None:
             shutil.copy2(fastq_file, sample_dir / fastq_file.name)
+            copy_fastq_scan(fastq_file, sample_dir / fastq_file.name, cache_dir)
             logger.info(f"Copied FASTQ file for {sample}: {fastq_file.name}")
         else:
             logger.warning(f"Could not find FASTQ file for {sample} (looked for .fastq and .fastq.gz)")
@@ -476,8 +1287,55 @@ def main(args=None):
             help='Host filter: 1=human, 2=rodent, 3=both, 4=no filter (default: 4)')
         parser.add_argument('--metadata', type=int, choices=[1,2,3,4], default=4,
             help='Metadata filter: 1=known location, 2=known date, 3=both, 4=no filter (default: 4)')
+        parser.add_argument('--selection_mode', choices=['per-reference', 'competitive'], default='per-reference',
+            help='Reference scoring: per-reference=one alignment per reference, competitive=one alignment per segment against all references (default: per-reference)')
+        parser.add_argument('--cache_dir', default=None,
+            help='Directory for cached minimap2 indexes and reference downloads (default: $LASSENSUS_CACHE_DIR or ~/.cache/lassensus)')
+        parser.add_argument('--cache_max_size', type=float, default=DEFAULT_CACHE_MAX_SIZE,
+            help=f'Maximum size of the minimap2 index, FASTQ scan and score cache in GB (default: {DEFAULT_CACHE_MAX_SIZE})')
+        parser.add_argument('--prescreen_top_k', type=int, default=0,
+            help='Only align to the top-k references per segment ranked by k-mer containment, 0=align to all (default: 0)')
+        parser.add_argument('--cluster_identity', type=float, default=0,
+            help='Cluster references at this identity (percent) and evaluate cluster representatives first, 0=no clustering (default: 0)')
+        parser.add_argument('--threads', type=int, default=None,
+            help='Total number of threads for reference selection (default: all CPU cores but one)')
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of reference alignments run in parallel, sharing --threads (default: 1)')
+        parser.add_argument('--batch', action='store_true',
+            help='Map the reads of all samples together in one competitive alignment per segment')
+        parser.add_argument('--tournament_reads', type=int, default=0,
+            help='Run a successive-halving tournament starting with this many reads, 0=align all reads to every reference (default: 0)')
+        parser.add_argument('--offline', action='store_true',
+            help='Never run lassaseq; use cached reference downloads only')
+        parser.add_argument('--reference_version', default=None,
+            help='Dataset version of the cached references (default: newest cached version, or today for a new download)')
+        parser.add_argument('--refresh_references', action='store_true',
+            help='Download references again even if a cached download matches the filters')
+        parser.add_argument('--local_filter', action='store_true',
+            help='Download the unfiltered reference database once and apply the filters locally')
+        parser.add_argument('--incremental', action='store_true',
+            help='Reuse the scores of the previous run of each sample and only evaluate added or changed references')
+        parser.add_argument('--no_score_cache', action='store_true',
+            help='Do not reuse or store cached per-sample reference scores')
+        parser.add_argument('--read_scores', action='store_true',
+            help='Save the best alignment score and identity of every read to every reference as a sparse matrix')
+        parser.add_argument('--bootstrap', type=int, default=0,
+            help='Number of read resamples to estimate the confidence of each best reference from the read scores, 0=off (default: 0)')
+        parser.add_argument('--output_compression', choices=COMPRESSION_FORMATS, default=DEFAULT_COMPRESSION,
+            help='Compression of rarefied FASTQ files (bgzf=block gzip, readable in parallel; gzip; plain=uncompressed .fastq) (default: bgzf)')
+        parser.add_argument('--compression_level', type=int, default=DEFAULT_LEVEL,
+            help='Compression level of rarefied FASTQ files, 1-9 (default: 6)')
+        parser.add_argument('--compression_threads', type=int, default=None,
+            help='Threads for compressing rarefied FASTQ files (default: --threads, or all CPU cores but one)')
         args = parser.parse_args()
     
+    if args.offline and args.refresh_references:
+        logger.error("--offline and --refresh_references cannot be combined")
+        sys.exit(1)
+    if not 1 <= args.compression_level <= 9:
+        logger.error("--compression_level must be between 1 and 9")
+        sys.exit(1)
+    
     # Convert input and output directories to Path objects
     input_dir = Path(args.input_dir)
     output_dir = Path(args.output_dir)
@@ -494,6 +1352,10 @@ def main(args=None):
         logger.error("No samples found in input directory")
         sys.exit(1)
     
+    # Global thread budget shared by all alignment workers and FASTQ decompression
+    threads = args.threads if args.threads else get_cpu_count()
+    logger.info(f"FASTQ compression backend: {describe_backend(threads)}")
+    
     logger.info(f"\nFound {len(samples)} samples to process:")
     total_reads = 0
     for i, sample in enumerate(samples, 1):
@@ -509,16 +1371,23 @@ def main(args=None):
             logger.warning(f"Could not find input file for {sample} (looked for .fastq and .fastq.gz)")
             read_count = 0
         else:
-            read_count = count_reads(input_file)
+            read_count = count_reads(input_file, threads, args.cache_dir)
         
         total_reads += read_count
         logger.info(f"{i}. {sample} ({read_count:,} reads)")
     
     logger.info(f"\nOutput will be saved to: {output_dir}")
     logger.info(f"Minimum identity threshold: {args.min_identity}%")
+    logger.info(f"Reference selection mode: {args.selection_mode}")
+    if args.prescreen_top_k > 0:
+        logger.info(f"k-mer pre-screen: top {args.prescreen_top_k} references per segment")
+    if args.cluster_identity > 0:
+        logger.info(f"Reference clustering at {args.cluster_identity}% identity")
     
     # First, rarefy all samples
-    rarefied_files = rarefy_all_samples(samples, input_dir, output_dir)
+    compression_threads = args.compression_threads if args.compression_threads else threads
+    rarefied_files = rarefy_all_samples(samples, input_dir, output_dir, threads=compression_threads,
+                                        compression=args.output_compression, level=args.compression_level, cache_dir=args.cache_dir)
     
     # Download references once for all samples
     logger.info("\nDownloading references for all samples...")
@@ -527,22 +1396,82 @@ def main(args=None):
         genome=args.genome,
         completeness=args.completeness,
         host=args.host,
-        metadata=args.metadata
+        metadata=args.metadata,
+        cache_dir=args.cache_dir,
+        offline=args.offline,
+        version=args.reference_version,
+        refresh=args.refresh_references,
+        local_filter=args.local_filter
     )
     
+    # Pack the downloaded references into the store shared by all samples,
+    # unless the store of an earlier run still matches them
+    load_reference_store(dirs['references'] / 'FASTA')
+    
+    if args.workers > 1:
+        logger.info(f"Running up to {args.workers} alignments in parallel with {max(1, threads // args.workers)} threads each")
+    
     # Process each sample using rarefied reads
     logger.info("\nFinding best references for each sample...")
-    for sample in samples:
-        best_refs = process_sample(
-            sample,
-            rarefied_files[sample],
+    if args.tournament_reads > 0 and args.cluster_identity > 0:
+        logger.warning("--cluster_identity is ignored with --tournament_reads")
+    if args.incremental and args.selection_mode != 'per-reference':
+        logger.warning("--incremental needs --selection_mode per-reference, since competitive scores depend on the whole reference set; evaluating all references")
+        args.incremental = False
+    if args.bootstrap > 0:
+        args.read_scores = True
+    if args.read_scores and (args.batch or args.incremental or args.tournament_reads > 0 or args.cluster_identity > 0):
+        logger.warning("--read_scores needs every reference scored on all reads and is ignored with --batch, --incremental, --tournament_reads or --cluster_identity")
+        args.read_scores = False
+        args.bootstrap = 0
+    if args.batch:
+        if args.incremental:
+            logger.warning("--incremental is ignored with --batch")
+        if args.tournament_reads > 0:
+            logger.warning("--tournament_reads is ignored with --batch; every sample is scored on all its reads")
+        if args.cluster_identity > 0:
+            logger.warning("--cluster_identity is ignored with --batch; all references are aligned competitively")
+        batch_results = find_best_references_batch(
+            rarefied_files,
             dirs['references'],
             output_dir,
-            args.min_identity
+            cache_dir=args.cache_dir,
+            prescreen_top_k=args.prescreen_top_k,
+            threads=threads,
+            workers=args.workers
         )
-        for segment in ['L', 'S']:
-            if best_refs[segment]:
-                logger.info(f"Best {segment}-segment reference for {sample}: {best_refs[segment]['accession']}")
+        for sample in samples:
+            best_refs, best_stats, segment_stats = batch_results[sample]
+            save_results(sample, best_refs, best_stats, segment_stats, rarefied_files[sample]['total_reads'], output_dir)
+            for segment in ['L', 'S']:
+                if best_refs[segment]:
+                    logger.info(f"Best {segment}-segment reference for {sample}: {best_refs[segment]['accession']}")
+    else:
+        for sample in samples:
+            best_refs = process_sample(
+                sample,
+                rarefied_files[sample],
+                dirs['references'],
+                output_dir,
+                args.min_identity,
+                selection_mode=args.selection_mode,
+                cache_dir=args.cache_dir,
+                prescreen_top_k=args.prescreen_top_k,
+                cluster_identity=args.cluster_identity,
+                threads=threads,
+                workers=args.workers,
+                tournament_reads=args.tournament_reads,
+                incremental=args.incremental,
+                score_cache=not args.no_score_cache,
+                read_scores=args.read_scores or args.bootstrap > 0,
+                bootstrap=args.bootstrap
+            )
+            for segment in ['L', 'S']:
+                if best_refs[segment]:
+                    logger.info(f"Best {segment}-segment reference for {sample}: {best_refs[segment]['accession']}")
+    
+    # Trim the index, FASTQ scan and score cache once, after all alignments are done
+    evict_cache(args.cache_dir, args.cache_max_size)
     
     # Clean up empty directories
     for sample in samples:
@@ -551,7 +1480,7 @@ def main(args=None):
             shutil.rmtree(empty_dir)
     
     # Set up consensus directories
-    consensus_dir = setup_consensus_directories(output_dir, samples, input_dir)
+    consensus_dir = setup_consensus_directories(output_dir, samples, input_dir, args.cache_dir)
     
     logger.info("\nReference selection complete!")
     logger.info(f"Results saved in: {dirs['selection_best_references']}")
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import os
+import mmap
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Files of the reference store, kept in the references FASTA directory
+STORE_SEQUENCES = 'reference_store.seq'
+STORE_INDEX = 'reference_store.json'
+
+# Loaded stores of this process: FASTA directory -> (fingerprint, references, by_accession, sequences)
+_stores = {}
+
+def list_fasta_files(fasta_dir):
+    """List the reference FASTA files in the segment directories of fasta_dir."""
+    fasta_files = []
+    for segment in ['L_segment', 'S_segment']:
+        segment_dir = Path(fasta_dir) / segment
+        if segment_dir.exists():
+            for ext in ['*.fasta', '*.fa']:
+                fasta_files.extend(segment_dir.glob(ext))
+    return fasta_files
+
+def fasta_fingerprint(fasta_files):
+    """Identify the current version of the FASTA files by path, size and modification time."""
+    fingerprint = []
+    for fasta_file in fasta_files:
+        stat = os.stat(fasta_file)
+        fingerprint.append([str(fasta_file), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+def parse_fasta(fasta_file):
+    """Yield (accession, description, sequence) for every record in a FASTA file."""
+    header = None
+    sequence = []
+    
+    with open(fasta_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if header is not None:
+                    yield header[0], ' '.join(header[1:]), ''.join(sequence)
+                header = line[1:].split() or ['']
+                sequence = []
+            else:
+                sequence.append(line)
+    
+    if header is not None:
+        yield header[0], ' '.join(header[1:]), ''.join(sequence)
+
+def build_reference_store(fasta_dir):
+    """Pack all reference sequences of fasta_dir into one file with an accession index.
+    
+    Sequences are stored back to back, one byte per base (ambiguity codes are
+    kept), in reference_store.seq. reference_store.json holds for every
+    reference its FASTA file, segment, description, offset and length, plus a
+    fingerprint of the FASTA files to detect a new download.
+    """
+    fasta_dir = Path(fasta_dir)
+    if not fasta_dir.exists():
+        logger.warning(f"No reference directory {fasta_dir} to build a reference store from")
+        return
+    
+    fasta_files = list_fasta_files(fasta_dir)
+    references = []
+    offset = 0
+    
+    # Write into temporary files and move them into place so that concurrent
+    # readers never see a partially written store
+    temp_sequences = fasta_dir / f"{STORE_SEQUENCES}.{os.getpid()}.tmp"
+    temp_index = fasta_dir / f"{STORE_INDEX}.{os.getpid()}.tmp"
+    with open(temp_sequences, 'wb') as f:
+        for fasta_file in fasta_files:
+            segment = fasta_file.parent.name.split('_')[0]
+            for accession, description, sequence in parse_fasta(fasta_file):
+                data = sequence.encode()
+                f.write(data)
+                references.append({
+                    'accession': accession,
+                    'description': description,
+                    'file': str(fasta_file),
+                    'segment': segment,
+                    'offset': offset,
+                    'length': len(data)
+                })
+                offset += len(data)
+    
+    with open(temp_index, 'w') as f:
+        json.dump({
+            'fingerprint': fasta_fingerprint(fasta_files),
+            'references': references
+        }, f)
+    
+    os.replace(temp_sequences, fasta_dir / STORE_SEQUENCES)
+    os.replace(temp_index, fasta_dir / STORE_INDEX)
+    
+    logger.info(f"Built reference store with {len(references)} sequences ({offset:,} bases) in {fasta_dir}")
+
+def load_reference_store(fasta_dir):
+    """Load the reference store of fasta_dir, (re)building it if the FASTA files changed.
+    
+    The sequence file is memory-mapped, so all processes reading it share one
+    copy through the page cache. Loaded stores are kept for the lifetime of
+    the process.
+    
+    Returns:
+        Tuple of (references, by_accession, sequences): the index entries in
+        FASTA order, a dictionary from accession to index entry and the
+        memory-mapped sequence data
+    """
+    fasta_dir = Path(fasta_dir)
+    if not fasta_dir.exists():
+        return [], {}, b''
+    fingerprint = fasta_fingerprint(list_fasta_files(fasta_dir))
+    
+    store = _stores.get(str(fasta_dir))
+    if store and store[0] == fingerprint:
+        return store[1:]
+    
+    index_file = fasta_dir / STORE_INDEX
+    index = None
+    if index_file.exists() and (fasta_dir / STORE_SEQUENCES).exists():
+        try:
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable reference store index {index_file}: {e}")
+    
+    if index is None or index['fingerprint'] != fingerprint:
+        build_reference_store(fasta_dir)
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    
+    references = index['references']
+    by_accession = {}
+    for entry in references:
+        by_accession.setdefault(entry['accession'], entry)
+    
+    sequences = b''
+    if os.path.getsize(fasta_dir / STORE_SEQUENCES) > 0:
+        with open(fasta_dir / STORE_SEQUENCES, 'rb') as f:
+            sequences = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    _stores[str(fasta_dir)] = (fingerprint, references, by_accession, sequences)
+    return references, by_accession, sequences
+
+def read_sequence(sequences, entry):
+    """Read the sequence of an index entry from the memory-mapped sequence data."""
+    return sequences[entry['offset']:entry['offset'] + entry['length']].decode()
+
+def get_reference_sequence(fasta_dir, accession):
+    """Look up the description and sequence of one reference by accession.
+    
+    Returns:
+        Tuple of (description, sequence), or None if the accession is unknown
+    """
+    references, by_accession, sequences = load_reference_store(fasta_dir)
+    entry = by_accession.get(accession)
+    if entry is None:
+        return None
+    return entry['description'], read_sequence(sequences, entry)
+
+def write_reference_fasta(fasta_dir, accession, output_file):
+    """Write one reference from the store to a FASTA file; returns False if the accession is unknown."""
+    reference = get_reference_sequence(fasta_dir, accession)
+    if reference is None:
+        return False
+    description, sequence = reference
+    with open(output_file, 'w') as f:
+        f.write(f">{accession} {description}\n" if description else f">{accession}\n")
+        f.write(sequence + "\n")
+    return True
+
+def sequence_hashes(fasta_dir):
+    """Return a dictionary mapping every accession in the store to a hash of its sequence."""
+    references, _, sequences = load_reference_store(fasta_dir)
+    return {
+        entry['accession']: hashlib.sha1(sequences[entry['offset']:entry['offset'] + entry['length']].upper()).hexdigest()
+        for entry in references
+    }
+
+def diff_reference_sets(previous, current):
+    """Compare two accession -> sequence hash dictionaries.
+    
+    Returns:
+        Dictionary with sorted lists of added, changed and removed accessions
+        and the number of unchanged ones
+    """
+    return {
+        'added': sorted(accession for accession in current if accession not in previous),
+        'changed': sorted(accession for accession in current if accession in previous and previous[accession] != current[accession]),
+        'removed': sorted(accession for accession in previous if accession not in current),
+        'unchanged': sum(1 for accession in current if previous.get(accession) == current[accession])
+    }
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import gzip
+import logging
+from pathlib import Path
+from collections import defaultdict
+
+import numpy as np
+
+from .cache import hash_files
+
+logger = logging.getLogger(__name__)
+
+# k-mer size and FracMinHash scale factor used for pre-screening references.
+# A short k keeps enough k-mers intact in error-prone nanopore reads.
+DEFAULT_KMER_SIZE = 15
+DEFAULT_SCALED = 10
+
+# Number of bases hashed at once when sketching reads
+CHUNK_SIZE = 4_000_000
+
+# Lookup table from ASCII to 2-bit code (4 = not ACGT)
+_ENCODE = np.full(256, 4, dtype=np.uint8)
+for _i, _base in enumerate('ACGT'):
+    _ENCODE[ord(_base)] = _i
+    _ENCODE[ord(_base.lower())] = _i
+
+def open_text(path):
+    """Open a plain or gzip-compressed text file, detecting compression from its content."""
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+def _mix64(x):
+    """MurmurHash3 64-bit finalizer, applied element-wise to a uint64 array."""
+    x = x ^ (x >> np.uint64(33))
+    x = x * np.uint64(0xff51afd7ed558ccd)
+    x = x ^ (x >> np.uint64(33))
+    x = x * np.uint64(0xc4ceb9fe1a85ec53)
+    x = x ^ (x >> np.uint64(33))
+    return x
+
+def hash_kmers(sequence, k=DEFAULT_KMER_SIZE, scaled=DEFAULT_SCALED):
+    """Return the sorted unique FracMinHash values of the canonical k-mers in sequence.
+    
+    Several sequences can be hashed in one call by joining them with 'N';
+    k-mers spanning a non-ACGT character are skipped.
+    """
+    codes = _ENCODE[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+    n_kmers = len(codes) - k + 1
+    if n_kmers <= 0:
+        return np.empty(0, dtype=np.uint64)
+    
+    # Skip k-mers containing a non-ACGT base
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = (invalid[k:] - invalid[:n_kmers]) == 0
+    
+    # Build forward and reverse-complement k-mer values one base at a time
+    values = codes.astype(np.uint64)
+    forward = np.zeros(n_kmers, dtype=np.uint64)
+    reverse = np.zeros(n_kmers, dtype=np.uint64)
+    four = np.uint64(4)
+    three = np.uint64(3)
+    for i in range(k):
+        forward = forward * four + values[i:i + n_kmers]
+    for i in range(k - 1, -1, -1):
+        reverse = reverse * four + (three - values[i:i + n_kmers])
+    canonical = np.minimum(forward, reverse)[valid]
+    
+    # Keep only hashes below the FracMinHash threshold
+    hashes = _mix64(canonical)
+    max_hash = np.uint64((2 ** 64 - 1) // scaled)
+    return np.unique(hashes[hashes <= max_hash])
+
+def sketch_reads(fastq_file, k=DEFAULT_KMER_SIZE, scaled=DEFAULT_SCALED):
+    """Compute a FracMinHash sketch over all reads in a FASTQ file."""
+    sketches = []
+    chunk = []
+    chunk_size = 0
+    
+    with open_text(fastq_file) as f:
+        for i, line in enumerate(f):
+            if i % 4 != 1:
+                continue
+            chunk.append(line.strip())
+            chunk_size += len(chunk[-1])
+            if chunk_size >= CHUNK_SIZE:
+                sketches.append(hash_kmers('N'.join(chunk), k, scaled))
+                chunk = []
+                chunk_size = 0
+    
+    if chunk:
+        sketches.append(hash_kmers('N'.join(chunk), k, scaled))
+    
+    if not sketches:
+        return np.empty(0, dtype=np.uint64)
+    return np.unique(np.concatenate(sketches))
+
+def get_sketch_file(ref_file, k=DEFAULT_KMER_SIZE, scaled=DEFAULT_SCALED):
+    """Return the path of the cached sketch file stored next to a reference FASTA."""
+    ref_file = Path(ref_file)
+    return ref_file.with_name(f"{ref_file.name}.k{k}.s{scaled}.sketch.npz")
+
+def load_reference_sketches(ref_file, references, k=DEFAULT_KMER_SIZE, scaled=DEFAULT_SCALED):
+    """Load or compute the sketches of all references in one FASTA file.
+    
+    Sketches are cached next to the FASTA and recomputed when the FASTA content changes.
+    
+    Args:
+        ref_file: Reference FASTA file
+        references: Reference info dictionaries from get_reference_info
+    Returns:
+        Dictionary mapping accession to a sorted array of k-mer hashes
+    """
+    sketch_file = get_sketch_file(ref_file, k, scaled)
+    fasta_hash = hash_files([ref_file])
+    sketches = {}
+    
+    if sketch_file.exists():
+        try:
+            with np.load(sketch_file) as data:
+                if str(data['fasta_hash']) == fasta_hash:
+                    accessions = data['accessions']
+                    offsets = data['offsets']
+                    hashes = data['hashes']
+                    sketches = {
+                        str(accession): hashes[offsets[i]:offsets[i + 1]]
+                        for i, accession in enumerate(accessions)
+                    }
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable sketch cache {sketch_file}: {e}")
+    
+    missing = [ref for ref in references if ref['accession'] not in sketches]
+    if not missing:
+        return sketches
+    
+    logger.info(f"Computing k-mer sketches for {len(missing)} references in {ref_file}")
+    for ref in missing:
+        sketches[ref['accession']] = hash_kmers(ref['sequence'], k, scaled)
+    
+    accessions = list(sketches)
+    offsets = np.cumsum([0] + [len(sketches[accession]) for accession in accessions])
+    hashes = np.concatenate([sketches[accession] for accession in accessions])
+    try:
+        np.savez(sketch_file, fasta_hash=fasta_hash, accessions=np.array(accessions), offsets=offsets, hashes=hashes)
+    except OSError as e:
+        logger.warning(f"Could not cache reference sketches to {sketch_file}: {e}")
+    
+    return sketches
+
+def containment_scores(reference_files, sample_fastq, k=DEFAULT_KMER_SIZE, scaled=DEFAULT_SCALED):
+    """Calculate the k-mer containment of each reference in the reads of a sample.
+    
+    Containment is the fraction of a reference's sketch found in the sketch of
+    the reads, so it estimates how much of the reference is covered by similar
+    sequence without aligning anything.
+    
+    Args:
+        reference_files: List of (ref_file, ref_info) tuples from get_reference_files
+        sample_fastq: FASTQ file with the (rarefied) sample reads
+    Returns:
+        List of containment scores in the order of reference_files
+    """
+    read_sketch = sketch_reads(sample_fastq, k, scaled)
+    logger.info(f"Sketched reads of {sample_fastq}: {len(read_sketch):,} k-mer hashes")
+    
+    # Group references by FASTA file to load each sketch cache once
+    references_by_file = defaultdict(list)
+    for ref_file, ref_info in reference_files:
+        references_by_file[ref_file].append(ref_info)
+    
+    sketches = {}
+    for ref_file, references in references_by_file.items():
+        sketches[ref_file] = load_reference_sketches(ref_file, references, k, scaled)
+    
+    scores = []
+    for ref_file, ref_info in reference_files:
+        ref_sketch = sketches[ref_file][ref_info['accession']]
+        if len(ref_sketch) == 0:
+            scores.append(0.0)
+        else:
+            scores.append(float(np.isin(ref_sketch, read_sketch, assume_unique=True).sum() / len(ref_sketch)))
+    
+    return scores
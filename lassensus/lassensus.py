@@ -12,24 +12,54 @@ TOOL_ROOT = Path(__file__).parent.parent.absolute()
 sys.path.insert(0, str(TOOL_ROOT))
 
 from lassensus.core.reference_selection import main as reference_selection_main
-from lassensus.core.consensus_generation import main as consensus_generation_main
+from lassensus.core.consensus_generation import main as consensus_generation_main, MAPPING_MODES, DEFAULT_MAPPING_MODE, DEFAULT_SORT_MEMORY, CONSENSUS_BACKENDS, DEFAULT_CONSENSUS_BACKEND, DEFAULT_MAX_DEPTH
+from lassensus.core.cache import main as cache_main, DEFAULT_CACHE_MAX_SIZE
+from lassensus.core.recall import main as recall_main
+from lassensus.core.compression import COMPRESSION_FORMATS, DEFAULT_COMPRESSION, DEFAULT_LEVEL
 
 def main():
     """Main entry point for the Lassensus tool."""
     parser = argparse.ArgumentParser(description='Lassensus - Lassa virus consensus sequence builder')
     
     # Add main arguments that are common to all commands
-    parser.add_argument('-i', '--input_dir', required=True, help='Directory containing input FASTQ files')
-    parser.add_argument('-o', '--output_dir', required=True, help='Directory for pipeline output')
+    parser.add_argument('-i', '--input_dir', help='Directory containing input FASTQ files')
+    parser.add_argument('-o', '--output_dir', help='Directory for pipeline output')
     parser.add_argument('--min_identity', type=float, default=90.0, help='Minimum identity threshold for reference selection (default: 90.0)')
     parser.add_argument('--genome', type=int, default=2, help='Genome completeness filter (1=Complete, 2=Partial, 3=None)')
     parser.add_argument('--completeness', type=int, default=90, help='Minimum sequence completeness (1-100 percent)')
     parser.add_argument('--host', type=int, default=4, help='Host filter (1=Human, 2=Rodent, 3=Both, 4=None)')
     parser.add_argument('--metadata', type=int, default=4, help='Metadata filter (1=Location, 2=Date, 3=Both, 4=None)')
+    parser.add_argument('--selection_mode', choices=['per-reference', 'competitive'], default='per-reference', help='Reference scoring mode (per-reference=one alignment per reference, competitive=one alignment per segment against all references)')
+    parser.add_argument('--prescreen_top_k', type=int, default=0, help='Only align to the top-k references per segment ranked by k-mer containment, 0=align to all (default: 0)')
+    parser.add_argument('--cluster_identity', type=float, default=0, help='Cluster references at this identity (percent) and evaluate cluster representatives first, 0=no clustering (default: 0)')
+    parser.add_argument('--threads', type=int, default=None, help='Total number of threads for reference selection and consensus generation (default: all CPU cores but one)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of reference alignments run in parallel, sharing --threads (default: 1)')
+    parser.add_argument('--batch', action='store_true', help='Map the reads of all samples together in one competitive alignment per segment')
+    parser.add_argument('--tournament_reads', type=int, default=0, help='Run a successive-halving tournament starting with this many reads, 0=align all reads to every reference (default: 0)')
     parser.add_argument('--min_depth', type=int, default=50, help='Minimum depth for consensus calling (default: 50)')
     parser.add_argument('--min_quality', type=int, default=30, help='Minimum quality score for consensus calling (default: 30)')
     parser.add_argument("--max_reads", type=int, default=1000000, help="Maximum number of reads to use for consensus generation (default: 1,000,000)")
     parser.add_argument('--majority_threshold', type=float, default=0.7, help='Majority rule threshold (default: 0.7)')
+    parser.add_argument('--sort_memory', default=DEFAULT_SORT_MEMORY, help='Memory per samtools sort thread, with K/M/G suffix (default: 768M)')
+    parser.add_argument('--sort_temp_dir', default=None, help='Directory for samtools sort temporary files (default: next to the BAM file)')
+    parser.add_argument('--no_bam_index', action='store_true', help='Do not index the per-segment sorted BAM files')
+    parser.add_argument('--consensus_backend', choices=CONSENSUS_BACKENDS, default=DEFAULT_CONSENSUS_BACKEND, help='Call consensus sequences with samtools mpileup | ivar consensus (ivar) or from an in-process pileup of the BAM file (native) (default: ivar)')
+    parser.add_argument('--max_depth', type=int, default=DEFAULT_MAX_DEPTH, help=f'Cap the depth per position at this many alignments before consensus calling, keeping regions below it intact; 0 disables the cap (default: {DEFAULT_MAX_DEPTH})')
+    parser.add_argument('--save_pileup', action='store_true', help='Save the pileup count matrix of every segment for lassensus recall')
+    parser.add_argument('--mapping_mode', choices=MAPPING_MODES, default=DEFAULT_MAPPING_MODE, help='Map and polish reads once against both segments (combined) or once per segment (separate) (default: combined)')
+    parser.add_argument('--cache_dir', default=None, help='Directory for cached minimap2 indexes and reference downloads (default: $LASSENSUS_CACHE_DIR or ~/.cache/lassensus)')
+    parser.add_argument('--offline', action='store_true', help='Never run lassaseq; use cached reference downloads only')
+    parser.add_argument('--reference_version', default=None, help='Dataset version of the cached references (default: newest cached version, or today for a new download)')
+    parser.add_argument('--refresh_references', action='store_true', help='Download references again even if a cached download matches the filters')
+    parser.add_argument('--local_filter', action='store_true', help='Download the unfiltered reference database once and apply the filters locally')
+    parser.add_argument('--incremental', action='store_true', help='Reuse the scores of the previous run of each sample and only evaluate added or changed references')
+    parser.add_argument('--no_score_cache', action='store_true', help='Do not reuse or store cached per-sample reference scores')
+    parser.add_argument('--read_scores', action='store_true', help='Save the best alignment score and identity of every read to every reference as a sparse matrix')
+    parser.add_argument('--bootstrap', type=int, default=0, help='Number of read resamples to estimate the confidence of each best reference from the read scores, 0=off (default: 0)')
+    parser.add_argument('--cache_max_size', type=float, default=DEFAULT_CACHE_MAX_SIZE, help=f'Maximum size of the minimap2 index, FASTQ scan and score cache in GB (default: {DEFAULT_CACHE_MAX_SIZE})')
+    parser.add_argument('--output_compression', choices=COMPRESSION_FORMATS, default=DEFAULT_COMPRESSION, help='Compression of rarefied FASTQ files (bgzf=block gzip, readable in parallel; gzip; plain=uncompressed .fastq) (default: bgzf)')
+    parser.add_argument('--compression_level', type=int, default=DEFAULT_LEVEL, help='Compression level of rarefied FASTQ files, 1-9 (default: 6)')
+    parser.add_argument('--compression_threads', type=int, default=None, help='Threads for compressing rarefied FASTQ files (default: --threads, or all CPU cores but one)')
     
     # Optional subcommand for future expansion
     subparsers = parser.add_subparsers(dest='command', help='Pipeline stage to run (default: full pipeline)')
@@ -43,6 +73,26 @@ def main():
     ref_parser.add_argument('--completeness', type=int, default=90, help='Minimum sequence completeness (1-100 percent)')
     ref_parser.add_argument('--host', type=int, default=4, help='Host filter (1=Human, 2=Rodent, 3=Both, 4=None)')
     ref_parser.add_argument('--metadata', type=int, default=4, help='Metadata filter (1=Location, 2=Date, 3=Both, 4=None)')
+    ref_parser.add_argument('--cache_dir', default=None, help='Directory for cached minimap2 indexes and reference downloads (default: $LASSENSUS_CACHE_DIR or ~/.cache/lassensus)')
+    ref_parser.add_argument('--offline', action='store_true', help='Never run lassaseq; use cached reference downloads only')
+    ref_parser.add_argument('--reference_version', default=None, help='Dataset version of the cached references (default: newest cached version, or today for a new download)')
+    ref_parser.add_argument('--refresh_references', action='store_true', help='Download references again even if a cached download matches the filters')
+    ref_parser.add_argument('--local_filter', action='store_true', help='Download the unfiltered reference database once and apply the filters locally')
+    ref_parser.add_argument('--incremental', action='store_true', help='Reuse the scores of the previous run of each sample and only evaluate added or changed references')
+    ref_parser.add_argument('--no_score_cache', action='store_true', help='Do not reuse or store cached per-sample reference scores')
+    ref_parser.add_argument('--read_scores', action='store_true', help='Save the best alignment score and identity of every read to every reference as a sparse matrix')
+    ref_parser.add_argument('--bootstrap', type=int, default=0, help='Number of read resamples to estimate the confidence of each best reference from the read scores, 0=off (default: 0)')
+    ref_parser.add_argument('--cache_max_size', type=float, default=DEFAULT_CACHE_MAX_SIZE, help=f'Maximum size of the minimap2 index, FASTQ scan and score cache in GB (default: {DEFAULT_CACHE_MAX_SIZE})')
+    ref_parser.add_argument('--output_compression', choices=COMPRESSION_FORMATS, default=DEFAULT_COMPRESSION, help='Compression of rarefied FASTQ files (bgzf=block gzip, readable in parallel; gzip; plain=uncompressed .fastq) (default: bgzf)')
+    ref_parser.add_argument('--compression_level', type=int, default=DEFAULT_LEVEL, help='Compression level of rarefied FASTQ files, 1-9 (default: 6)')
+    ref_parser.add_argument('--compression_threads', type=int, default=None, help='Threads for compressing rarefied FASTQ files (default: --threads, or all CPU cores but one)')
+    ref_parser.add_argument('--selection_mode', choices=['per-reference', 'competitive'], default='per-reference', help='Reference scoring mode (per-reference=one alignment per reference, competitive=one alignment per segment against all references)')
+    ref_parser.add_argument('--prescreen_top_k', type=int, default=0, help='Only align to the top-k references per segment ranked by k-mer containment, 0=align to all (default: 0)')
+    ref_parser.add_argument('--cluster_identity', type=float, default=0, help='Cluster references at this identity (percent) and evaluate cluster representatives first, 0=no clustering (default: 0)')
+    ref_parser.add_argument('--threads', type=int, default=None, help='Total number of threads for reference selection (default: all CPU cores but one)')
+    ref_parser.add_argument('--workers', type=int, default=1, help='Number of reference alignments run in parallel, sharing --threads (default: 1)')
+    ref_parser.add_argument('--batch', action='store_true', help='Map the reads of all samples together in one competitive alignment per segment')
+    ref_parser.add_argument('--tournament_reads', type=int, default=0, help='Run a successive-halving tournament starting with this many reads, 0=align all reads to every reference (default: 0)')
     
     # Consensus generation subcommand
     consensus_parser = subparsers.add_parser('consensus', help='Generate consensus sequences only')
@@ -51,7 +101,36 @@ def main():
     consensus_parser.add_argument('--min_depth', type=int, default=50, help='Minimum depth for consensus calling (default: 50)')
     consensus_parser.add_argument('--min_quality', type=int, default=30, help='Minimum quality score for consensus calling (default: 30)')
     consensus_parser.add_argument('--majority_threshold', type=float, default=0.7, help='Majority rule threshold (default: 0.7)')
+    consensus_parser.add_argument('--sort_memory', default=DEFAULT_SORT_MEMORY, help='Memory per samtools sort thread, with K/M/G suffix (default: 768M)')
+    consensus_parser.add_argument('--sort_temp_dir', default=None, help='Directory for samtools sort temporary files (default: next to the BAM file)')
+    consensus_parser.add_argument('--no_bam_index', action='store_true', help='Do not index the per-segment sorted BAM files')
+    consensus_parser.add_argument('--consensus_backend', choices=CONSENSUS_BACKENDS, default=DEFAULT_CONSENSUS_BACKEND, help='Call consensus sequences with samtools mpileup | ivar consensus (ivar) or from an in-process pileup of the BAM file (native) (default: ivar)')
+    consensus_parser.add_argument('--max_depth', type=int, default=DEFAULT_MAX_DEPTH, help=f'Cap the depth per position at this many alignments before consensus calling, keeping regions below it intact; 0 disables the cap (default: {DEFAULT_MAX_DEPTH})')
+    consensus_parser.add_argument('--save_pileup', action='store_true', help='Save the pileup count matrix of every segment for lassensus recall')
+    consensus_parser.add_argument('--mapping_mode', choices=MAPPING_MODES, default=DEFAULT_MAPPING_MODE, help='Map and polish reads once against both segments (combined) or once per segment (separate) (default: combined)')
     consensus_parser.add_argument("--max_reads", type=int, default=1000000, help="Maximum number of reads to use for consensus generation (default: 1,000,000)")
+    consensus_parser.add_argument('--threads', type=int, default=None, help='Number of threads for mapping, sorting, pileup and polishing (default: all CPU cores but one)')
+    consensus_parser.add_argument('--cache_dir', default=None, help='Directory for cached minimap2 indexes (default: $LASSENSUS_CACHE_DIR or ~/.cache/lassensus)')
+    consensus_parser.add_argument('--cache_max_size', type=float, default=DEFAULT_CACHE_MAX_SIZE, help=f'Maximum size of the minimap2 index, FASTQ scan and score cache in GB (default: {DEFAULT_CACHE_MAX_SIZE})')
+    consensus_parser.add_argument('--output_compression', choices=COMPRESSION_FORMATS, default=DEFAULT_COMPRESSION, help='Compression of rarefied FASTQ files (bgzf=block gzip, readable in parallel; gzip; plain=uncompressed .fastq) (default: bgzf)')
+    consensus_parser.add_argument('--compression_level', type=int, default=DEFAULT_LEVEL, help='Compression level of rarefied FASTQ files, 1-9 (default: 6)')
+    consensus_parser.add_argument('--compression_threads', type=int, default=None, help='Threads for compressing rarefied FASTQ files (default: --threads, or all CPU cores but one)')
+    
+    # Cache management subcommand
+    cache_parser = subparsers.add_parser('cache', help='Manage the minimap2 index and reference download cache')
+    cache_parser.add_argument('action', choices=['list', 'prune', 'export', 'import'], help='list=show cached indexes, FASTQ scans, scores and references, prune=evict indexes, FASTQ scans and scores, export/import=reference snapshot')
+    cache_parser.add_argument('--cache_dir', default=None, help='Cache directory (default: $LASSENSUS_CACHE_DIR or ~/.cache/lassensus)')
+    cache_parser.add_argument('--max_size', type=float, default=None, help='Prune the cache down to this size in GB (default: remove everything)')
+    cache_parser.add_argument('--snapshot', default=None, help='Snapshot file (.tar.gz) to export to or import from')
+    
+    # Consensus re-calling subcommand
+    recall_parser = subparsers.add_parser('recall', help='Re-call consensus sequences from saved pileup count matrices without remapping (unpolished; completeness can differ from the medaka-polished consensus of the pipeline)')
+    recall_parser.add_argument('-o', '--output_dir', required=True, help='Pipeline output directory holding the consensus directory')
+    recall_parser.add_argument('--samples', nargs='+', default=None, help='Samples to re-call (default: all)')
+    recall_parser.add_argument('--min_depth', type=int, nargs='+', default=[50], help='Minimum depth(s) for consensus calling (default: 50)')
+    recall_parser.add_argument('--min_quality', type=int, nargs='+', default=[30], help='Minimum quality score(s) for consensus calling (default: 30)')
+    recall_parser.add_argument('--majority_threshold', type=float, nargs='+', default=[0.7], help='Majority rule threshold(s) (default: 0.7)')
+    recall_parser.add_argument('--recall_dir', default=None, help='Directory for re-called consensus sequences (default: <output_dir>/recall)')
     
     # Parse arguments
     args = parser.parse_args()
@@ -72,6 +151,10 @@ def main():
             reference_selection_main(args)
         elif args.command == 'consensus':
             consensus_generation_main(args)
+        elif args.command == 'cache':
+            cache_main(args)
+        elif args.command == 'recall':
+            recall_main(args)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -10,6 +10,9 @@ setup(
         "requests>=2.26.0",
         "numpy<2.0",
     ],
+    extras_require={
+        "fast-io": ["isal>=1.4", "zlib-ng>=0.2"],
+    },
     entry_points={
         "console_scripts": [
             "lassensus=lassensus.lassensus:main",
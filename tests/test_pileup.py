@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import struct
+
+import numpy as np
+import pytest
+
+from lassensus.core.compression import write_chunks
+from lassensus.core.pileup import (pileup_bam, pileup_counts, insertion_sequences, insertion_candidates,
+                                   call_consensus, save_pileup, load_pileup, MAX_QUALITY)
+
+REFERENCE = 'ACGTACGTACGTACGTACGT'
+CIGAR_OPERATIONS = 'MIDNSHP=X'
+BAM_BASES = '=ACMGRSVTWYHKDBN'
+
+def encode_cigar(cigar):
+    """Encode (operation, length) pairs as BAM CIGAR bytes."""
+    return b''.join(struct.pack('<I', length << 4 | CIGAR_OPERATIONS.index(op)) for op, length in cigar)
+
+def encode_record(reference_id, pos, name, cigar, seq, quality, flag=0, tags=b''):
+    """Encode one BAM alignment record; quality is one value for all bases or a list."""
+    if isinstance(quality, int):
+        quality = [quality] * len(seq)
+    read_name = name.encode() + b'\0'
+    codes = [BAM_BASES.index(base) for base in seq] + ([0] if len(seq) % 2 else [])
+    packed = bytes(codes[i] << 4 | codes[i + 1] for i in range(0, len(codes), 2))
+    body = struct.pack('<iiBBHHHiiii', reference_id, pos, len(read_name), 60, 0, len(cigar), flag, len(seq), -1, -1, 0)
+    body += read_name + encode_cigar(cigar) + packed + bytes(quality) + tags
+    return struct.pack('<i', len(body)) + body
+
+def write_bam(bam_file, records, references=(('ref', len(REFERENCE)),)):
+    """Write a BGZF-compressed BAM file; records are encode_record arguments, sorted by position."""
+    text = b'@HD\tVN:1.6\tSO:coordinate\n'
+    header = b'BAM\1' + struct.pack('<i', len(text)) + text + struct.pack('<i', len(references))
+    for name, length in references:
+        header += struct.pack('<i', len(name) + 1) + name.encode() + b'\0' + struct.pack('<i', length)
+    write_chunks(bam_file, [header] + [encode_record(*record) for record in records], 'bgzf')
+    return bam_file
+
+def base_counts(pileup, min_quality=0):
+    """Return the A, C, G, T, del and ins counts of a pileup as a positions x 6 array."""
+    return pileup_counts(pileup, min_quality)['counts']
+
+def test_cigar_operations(tmp_path):
+    # 2S 3M 2I 2M 2D 3= 1X on ACGTACGTACGT...: the soft clip and insertion
+    # consume read bases only, the deletion reference positions only
+    bam_file = write_bam(tmp_path / 'reads.bam', [
+        (0, 2, 'r1', [('S', 2), ('M', 3), ('I', 2), ('M', 2), ('D', 2), ('=', 3), ('X', 1)], 'TTGTAGGCGCGTC', 30)
+    ])
+    pileup = pileup_bam(bam_file, 'ref')
+    counts = base_counts(pileup)
+    
+    assert ''.join('ACGT'[np.argmax(row[:4])] for row in counts[2:7]) == 'GTACG'
+    assert counts[2:7, :4].sum() == 5
+    assert counts[7:9, 4].tolist() == [1, 1]
+    assert counts[:, :4].sum(axis=1)[7:9].tolist() == [0, 0]
+    assert ''.join('ACGT'[np.argmax(row[:4])] for row in counts[9:13]) == 'CGTC'
+    assert np.flatnonzero(counts[:, 5]).tolist() == [4]
+    assert pileup['depth'].tolist() == [0, 0] + [1] * 11 + [0] * 7
+    assert pileup['quality_counts'][2, 2, 30] == 1
+
+def test_skipped_alignments(tmp_path):
+    # Unmapped, secondary, QC-failed and duplicate alignments and alignments
+    # to another contig are skipped like samtools mpileup does
+    records = [(0, 0, f'r{flag}', [('M', 4)], 'ACGT', 30, flag) for flag in [0, 0x4, 0x100, 0x200, 0x400, 0x800]]
+    records.append((1, 0, 'other', [('M', 4)], 'ACGT', 30))
+    bam_file = write_bam(tmp_path / 'reads.bam', records, [('ref', len(REFERENCE)), ('other', 10)])
+    pileup = pileup_bam(bam_file, 'ref')
+    
+    # The supplementary alignment (0x800) is counted
+    assert pileup['depth'][:4].tolist() == [2, 2, 2, 2]
+    assert pileup['depth'][4:].sum() == 0
+    
+    with pytest.raises(ValueError):
+        pileup_bam(bam_file, 'missing')
+
+def test_min_quality(tmp_path):
+    # Bases below the minimum quality are not counted but still add to the depth
+    bam_file = write_bam(tmp_path / 'reads.bam', [
+        (0, 0, 'r1', [('M', 4)], 'ACGT', [10, 20, 30, 40]),
+        (0, 0, 'r2', [('M', 4)], 'ACNT', [10, 20, 30, 40])
+    ])
+    pileup = pileup_bam(bam_file, 'ref')
+    counts = pileup_counts(pileup, min_quality=20)
+    
+    assert counts['counts'][:4, :4].sum(axis=1).tolist() == [0, 2, 1, 2]
+    assert counts['quality_sums'][3].tolist() == [0, 0, 0, 80]
+    assert pileup['depth'][:4].tolist() == [2, 2, 2, 2]
+
+def test_insertion_sequences(tmp_path):
+    bam_file = write_bam(tmp_path / 'reads.bam', [
+        (0, 0, 'r1', [('M', 4), ('I', 2), ('M', 4)], 'ACGTGGACGT', 30),
+        (0, 0, 'r2', [('M', 4), ('I', 2), ('M', 4)], 'ACGTGGACGT', 20),
+        (0, 0, 'r3', [('M', 4), ('I', 1), ('M', 4)], 'ACGTCACGT', 30),
+        (0, 0, 'r4', [('M', 8)], 'ACGTACGT', 30)
+    ])
+    pileup = pileup_bam(bam_file, 'ref')
+    
+    assert pileup['insertions'][3] == 3
+    assert insertion_candidates(pileup, 0.7) == [3]
+    assert insertion_candidates(pileup, 0.8) == []
+    assert insertion_sequences(bam_file, 'ref', [3]) == {3: {'GG': [2, 100], 'C': [1, 30]}}
+
+def test_long_cigar(tmp_path):
+    # Alignments with over 65,535 CIGAR operations hold a placeholder CIGAR
+    # and the real one in the CG tag (minimap2 -L)
+    cigar = [('M', 3), ('D', 1), ('M', 3)]
+    tags = b'CGBI' + struct.pack('<i', len(cigar)) + encode_cigar(cigar)
+    bam_file = write_bam(tmp_path / 'reads.bam', [
+        (0, 0, 'r1', [('S', 6), ('N', 7)], 'ACGACG', 30, 0, tags)
+    ])
+    counts = base_counts(pileup_bam(bam_file, 'ref'))
+    
+    assert counts[:7, :4].sum(axis=1).tolist() == [1, 1, 1, 0, 1, 1, 1]
+    assert counts[3, 4] == 1
+
+def test_call_consensus(tmp_path):
+    # Five reads over positions 0-9: position 2 splits C/T 3:2 (called Y),
+    # position 5 is deleted in four reads (left out) and GG is inserted
+    # after position 7 in all reads
+    records = []
+    for i in range(5):
+        seq = 'ACCTACGTGGAC' if i < 3 else 'ACTTACGTGGAC'
+        if i < 4:
+            records.append((0, 0, f'r{i}', [('M', 5), ('D', 1), ('M', 2), ('I', 2), ('M', 2)], seq[:5] + seq[6:], 30))
+        else:
+            records.append((0, 0, f'r{i}', [('M', 8), ('I', 2), ('M', 2)], seq, 30))
+    bam_file = write_bam(tmp_path / 'reads.bam', records)
+    pileup = pileup_bam(bam_file, 'ref')
+    insertions = insertion_sequences(bam_file, 'ref', insertion_candidates(pileup, 0.7))
+    sequence, qualities = call_consensus(pileup_counts(pileup), min_depth=3, majority_threshold=0.7, insertions=insertions)
+    
+    assert sequence == 'ACYTAGTGGAC'
+    assert qualities == '?' * len(sequence)
+    
+    # Without enough depth every position is left out
+    assert call_consensus(pileup_counts(pileup), min_depth=6, majority_threshold=0.7)[0] == ''
+
+def test_save_pileup(tmp_path):
+    bam_file = write_bam(tmp_path / 'reads.bam', [
+        (0, 0, 'r1', [('M', 4), ('I', 2), ('M', 4)], 'ACGTGGACGT', 30)
+    ])
+    pileup = pileup_bam(bam_file, 'ref')
+    insertions = insertion_sequences(bam_file, 'ref', [3])
+    save_pileup(tmp_path / 'pileup.npz', pileup, 'ref', insertions, 0.7)
+    loaded, contig, loaded_insertions, fraction = load_pileup(tmp_path / 'pileup.npz')
+    
+    assert contig == 'ref'
+    assert fraction == 0.7
+    assert loaded_insertions == insertions
+    assert loaded['quality_counts'].shape == (len(REFERENCE), 4, MAX_QUALITY + 1)
+    for key in ['quality_counts', 'deletions', 'insertions', 'depth']:
+        assert np.array_equal(loaded[key], pileup[key])